@@ -0,0 +1,116 @@
+import time
+import tracemalloc
+
+import numpy as np
+
+from dem_codec import TileBuffers, gsi_dem_to_height_m, height_m_to_terrarium_rgb, terrarium_to_height_m
+
+# dem_codec と従来実装（各スクリプトにコピーされていたもの）の速度・一時メモリを比べるマイクロベンチマーク
+# 出力が一致することも確認する
+
+N_TILES = 64        # 合成タイル数
+REPEAT = 5          # 計測回数（最良値を採用）
+BATCH = 16          # バッチ版の1回あたりタイル数
+
+# ===== 従来実装 =====
+def legacy_gsi_dem_to_height_m(rgb):
+    r = rgb[..., 0].astype(np.int32)
+    g = rgb[..., 1].astype(np.int32)
+    b = rgb[..., 2].astype(np.int32)
+    v = (r * 256 * 256 + g * 256 + b).astype(np.float32) * 0.01
+    v = np.where(r >= 128, v - 167772.16, v)
+    nodata = (r == 128) & (g == 0) & (b == 0)
+    return v, nodata
+
+def legacy_height_m_to_terrarium_rgb(height_m, nodata_mask):
+    h = height_m.astype(np.float32)
+    h = np.where(nodata_mask, 0.0, h)
+    v = h + 32768.0
+    v_floor = np.floor(v)
+    R = np.floor(v / 256.0).astype(np.int32)
+    G = (v_floor.astype(np.int32) % 256)
+    B = np.floor((v - v_floor) * 256.0).astype(np.int32)
+    out = np.stack([R, G, B], axis=-1)
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+def legacy_terrarium_to_height_m(rgb):
+    r = rgb[..., 0].astype(np.float32)
+    g = rgb[..., 1].astype(np.float32)
+    b = rgb[..., 2].astype(np.float32)
+    return (r * 256.0 + g + b / 256.0) - 32768.0
+
+# ===== 合成データ =====
+def synthetic_gsi_tiles(n: int, seed: int = 0) -> np.ndarray:
+    """(n, 256, 256, 3) の GSI dem_png。-50〜2500m の起伏 + 5% の nodata"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:256, 0:256].astype(np.float64)
+    out = np.empty((n, 256, 256, 3), dtype=np.uint8)
+    for i in range(n):
+        h = 1200 + 1300 * np.sin(xx / (20 + i) + i) * np.cos(yy / 31.0) + rng.normal(0, 2, (256, 256))
+        v = np.rint(h * 100).astype(np.int64) & 0xFFFFFF
+        out[i, ..., 0] = v >> 16
+        out[i, ..., 1] = (v >> 8) & 0xFF
+        out[i, ..., 2] = v & 0xFF
+        out[i][rng.random((256, 256)) < 0.05] = (128, 0, 0)
+    return out
+
+def measure(fn, tiles, per_call: int):
+    """-> (ns/タイル, 1回あたりのピーク一時メモリ bytes)"""
+    best = float("inf")
+    for _ in range(REPEAT):
+        t0 = time.perf_counter_ns()
+        for t in tiles:
+            fn(t)
+        best = min(best, time.perf_counter_ns() - t0)
+
+    tracemalloc.start()
+    fn(tiles[0])   # numpy の配列確保は tracemalloc で追える
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best / (len(tiles) * per_call), peak
+
+def main():
+    gsi = synthetic_gsi_tiles(N_TILES)
+    h_ref, nd_ref = legacy_gsi_dem_to_height_m(gsi[0])
+    ter = legacy_height_m_to_terrarium_rgb(h_ref, nd_ref)
+    ters = np.stack([legacy_height_m_to_terrarium_rgb(*legacy_gsi_dem_to_height_m(t)) for t in gsi])
+
+    # 一致確認
+    for t in gsi:
+        h0, n0 = legacy_gsi_dem_to_height_m(t)
+        h1, n1 = gsi_dem_to_height_m(t)
+        assert np.array_equal(h0.view(np.uint32), h1.view(np.uint32)) and np.array_equal(n0, n1)
+        assert np.array_equal(legacy_height_m_to_terrarium_rgb(h0, n0), height_m_to_terrarium_rgb(h1, n1))
+    assert np.array_equal(legacy_terrarium_to_height_m(ters), terrarium_to_height_m(ters))
+
+    buf = TileBuffers((256, 256))
+    bbuf = TileBuffers((BATCH, 256, 256))
+    batches = [gsi[i:i + BATCH] for i in range(0, N_TILES - BATCH + 1, BATCH)]
+    ter_batches = [ters[i:i + BATCH] for i in range(0, N_TILES - BATCH + 1, BATCH)]
+
+    def new_encode(t, b=buf):
+        h, nd = gsi_dem_to_height_m(t, out=b.height, nodata_out=b.nodata, buf=b)
+        return height_m_to_terrarium_rgb(h, nd, out=b.rgb, buf=b)
+
+    cases = [
+        ("gsi decode", "legacy", lambda t: legacy_gsi_dem_to_height_m(t), gsi, 1),
+        ("gsi decode", "codec", lambda t: gsi_dem_to_height_m(t, out=buf.height, nodata_out=buf.nodata, buf=buf), gsi, 1),
+        ("gsi decode", f"codec x{BATCH}", lambda t: gsi_dem_to_height_m(t, out=bbuf.height, nodata_out=bbuf.nodata, buf=bbuf), batches, BATCH),
+        ("terrarium encode", "legacy", lambda t: legacy_height_m_to_terrarium_rgb(h_ref, nd_ref), gsi, 1),
+        ("terrarium encode", "codec", lambda t: height_m_to_terrarium_rgb(h_ref, nd_ref, out=buf.rgb, buf=buf), gsi, 1),
+        ("gsi -> terrarium", "legacy", lambda t: legacy_height_m_to_terrarium_rgb(*legacy_gsi_dem_to_height_m(t)), gsi, 1),
+        ("gsi -> terrarium", "codec", new_encode, gsi, 1),
+        ("gsi -> terrarium", f"codec x{BATCH}", lambda t: new_encode(t, bbuf), batches, BATCH),
+        ("terrarium decode", "legacy", lambda t: legacy_terrarium_to_height_m(ter), gsi, 1),
+        ("terrarium decode", "codec", lambda t: terrarium_to_height_m(ter, out=buf.height, buf=buf), gsi, 1),
+        ("terrarium decode", f"codec x{BATCH}", lambda t: terrarium_to_height_m(t, out=bbuf.height, buf=bbuf), ter_batches, BATCH),
+    ]
+
+    print(f"Tiles: {N_TILES} x 256x256  (best of {REPEAT})")
+    print(f"{'stage':<18} {'impl':<10} {'ns/tile':>12} {'alloc/call':>12}")
+    for stage, impl, fn, data, per_call in cases:
+        ns, peak = measure(fn, data, per_call)
+        print(f"{stage:<18} {impl:<10} {ns:>12,.0f} {peak:>12,}")
+
+if __name__ == "__main__":
+    main()
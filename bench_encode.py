@@ -0,0 +1,53 @@
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+from bench_pipeline import synthetic_tile
+from dem_codec import height_m_to_terrarium_rgb
+from tile_encoder import encode_image, encode_png_fast
+
+# Terrarium タイルの画像エンコードを方式ごとに比べる（時間 / 出力サイズ）
+#   max / webp と、fast の zlib レベル x フィルタの組み合わせ
+# 復号した RGB が入力と一致すること（ロスレス）も確認する
+
+N_TILES = 32
+REPEAT = 3                      # 計測回数（最良値を採用）
+SEED = 0
+KINDS = ("land", "coast", "flat", "ocean")
+FAST_LEVELS = (1, 3, 6, 9)
+FAST_FILTERS = ("none", "sub", "up")
+
+def synthetic_terrarium_tiles(n: int = N_TILES, seed: int = SEED):
+    rng = np.random.default_rng(seed)
+    return [height_m_to_terrarium_rgb(*synthetic_tile(rng, KINDS[i % len(KINDS)])) for i in range(n)]
+
+def measure(fn, tiles):
+    """-> (ms/タイル, 平均 bytes/タイル)"""
+    best = float("inf")
+    for _ in range(REPEAT):
+        t0 = time.perf_counter()
+        blobs = [fn(t) for t in tiles]
+        best = min(best, time.perf_counter() - t0)
+    for t, b in zip(tiles, blobs):
+        assert np.array_equal(np.array(Image.open(io.BytesIO(b)).convert("RGB")), t), "not lossless"
+    return best / len(tiles) * 1000, sum(len(b) for b in blobs) / len(blobs)
+
+def main():
+    tiles = synthetic_terrarium_tiles()
+    cases = [("max", lambda t: encode_image(t, "max")), ("webp", lambda t: encode_image(t, "webp"))]
+    for level in FAST_LEVELS:
+        for filt in FAST_FILTERS:
+            cases.append((f"fast L{level} {filt}", lambda t, level=level, filt=filt: encode_png_fast(t, level, filt)))
+
+    print(f"Tiles: {N_TILES} x 256x256 Terrarium  (best of {REPEAT})")
+    print(f"{'mode':<14} {'ms/tile':>9} {'bytes/tile':>11} {'vs max':>8}")
+    base = None
+    for name, fn in cases:
+        ms, size = measure(fn, tiles)
+        base = base or size
+        print(f"{name:<14} {ms:>9.2f} {size:>11,.0f} {size / base * 100:>7.1f}%")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import json
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from dem_codec import buffers_for, gsi_dem_to_height_m, height_m_to_gsi_rgb, height_m_to_terrarium_rgb, terrarium_to_height_m
+from terrarium_to_mbtiles import ensure_schema, insert_tiles, xyz_y_to_tms_y
+from to_terrarium import decode_png, encode_png
+
+try:
+    import resource   # Unix のみ
+except ImportError:
+    resource = None
+
+# DEMパイプラインの段階別ベンチマーク（ネットワーク不要）
+#   合成した GSI dem_png タイル群を一時ディレクトリに作り、各段階を個別に計測する:
+#     read -> decode(PNG) -> height(符号化計算) -> encode(PNG) -> mbtiles(INSERT) -> validate(復号+誤差)
+#   結果（tiles/s, MB/s, peak RSS）を JSON で OUT_DIR に保存し、コミット間で比較できるようにする
+
+# ===== 設定 =====
+N_TILES = 256
+TILE_SIZE = 256
+# タイル種別の割合（残りは起伏のある陸地）
+OCEAN_RATIO = 0.2          # 全面 nodata
+FLAT_RATIO = 0.1           # 全面同じ標高
+COAST_NODATA_RATIO = 0.3   # 陸地タイルのうち海岸線（一部 nodata）を含む割合
+SEED = 0
+MB_BATCH = 1000            # MBTiles INSERT のバッチ
+OUT_DIR = Path("bench_results")
+
+def synthetic_tile(rng: np.random.Generator, kind: str, size: int = TILE_SIZE):
+    """kind: ocean / flat / land / coast -> (height_m float32, nodata bool)"""
+    if kind == "ocean":
+        return np.zeros((size, size), np.float32), np.ones((size, size), bool)
+    if kind == "flat":
+        return np.full((size, size), rng.uniform(0, 300), np.float32), np.zeros((size, size), bool)
+
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float64)
+    h = np.zeros((size, size))
+    for _ in range(4):   # 波長の違う起伏を重ねる
+        k = rng.uniform(0.005, 0.08)
+        h += rng.uniform(50, 600) * np.sin(k * xx + rng.uniform(0, 6.3)) * np.cos(k * 0.8 * yy + rng.uniform(0, 6.3))
+    h += 800 + rng.normal(0, 0.5, (size, size))
+    nodata = np.zeros((size, size), bool)
+    if kind == "coast":
+        # 斜めの海岸線より外側を nodata
+        nodata = (xx + yy * rng.uniform(0.3, 3.0)) > rng.uniform(0.5, 1.5) * size
+    return h.astype(np.float32), nodata
+
+def make_synthetic_tileset(root: Path, n: int = None, seed: int = None):
+    """root/14/{x}/{y}.png に GSI dem_png 形式で書き出す"""
+    n = N_TILES if n is None else n
+    rng = np.random.default_rng(SEED if seed is None else seed)
+    kinds = rng.choice(
+        ["ocean", "flat", "coast", "land"],
+        size=n,
+        p=[
+            OCEAN_RATIO,
+            FLAT_RATIO,
+            (1 - OCEAN_RATIO - FLAT_RATIO) * COAST_NODATA_RATIO,
+            (1 - OCEAN_RATIO - FLAT_RATIO) * (1 - COAST_NODATA_RATIO),
+        ],
+    )
+    side = int(np.ceil(np.sqrt(n)))
+    paths = []
+    for i, kind in enumerate(kinds):
+        z, x, y = 14, 14700 + i % side, 5900 + i // side
+        h, nodata = synthetic_tile(rng, kind)
+        path = root / str(z) / str(x) / f"{y}.png"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(encode_png(height_m_to_gsi_rgb(h, nodata)))
+        paths.append(((z, x, y), path))
+    return paths, {k: int((kinds == k).sum()) for k in ("ocean", "flat", "coast", "land")}
+
+def gsi_rgb_to_terrarium_rgb(rgb: np.ndarray) -> np.ndarray:
+    # 符号化計算だけを測る（変換の本体は to_terrarium.encode_tile_stats。作業領域はプロセス内で使い回す）
+    buf = buffers_for(rgb.shape[:-1])
+    h_m, nodata = gsi_dem_to_height_m(rgb, out=buf.height, nodata_out=buf.nodata, buf=buf)
+    return height_m_to_terrarium_rgb(h_m, nodata, out=buf.rgb, buf=buf)
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS は bytes
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name: str, seconds: float, tiles: int, nbytes: int):
+        self.stages[name] = {
+            "seconds": round(seconds, 6),
+            "tiles": tiles,
+            "bytes": nbytes,
+            "tiles_per_s": round(tiles / seconds, 2) if seconds > 0 else None,
+            "mb_per_s": round(nbytes / seconds / 1e6, 2) if seconds > 0 else None,
+        }
+
+def run_bench(workdir: Path):
+    paths, kinds = make_synthetic_tileset(workdir / "raw_dem")
+    n = len(paths)
+    timer = StageTimer()
+
+    t0 = time.perf_counter()
+    raws = [p.read_bytes() for _, p in paths]
+    raw_bytes = sum(len(r) for r in raws)
+    timer.add("read", time.perf_counter() - t0, n, raw_bytes)
+
+    t0 = time.perf_counter()
+    rgbs = [decode_png(r) for r in raws]
+    timer.add("decode", time.perf_counter() - t0, n, raw_bytes)
+
+    t0 = time.perf_counter()
+    ters = [gsi_rgb_to_terrarium_rgb(rgb).copy() for rgb in rgbs]
+    timer.add("height", time.perf_counter() - t0, n, sum(t.nbytes for t in rgbs))
+
+    t0 = time.perf_counter()
+    blobs = [encode_png(t) for t in ters]
+    out_bytes = sum(len(b) for b in blobs)
+    timer.add("encode", time.perf_counter() - t0, n, sum(t.nbytes for t in ters))
+
+    mb_path = workdir / "bench.mbtiles"
+    t0 = time.perf_counter()
+    conn = sqlite3.connect(str(mb_path))
+    try:
+        cur = conn.cursor()
+        ensure_schema(cur)
+        rows = [(z, x, xyz_y_to_tms_y(z, y), b) for ((z, x, y), _), b in zip(paths, blobs)]
+        for i in range(0, n, MB_BATCH):
+            insert_tiles(cur, rows[i:i + MB_BATCH])
+            conn.commit()
+    finally:
+        conn.close()
+    timer.add("mbtiles", time.perf_counter() - t0, n, out_bytes)
+
+    # validate: Terrarium PNG を復号して元の標高と比較（check_rmse と同じ計算）
+    t0 = time.perf_counter()
+    max_abs = 0.0
+    for rgb, blob in zip(rgbs, blobs):
+        raw_h, raw_nodata = gsi_dem_to_height_m(rgb)
+        ter_h = terrarium_to_height_m(decode_png(blob))
+        valid = ~raw_nodata
+        if valid.any():
+            max_abs = max(max_abs, float(np.abs(ter_h[valid] - raw_h[valid]).max()))
+    timer.add("validate", time.perf_counter() - t0, n, out_bytes)
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "params": {"n_tiles": n, "tile_size": TILE_SIZE, "kinds": kinds, "seed": SEED},
+        "raw_bytes": raw_bytes,
+        "terrarium_bytes": out_bytes,
+        "max_abs_error_m": max_abs,
+        "stages": timer.stages,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def main():
+    workdir = Path(tempfile.mkdtemp(prefix="dem_bench_"))
+    try:
+        result = run_bench(workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.fromisoformat(result["timestamp"]).strftime("%Y%m%dT%H%M%S")
+    out_path = OUT_DIR / f"pipeline_{stamp}_{result['commit'] or 'nogit'}.json"
+    out_path.write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    print(f"Tiles: {result['params']['n_tiles']}  kinds={result['params']['kinds']}")
+    print(f"{'stage':<10} {'sec':>9} {'tiles/s':>10} {'MB/s':>9}")
+    for name, st in result["stages"].items():
+        print(f"{name:<10} {st['seconds']:>9.3f} {st['tiles_per_s'] or 0:>10,.1f} {st['mb_per_s'] or 0:>9,.1f}")
+    if result["peak_rss_mb"] is not None:
+        print(f"Peak RSS: {result['peak_rss_mb']:.1f} MB")
+    print(f"Max abs error (m): {result['max_abs_error_m']:.6f}")
+    print(f"Result: {out_path.resolve()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import asyncio
+import random
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from tile_server import HOST, PORT, SOURCE_PATH, MBTilesSource, PMTilesSource, open_source
+
+# tile_server.py の負荷試験（ローカル）。並列クライアントから keep-alive でタイルを要求し、レイテンシの分位点を出す
+#   - 要求するタイルはタイルセットの中身から選び、一部は Zipf 風に偏らせる（地図を見るときと同じく人気タイルが多い）
+#   - REVALIDATE_RATIO の割合で前回の ETag を If-None-Match に付ける（304 の経路）
+#   - MISSING_RATIO の割合で範囲外のタイルを要求する（404 の経路）
+# START_SERVER = True なら tile_server.py を別プロセスで起動して、終わったら止める
+
+SERVER = (HOST, PORT)
+START_SERVER = True
+CLIENTS = 32                # 同時接続数
+REQUESTS = 5000             # 合計リクエスト数
+ZIPF_S = 1.1                # 人気タイルへの偏り（大きいほど一部のタイルに集中）
+REVALIDATE_RATIO = 0.2
+MISSING_RATIO = 0.05
+SEED = 0
+PERCENTILES = (50, 90, 99)
+
+def list_tiles(path: Path):
+    """タイルセットにある (z, x, y) の一覧"""
+    src = open_source(path)
+    try:
+        if isinstance(src, MBTilesSource):
+            conn = src.pool.get()
+            try:
+                return [(z, x, (1 << z) - 1 - row) for z, x, row in
+                        conn.execute("SELECT zoom_level, tile_column, tile_row FROM tiles ORDER BY 1, 2, 3")], src.format
+            finally:
+                src.pool.put(conn)
+        if isinstance(src, PMTilesSource):
+            from pmtiles_io import tileid_to_zxy
+            return [tileid_to_zxy(tile_id) for tile_id, _, _ in src.reader.iter_entries()], src.format
+    finally:
+        src.close()
+
+def make_requests(tiles, n: int, seed: int = SEED):
+    rng = random.Random(seed)
+    order = tiles[:]
+    rng.shuffle(order)
+    weights = [1.0 / (i + 1) ** ZIPF_S for i in range(len(order))]
+    picks = rng.choices(order, weights=weights, k=n)
+    out = []
+    for z, x, y in picks:
+        if rng.random() < MISSING_RATIO:
+            # 範囲外（同じズームでタイルセットから遠い位置）
+            out.append((z, (x + (1 << z) // 2) % (1 << z), y, False))
+        else:
+            out.append((z, x, y, rng.random() < REVALIDATE_RATIO))
+    return out
+
+async def read_response(reader: asyncio.StreamReader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ")[1])
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    length = int(headers.get("content-length", 0))
+    body = await reader.readexactly(length) if length else b""
+    return status, headers, body
+
+async def client(queue: list, fmt: str, etags: dict, latencies: list, statuses: dict):
+    reader, writer = await asyncio.open_connection(*SERVER)
+    try:
+        while queue:
+            z, x, y, revalidate = queue.pop()
+            req = f"GET /{z}/{x}/{y}.{fmt} HTTP/1.1\r\nHost: {SERVER[0]}:{SERVER[1]}\r\n"
+            etag = etags.get((z, x, y)) if revalidate else None
+            if etag:
+                req += f"If-None-Match: {etag}\r\n"
+            t0 = time.perf_counter()
+            writer.write((req + "\r\n").encode("latin-1"))
+            await writer.drain()
+            status, headers, _ = await read_response(reader)
+            latencies.append(time.perf_counter() - t0)
+            statuses[status] = statuses.get(status, 0) + 1
+            if "etag" in headers:
+                etags[(z, x, y)] = headers["etag"]
+    finally:
+        writer.close()
+
+async def run_load(requests, fmt: str, clients: int = CLIENTS):
+    queue = list(reversed(requests))
+    etags, latencies, statuses = {}, [], {}
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client(queue, fmt, etags, latencies, statuses) for _ in range(clients)))
+    return time.perf_counter() - t0, latencies, statuses
+
+async def wait_for_server(timeout: float = 10.0):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(*SERVER)
+            writer.close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise SystemExit(f"Server did not start on {SERVER[0]}:{SERVER[1]}")
+            await asyncio.sleep(0.1)
+
+def main():
+    if not SOURCE_PATH.exists():
+        raise SystemExit(f"Tileset not found: {SOURCE_PATH.resolve()}")
+    tiles, fmt = list_tiles(SOURCE_PATH)
+    requests = make_requests(tiles, REQUESTS)
+
+    proc = subprocess.Popen([sys.executable, "tile_server.py"], stdout=subprocess.DEVNULL) if START_SERVER else None
+    try:
+        asyncio.run(wait_for_server())
+        dt, latencies, statuses = asyncio.run(run_load(requests, fmt))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+    ms = np.array(latencies) * 1000
+    print(f"Tileset: {SOURCE_PATH} ({len(tiles):,} tiles)  clients={CLIENTS}  requests={len(latencies):,}")
+    print(f"Throughput: {len(latencies) / dt:,.0f} req/s  ({dt:.2f}s)")
+    print("Latency (ms): " + "  ".join(f"p{q}={np.percentile(ms, q):.2f}" for q in PERCENTILES)
+          + f"  max={ms.max():.2f}")
+    print("Status: " + "  ".join(f"{k}={v:,}" for k, v in sorted(statuses.items())))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+from dem_codec import gsi_dem_to_height_m, height_m_to_gsi_rgb
+from dem_png import BBOX_E, BBOX_N, BBOX_S, BBOX_W, OUT_DIR, Z_MAX, Z_MIN, tile_range_for_bbox
+from to_terrarium import write_atomic
+
+# 最大ズーム（Z_MAX）の raw_dem だけから下位ズーム（Z_MAX-1 .. Z_MIN）を作る。
+# 子タイル2x2を標高(m)のまま 512x512 に並べて 1/2 に縮小し、GSI dem_png 形式で raw_dem/ に書き出す。
+# 以降の to_terrarium.py / raw_to_mbtiles.py はそのまま使える。
+# 深さ優先で下から作るので、メモリ上にあるのは各ズームで高々1組の子タイルだけ。
+
+RAW_DIR = OUT_DIR          # raw_dem/{z}/{x}/{y}.png
+TILE_SIZE = 256
+
+# 縮小カーネル
+#   mean:    nodata を除いた平均（2x2が全部nodataならnodata）
+#   nearest: 2x2の左上（nodataならnodata）
+#   max/min: nodata を除いた最大/最小
+RESAMPLING = "mean"
+
+def downsample_2x(height_m: np.ndarray, nodata: np.ndarray, kernel: str = RESAMPLING):
+    """(2H, 2W) -> (H, W)。nodata を考慮して2x2ブロックを1画素にする"""
+    h2, w2 = height_m.shape
+    if kernel == "nearest":
+        return height_m[0::2, 0::2].copy(), nodata[0::2, 0::2].copy()
+
+    blocks = height_m.reshape(h2 // 2, 2, w2 // 2, 2).astype(np.float64)
+    valid = ~nodata.reshape(h2 // 2, 2, w2 // 2, 2)
+    count = valid.sum(axis=(1, 3))
+    out_nodata = count == 0
+
+    if kernel == "mean":
+        total = np.where(valid, blocks, 0.0).sum(axis=(1, 3))
+        out = total / np.maximum(count, 1)
+    elif kernel == "max":
+        out = np.where(valid, blocks, -np.inf).max(axis=(1, 3))
+    elif kernel == "min":
+        out = np.where(valid, blocks, np.inf).min(axis=(1, 3))
+    else:
+        raise ValueError(f"Unknown resampling kernel: {kernel}")
+
+    out = np.where(out_nodata, 0.0, out).astype(np.float32)
+    return out, out_nodata
+
+def load_tile(z: int, x: int, y: int):
+    path = RAW_DIR / str(z) / str(x) / f"{y}.png"
+    if not path.exists():
+        return None
+    rgb = np.array(Image.open(path).convert("RGB"), dtype=np.uint8)
+    return gsi_dem_to_height_m(rgb)
+
+def save_tile(z: int, x: int, y: int, height_m: np.ndarray, nodata: np.ndarray):
+    path = RAW_DIR / str(z) / str(x) / f"{y}.png"
+    buf = io.BytesIO()
+    Image.fromarray(height_m_to_gsi_rgb(height_m, nodata), mode="RGB").save(buf, format="PNG")
+    # 中断しても書きかけの PNG を残さない（dem_png.py はサイズ0でないファイルをスキップする）
+    write_atomic(path, buf.getvalue())
+
+class OverviewBuilder:
+    def __init__(self, z_min: int = Z_MIN, z_max: int = Z_MAX, kernel: str = RESAMPLING,
+                 bbox=(BBOX_W, BBOX_S, BBOX_E, BBOX_N), plan=None, sources=None):
+        """
+        plan: tile_plan.TilePlan（複数範囲・ポリゴン）。指定すれば bbox の代わりにその範囲を辿る
+        sources: 取得済みのタイルの TilePlan（範囲ごとに最大ズームが違うとき）。含まれるタイルは作らずに読む
+        """
+        self.z_min = z_min
+        self.z_max = z_max
+        self.kernel = kernel
+        self.plan = plan
+        self.sources = sources
+        # 子を辿る範囲を bbox 内に限定する
+        self.ranges = {z: tile_range_for_bbox(*bbox, z) for z in range(z_min, z_max + 1)}
+        self.written = {z: 0 for z in range(z_min, z_max)}
+
+    def in_range(self, z: int, x: int, y: int) -> bool:
+        if self.plan is not None:
+            return self.plan.contains(z, x, y)
+        x_min, x_max, y_min, y_max = self.ranges[z]
+        return x_min <= x <= x_max and y_min <= y <= y_max
+
+    def build(self, z: int, x: int, y: int):
+        """(z, x, y) の (height_m, nodata) を返す。Z_MAX（か sources に含まれる）なら読み込み、それ以外は子から作る"""
+        if z == self.z_max or (self.sources is not None and self.sources.contains(z, x, y)):
+            return load_tile(z, x, y)
+
+        size = TILE_SIZE
+        mosaic = None
+        mask = None
+        for dy in (0, 1):
+            for dx in (0, 1):
+                cx, cy = 2 * x + dx, 2 * y + dy
+                if not self.in_range(z + 1, cx, cy):
+                    continue
+                child = self.build(z + 1, cx, cy)
+                if child is None:
+                    continue
+                if mosaic is None:
+                    mosaic = np.zeros((2 * size, 2 * size), dtype=np.float32)
+                    mask = np.ones((2 * size, 2 * size), dtype=bool)   # 子が無い部分は nodata
+                mosaic[dy * size:(dy + 1) * size, dx * size:(dx + 1) * size] = child[0]
+                mask[dy * size:(dy + 1) * size, dx * size:(dx + 1) * size] = child[1]
+
+        if mosaic is None:
+            return None
+
+        h, nodata = downsample_2x(mosaic, mask, self.kernel)
+        save_tile(z, x, y, h, nodata)
+        self.written[z] += 1
+        return h, nodata
+
+    def run(self):
+        if self.plan is not None:
+            for _, x, y in self.plan.iter_tiles(self.z_min, self.z_min):
+                self.build(self.z_min, x, y)
+            return self.written
+        x_min, x_max, y_min, y_max = self.ranges[self.z_min]
+        for x in range(x_min, x_max + 1):
+            for y in range(y_min, y_max + 1):
+                self.build(self.z_min, x, y)
+        return self.written
+
+def main():
+    if not RAW_DIR.exists():
+        raise SystemExit(f"Input dir not found: {RAW_DIR.resolve()}")
+    if not (RAW_DIR / str(Z_MAX)).exists():
+        raise SystemExit(f"No z{Z_MAX} tiles under {RAW_DIR}/ (run dem_png.py first)")
+
+    t0 = time.perf_counter()
+    written = OverviewBuilder().run()
+    dt = time.perf_counter() - t0
+
+    print(f"Overviews built from z{Z_MAX} ({RESAMPLING}):")
+    for z in sorted(written, reverse=True):
+        print(f"z{z}: {written[z]:,} tiles")
+    print(f"Total: {sum(written.values()):,} tiles  ({dt:.1f}s)")
+    print(f"Output dir: {RAW_DIR.resolve()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,447 @@
+import heapq
+import io
+import json
+import os
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import perf_metrics
+import uniform_tiles
+from check_write_diff_heatmaps import load_rgb, write_legend_png, write_tile_heatmaps
+from dem_codec import GSI_NODATA_RGB, buffers_for, gsi_dem_to_height_m, terrarium_to_height_m
+from task_stream import StopRequest, bounded_results, ignore_sigint, iter_chunks, iter_tile_files
+
+# check_terrarium / check_rmse_gsi_vs_terrarium / check_write_diff_heatmaps を1パスで行う。
+#   - terrarium と raw_dem の各タイルを1回だけ読み・復号し、min/max・0m比率・RMSE/MAE/最大誤差・タイル別統計をまとめて集計
+#   - 最大誤差が大きい TOP_N タイルは diff 配列ごと保持し、ヒートマップは読み直さずに書く
+#   - ワーカープロセスごとの部分集計（ValidationStats）を merge して全体の結果にする
+#   - ズームごとに標高・誤差のヒストグラム（固定ビン）を持ち、P50/P95/P99 と nodata 比率を JSON レポートに出す
+#     ビン数は固定なのでタイル数が増えてもメモリは増えない
+#   - タイルは辿りながらチャンクにして投入する（一覧を作らない）。Ctrl-C ならそこまでの集計でレポートを書いて止める
+#   - Terrarium が一様で raw_dem が無いか全面 nodata のタイル（海）は比べる画素が無いので、復号せずに1画素の値から集計する
+
+RAW_DIR = Path("raw_dem")       # GSI dem_png: raw_dem/{z}/{x}/{y}.png
+TERRA_DIR = Path("terrarium")   # Terrarium:  terrarium/{z}/{x}/{y}.png
+OUT_DIR = Path("diff_maps")     # ヒートマップの出力先（None なら書かない）
+
+FOCUS_Z = None                  # None なら全ズーム。数値ならそのズームだけ（存在しなければ全体）
+TOP_N = 3                       # 表示するタイル数・ヒートマップを書くタイル数
+CLIP_M = 0.0020                 # ヒートマップのクリップ幅（±m）
+
+WORKERS = os.cpu_count() or 1
+CHUNKSIZE = 64                  # 1タスクでワーカーに渡すタイル数
+
+# ===== ヒストグラム（範囲外は両端のビンに入れる） =====
+ELEV_MIN_M = -500.0
+ELEV_MAX_M = 4500.0
+ELEV_BIN_M = 10.0
+ERR_MAX_M = 0.05                # |誤差| のヒストグラム範囲 0..ERR_MAX_M
+ERR_BIN_M = 0.00001             # 0.01mm（分位点の分解能）
+PERCENTILES = (50, 95, 99)
+
+# ===== レポート・判定 =====
+REPORT_PATH = Path("validation_report.json")   # None なら書かない
+GATE_P99_M = 0.004              # どのズームでも P99 |誤差| がこれを超えたら終了コード1（None で無効）
+GATE_MAX_M = 0.01               # どのズームでも最大 |誤差| がこれを超えたら終了コード1（None で無効）
+
+class TopN:
+    """key が大きい順に n 件だけ残す（ヒープ）。key が同じ値にならないよう呼び出し側で通し番号を入れる"""
+
+    def __init__(self, n: int):
+        self.n = n
+        self.heap = []
+
+    def push(self, key, item):
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, (key, item))
+        elif key > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (key, item))
+
+    def merge(self, other: "TopN"):
+        for key, item in other.heap:
+            self.push(key, item)
+
+    def items(self):
+        """key の大きい順"""
+        return [item for _, item in sorted(self.heap, key=lambda e: e[0], reverse=True)]
+
+def fixed_histogram(values: np.ndarray, lo: float, bin_m: float, nbins: int) -> np.ndarray:
+    idx = np.floor((values - lo) / bin_m).astype(np.int64)
+    np.clip(idx, 0, nbins - 1, out=idx)
+    return np.bincount(idx, minlength=nbins)
+
+def hist_percentile(counts: np.ndarray, q: float, bin_m: float, lo: float = 0.0) -> float:
+    """固定ビンのヒストグラムから分位点を求める（該当ビンの上端 = 安全側の値）"""
+    total = int(counts.sum())
+    if total == 0:
+        return None
+    i = int(np.searchsorted(np.cumsum(counts), q / 100.0 * total))
+    return round(lo + (i + 1) * bin_m, 9)
+
+class ZoomStats:
+    """1ズーム分の集計（固定長のヒストグラム + 合計値のみ）"""
+
+    ELEV_BINS = int(round((ELEV_MAX_M - ELEV_MIN_M) / ELEV_BIN_M))
+    ERR_BINS = int(round(ERR_MAX_M / ERR_BIN_M))
+
+    def __init__(self):
+        self.tiles = 0
+        self.pixels = 0
+        self.zero_px = 0
+        self.elev_min = float("inf")
+        self.elev_max = float("-inf")
+        self.elev_hist = np.zeros(self.ELEV_BINS, dtype=np.int64)
+        self.raw_px = 0
+        self.nodata_px = 0
+        self.compared = 0
+        self.n = 0
+        self.sum_sq = 0.0
+        self.sum_abs = 0.0
+        self.max_abs = 0.0
+        self.err_hist = np.zeros(self.ERR_BINS, dtype=np.int64)
+
+    def add_terrarium(self, elev_hist: np.ndarray, pixels: int, hmin: float, hmax: float, zero_px: int):
+        self.tiles += 1
+        self.pixels += pixels
+        self.zero_px += zero_px
+        self.elev_min = min(self.elev_min, hmin)
+        self.elev_max = max(self.elev_max, hmax)
+        self.elev_hist += elev_hist
+
+    def add_raw(self, pixels: int, nodata_px: int):
+        self.raw_px += pixels
+        self.nodata_px += nodata_px
+
+    def add_error(self, absdiff: np.ndarray, sq: float, sabs: float, tile_max: float):
+        self.compared += 1
+        self.n += absdiff.size
+        self.sum_sq += sq
+        self.sum_abs += sabs
+        self.max_abs = max(self.max_abs, tile_max)
+        self.err_hist += fixed_histogram(absdiff, 0.0, ERR_BIN_M, self.ERR_BINS)
+
+    def merge(self, other: "ZoomStats"):
+        for name in ("tiles", "pixels", "zero_px", "raw_px", "nodata_px", "compared", "n", "sum_sq", "sum_abs"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.elev_min = min(self.elev_min, other.elev_min)
+        self.elev_max = max(self.elev_max, other.elev_max)
+        self.max_abs = max(self.max_abs, other.max_abs)
+        self.elev_hist += other.elev_hist
+        self.err_hist += other.err_hist
+
+    def percentiles(self) -> dict:
+        return {f"p{q}": hist_percentile(self.err_hist, q, ERR_BIN_M) for q in PERCENTILES}
+
+    def to_dict(self) -> dict:
+        def trimmed(counts):
+            # 末尾の0は省く（JSON を小さくする）
+            nz = np.flatnonzero(counts)
+            return counts[:nz[-1] + 1].tolist() if nz.size else []
+
+        return {
+            "tiles": self.tiles,
+            "pixels": self.pixels,
+            "zero_ratio": self.zero_px / self.pixels if self.pixels else None,
+            "nodata_ratio": self.nodata_px / self.raw_px if self.raw_px else None,
+            "elev_min_m": self.elev_min if self.tiles else None,
+            "elev_max_m": self.elev_max if self.tiles else None,
+            "compared_tiles": self.compared,
+            "valid_pixels": self.n,
+            "rmse_m": float(np.sqrt(self.sum_sq / self.n)) if self.n else None,
+            "mae_m": self.sum_abs / self.n if self.n else None,
+            "max_abs_m": self.max_abs if self.n else None,
+            "abs_error_percentiles_m": self.percentiles(),
+            "elev_hist": {"min_m": ELEV_MIN_M, "bin_m": ELEV_BIN_M, "counts": trimmed(self.elev_hist)},
+            "abs_error_hist": {"min_m": 0.0, "bin_m": ERR_BIN_M, "counts": trimmed(self.err_hist)},
+        }
+
+class ValidationStats:
+    """部分集計。ワーカーで作り、main で merge する（同じ順序で足せば逐次版と同じ結果）"""
+
+    def __init__(self, top_n: int = TOP_N):
+        # check_terrarium 相当（terrarium 側のみ）
+        self.checked = 0
+        self.global_min = float("inf")
+        self.global_max = float("-inf")
+        self.zero_count = 0
+        self.total_px = 0
+        self.lowest_min = TopN(top_n)
+        self.highest_max = TopN(top_n)
+        # check_rmse 相当（raw_dem とのペア）
+        self.compared = 0
+        self.sum_sq = 0.0
+        self.sum_abs = 0.0
+        self.n = 0
+        self.max_abs = 0.0
+        self.max_abs_key = None
+        self.max_abs_tile = None
+        self.worst = TopN(top_n)
+        # ヒートマップ用（diff 配列を保持）
+        self.heat = TopN(top_n)
+        # ズーム別
+        self.zooms = {}
+
+    def add_terrarium(self, idx: int, rel: str, elev_hist: np.ndarray, pixels: int, hmin: float, hmax: float,
+                      zero_px: int) -> ZoomStats:
+        zs = self.zooms.setdefault(int(rel.split("/")[0]), ZoomStats())
+        self.checked += 1
+        self.global_min = min(self.global_min, hmin)
+        self.global_max = max(self.global_max, hmax)
+        self.zero_count += zero_px
+        self.total_px += pixels
+        zs.add_terrarium(elev_hist, pixels, hmin, hmax, zero_px)
+        # 同じ値ならファイル順で先のものを優先（従来のスクリプトの安定ソートと同じ並び）
+        self.lowest_min.push((-hmin, -idx), (rel, hmin, hmax))
+        self.highest_max.push((hmax, -idx), (rel, hmin, hmax))
+        return zs
+
+    def add_uniform(self, idx: int, rel: str, ter_v: np.ndarray, shape: tuple, raw_nodata: bool):
+        """
+        全画素が同じ標高 ter_v（np.float32）の Terrarium タイルで、raw_dem は無い（raw_nodata=False）か
+        全面 nodata（True）のもの。add_tile に全画素の配列を渡したのと同じ集計を1画素の値から作る
+        """
+        pixels = shape[0] * shape[1]
+        v = float(ter_v)
+        elev_hist = fixed_histogram(ter_v.reshape(1), ELEV_MIN_M, ELEV_BIN_M, ZoomStats.ELEV_BINS) * pixels
+        zs = self.add_terrarium(idx, rel, elev_hist, pixels, v, v, pixels if v == 0.0 else 0)
+        if raw_nodata:
+            zs.add_raw(pixels, pixels)
+
+    def add_tile(self, idx: int, rel: str, ter_h: np.ndarray, raw=None):
+        """raw: (raw_h, raw_nodata) または None（raw_dem に無いタイル）"""
+        elev_hist = fixed_histogram(ter_h.ravel(), ELEV_MIN_M, ELEV_BIN_M, ZoomStats.ELEV_BINS)
+        zero_px = int(np.count_nonzero(ter_h == 0.0))
+        zs = self.add_terrarium(idx, rel, elev_hist, ter_h.size, float(np.min(ter_h)), float(np.max(ter_h)), zero_px)
+
+        if raw is None:
+            return
+        raw_h, raw_nodata = raw
+        if raw_h.shape != ter_h.shape:
+            raise RuntimeError(f"Tile size mismatch: {rel} raw={raw_h.shape} terra={ter_h.shape}")
+        zs.add_raw(raw_nodata.size, int(np.count_nonzero(raw_nodata)))
+        valid = ~raw_nodata
+        if not np.any(valid):
+            return
+
+        diff32 = ter_h - raw_h
+        diff = diff32[valid].astype(np.float64)
+        absdiff = np.abs(diff)
+        sq = float(np.sum(diff * diff))
+        sabs = float(np.sum(absdiff))
+        tile_n = diff.size
+        tile_max = float(np.max(absdiff))
+
+        self.compared += 1
+        self.sum_sq += sq
+        self.sum_abs += sabs
+        self.n += tile_n
+        key = (tile_max, -idx)
+        if self.max_abs_key is None or key > self.max_abs_key:
+            self.max_abs, self.max_abs_key, self.max_abs_tile = tile_max, key, rel
+        self.worst.push(key, (rel, tile_n, float(np.sqrt(sq / tile_n)), sabs / tile_n, tile_max))
+        self.heat.push(key, (rel, tile_max, diff32, valid))
+        zs.add_error(absdiff, sq, sabs, tile_max)
+
+    def merge(self, other: "ValidationStats"):
+        self.checked += other.checked
+        self.global_min = min(self.global_min, other.global_min)
+        self.global_max = max(self.global_max, other.global_max)
+        self.zero_count += other.zero_count
+        self.total_px += other.total_px
+        self.lowest_min.merge(other.lowest_min)
+        self.highest_max.merge(other.highest_max)
+
+        self.compared += other.compared
+        self.sum_sq += other.sum_sq
+        self.sum_abs += other.sum_abs
+        self.n += other.n
+        if other.max_abs_key is not None and (self.max_abs_key is None or other.max_abs_key > self.max_abs_key):
+            self.max_abs, self.max_abs_key, self.max_abs_tile = other.max_abs, other.max_abs_key, other.max_abs_tile
+        self.worst.merge(other.worst)
+        self.heat.merge(other.heat)
+        for z, zs in other.zooms.items():
+            if z in self.zooms:
+                self.zooms[z].merge(zs)
+            else:
+                self.zooms[z] = zs
+
+    def to_report(self) -> dict:
+        return {
+            "generated_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "focus_z": FOCUS_Z,
+            "summary": {
+                "checked_tiles": self.checked,
+                "compared_tiles": self.compared,
+                "elev_min_m": self.global_min,
+                "elev_max_m": self.global_max,
+                "zero_ratio": self.zero_count / self.total_px if self.total_px else None,
+                "valid_pixels": self.n,
+                "rmse_m": float(np.sqrt(self.sum_sq / self.n)) if self.n else None,
+                "mae_m": self.sum_abs / self.n if self.n else None,
+                "max_abs_m": self.max_abs if self.n else None,
+                "max_abs_tile": self.max_abs_tile,
+            },
+            "zooms": {str(z): self.zooms[z].to_dict() for z in sorted(self.zooms)},
+        }
+
+def gate_failures(stats: ValidationStats) -> list:
+    """GATE_* を超えたズームの一覧（空なら合格）"""
+    failures = []
+    for z in sorted(stats.zooms):
+        zs = stats.zooms[z]
+        if zs.n == 0:
+            continue
+        p99 = zs.percentiles()["p99"]
+        if GATE_P99_M is not None and p99 > GATE_P99_M:
+            failures.append(f"z{z}: P99 |err| {p99:.6f} m > {GATE_P99_M} m")
+        if GATE_MAX_M is not None and zs.max_abs > GATE_MAX_M:
+            failures.append(f"z{z}: max |err| {zs.max_abs:.6f} m > {GATE_MAX_M} m")
+    return failures
+
+def validate_chunk(items):
+    """ワーカー: [(通し番号, 相対パス)] -> (ValidationStats, 計測値, 見つけた一様タイル)"""
+    stats = ValidationStats()
+    for idx, rel in items:
+        rpath = RAW_DIR / rel
+        with perf_metrics.timer("read"):
+            ter_png = (TERRA_DIR / rel).read_bytes()
+            raw_png = rpath.read_bytes() if rpath.exists() else None
+
+        # 海（raw が全面 nodata）の一様タイルは比べる画素が無く、自明に正しい: 復号せずに集計だけ足す
+        ter_u = uniform_tiles.detect(ter_png)
+        if ter_u is not None:
+            raw_u = uniform_tiles.detect(raw_png) if raw_png is not None else None
+            if raw_png is None or raw_u == (GSI_NODATA_RGB, ter_u[1]):
+                with perf_metrics.timer("uniform"):
+                    ter_v = terrarium_to_height_m(np.array([[ter_u[0]]], dtype=np.uint8))[0, 0]
+                    stats.add_uniform(idx, rel, ter_v, ter_u[1], raw_png is not None)
+                perf_metrics.count("uniform_tiles")
+                continue
+
+        with perf_metrics.timer("read"):
+            ter_rgb = load_rgb(io.BytesIO(ter_png))
+            raw_rgb = load_rgb(io.BytesIO(raw_png)) if raw_png is not None else None
+        with perf_metrics.timer("codec"):
+            buf = buffers_for(ter_rgb.shape[:-1])
+            ter_h = terrarium_to_height_m(ter_rgb, buf=buf)
+            raw = gsi_dem_to_height_m(raw_rgb, buf=buf) if raw_rgb is not None else None
+        with perf_metrics.timer("stats"):
+            stats.add_tile(idx, rel, ter_h, raw)
+    perf_metrics.count("tiles", len(items))
+    return stats, perf_metrics.take(), uniform_tiles.take_learned()
+
+def merge_result(total: ValidationStats, result):
+    stats, snap, learned = result
+    total.merge(stats)
+    perf_metrics.merge(snap)
+    uniform_tiles.remember(learned)
+
+def run_validation(rels, workers: int = WORKERS, stop: StopRequest = None) -> ValidationStats:
+    """rels: 相対パスの列（ジェネレータでよい）"""
+    chunks = iter_chunks(enumerate(rels), CHUNKSIZE)
+    total = ValidationStats()
+    if workers == 1:
+        for result in bounded_results(None, validate_chunk, chunks, 1, stop):
+            merge_result(total, result)
+        return total
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=ignore_sigint) as ex:
+        # 投入中のチャンクは workers*2 個まで（TOP_N の diff 配列を持って返るのでメモリを抑える）
+        for result in bounded_results(ex, validate_chunk, chunks, workers * 2, stop):
+            merge_result(total, result)
+    return total
+
+@perf_metrics.stage("check")
+def main():
+    if not TERRA_DIR.exists():
+        raise SystemExit(f"terrarium not found: {TERRA_DIR.resolve()}")
+
+    # FOCUS_Z のズームだけに絞る（存在するなら）
+    z_dir = TERRA_DIR / str(FOCUS_Z) if FOCUS_Z is not None else None
+    root = z_dir if z_dir and z_dir.exists() else TERRA_DIR
+    if next(iter_tile_files(root), None) is None:
+        raise SystemExit("No terrarium png found.")
+    rels = (p.relative_to(TERRA_DIR).as_posix() for p in iter_tile_files(root))
+
+    t0 = time.perf_counter()
+    with StopRequest() as stop:
+        try:
+            stats = run_validation(rels, max(1, WORKERS), stop)
+        finally:
+            uniform_tiles.save()
+    dt = time.perf_counter() - t0
+    if stop.requested:
+        print(f"Interrupted: results below cover the first {stats.checked:,} tiles only")
+
+    print(f"Checked tiles: {stats.checked} (focus z={FOCUS_Z if FOCUS_Z is not None else 'all'})  ({dt:.1f}s)")
+    print(f"Height min/max (m): {stats.global_min:.3f} .. {stats.global_max:.3f}")
+    print(f"0m pixels ratio: {stats.zero_count / stats.total_px * 100:.3f}%  (note: nodata->0mの場合は参考値)")
+
+    print(f"\n--- Lowest min tiles (top {TOP_N}) ---")
+    for rel, hmin, hmax in stats.lowest_min.items():
+        print(f"{TERRA_DIR / rel}  min={hmin:.3f}  max={hmax:.3f}")
+    print(f"\n--- Highest max tiles (top {TOP_N}) ---")
+    for rel, hmin, hmax in stats.highest_max.items():
+        print(f"{TERRA_DIR / rel}  min={hmin:.3f}  max={hmax:.3f}")
+
+    if stats.n == 0:
+        raise SystemExit("No valid pixels to compare (raw_dem missing or all nodata?)")
+
+    print(f"\nCompared tiles: {stats.compared}")
+    print(f"Valid pixels: {stats.n:,}")
+    print(f"RMSE (m): {np.sqrt(stats.sum_sq / stats.n):.6f}")
+    print(f"MAE  (m): {stats.sum_abs / stats.n:.6f}")
+    print(f"Max abs error (m): {stats.max_abs:.6f}  at tile {stats.max_abs_tile}")
+
+    print(f"\n--- Worst tiles by max abs error (top {TOP_N}) ---")
+    for rel, tile_n, tile_rmse, tile_mae, tile_max in stats.worst.items():
+        print(f"{rel}  n={tile_n:,}  rmse={tile_rmse:.6f}  mae={tile_mae:.6f}  max={tile_max:.6f}")
+
+    print("\n--- Per zoom ---")
+    print(f"{'z':>3} {'tiles':>7} {'nodata':>8} {'min':>9} {'max':>9} {'rmse':>9} "
+          + " ".join(f"{'p' + str(q):>9}" for q in PERCENTILES) + f" {'max|err|':>9}")
+    for z in sorted(stats.zooms):
+        d = stats.zooms[z].to_dict()
+        if d["valid_pixels"] == 0:
+            print(f"{z:>3} {d['tiles']:>7,}  (no raw_dem to compare)")
+            continue
+        pct = d["abs_error_percentiles_m"]
+        print(f"{z:>3} {d['tiles']:>7,} {d['nodata_ratio'] * 100:>7.2f}% {d['elev_min_m']:>9.2f} {d['elev_max_m']:>9.2f} "
+              f"{d['rmse_m']:>9.6f} " + " ".join(f"{pct[f'p{q}']:>9.5f}" for q in PERCENTILES)
+              + f" {d['max_abs_m']:>9.6f}")
+
+    if OUT_DIR is not None:
+        OUT_DIR.mkdir(parents=True, exist_ok=True)
+        legend = OUT_DIR / f"legend_clip_{CLIP_M}m.png"
+        write_legend_png(legend, CLIP_M)
+        print(f"\nWriting heatmaps: top {TOP_N} tiles")
+        for rel, tile_max, diff, valid in stats.heat.items():
+            with perf_metrics.timer("heatmap"):
+                heat_path, gray_path = write_tile_heatmaps(rel, diff, valid, CLIP_M, OUT_DIR)
+            print(f"- {rel}  max_abs={tile_max:.6f} m")
+            print(f"  {heat_path}")
+            print(f"  {gray_path}")
+        print(f"\nLegend: {legend}")
+        print(f"Output dir: {OUT_DIR.resolve()}")
+
+    if REPORT_PATH is not None:
+        report = stats.to_report()
+        report["interrupted"] = stop.requested
+        REPORT_PATH.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"Report: {REPORT_PATH.resolve()}")
+    stop.exit_if_requested(f"validated {stats.checked:,} tiles before stopping (gate not evaluated)")
+
+    failures = gate_failures(stats)
+    if failures:
+        print("\nGATE FAILED:")
+        for f in failures:
+            print(f"  {f}")
+        raise SystemExit(1)
+    print("\nGate: OK")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+from pathlib import Path
+
+from pmtiles_io import PMTilesReader, tileid_to_zxy
+
+PM_PATH = Path("dem_terrarium_z8-14.pmtiles")
+TERRA_DIR = Path("terrarium")   # 突き合わせ用: terrarium/{z}/{x}/{y}.png
+
+def main():
+    if not PM_PATH.exists():
+        raise SystemExit(f"PMTiles not found: {PM_PATH.resolve()}")
+    if not TERRA_DIR.exists():
+        raise SystemExit(f"terrarium not found: {TERRA_DIR.resolve()}")
+
+    reader = PMTilesReader(PM_PATH)
+    try:
+        h = reader.header
+        meta = reader.metadata()
+
+        # 1. terrarium/ の各タイルが PMTiles から同じバイト列で読めるか
+        files = sorted(TERRA_DIR.rglob("*.png"))
+        mismatch = missing = 0
+        for p in files:
+            rel = p.relative_to(TERRA_DIR)
+            z, x, y = int(rel.parts[0]), int(rel.parts[1]), int(rel.parts[2].replace(".png", ""))
+            data = reader.get_tile(z, x, y)
+            if data is None:
+                missing += 1
+                print(f"missing: {rel.as_posix()}")
+            elif data != p.read_bytes():
+                mismatch += 1
+                print(f"mismatch: {rel.as_posix()}")
+
+        # 2. ディレクトリを全走査した件数がヘッダと一致するか
+        entries = list(reader.iter_entries())
+        extra = sum(
+            1 for tile_id, _, _ in entries
+            if not (TERRA_DIR / "{}/{}/{}.png".format(*tileid_to_zxy(tile_id))).exists()
+        )
+    finally:
+        reader.close()
+
+    print(f"PMTiles: {PM_PATH.resolve()}")
+    print(f"name: {meta.get('name')}  zoom: {h['min_zoom']}-{h['max_zoom']}")
+    print(f"addressed={h['addressed_tiles_count']}  entries={h['tile_entries_count']}  contents={h['tile_contents_count']}")
+    print(f"Compared tiles: {len(files)}  missing={missing}  mismatch={mismatch}  extra={extra}")
+
+    ok = (
+        missing == 0 and mismatch == 0 and extra == 0
+        and len(entries) == h["addressed_tiles_count"] == len(files)
+    )
+    if not ok:
+        raise SystemExit("NG: PMTiles does not round-trip")
+    print("OK: PMTiles round-trip matches terrarium/")
+
+if __name__ == "__main__":
+    main()
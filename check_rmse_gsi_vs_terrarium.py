@@ -2,40 +2,12 @@ import numpy as np
 from PIL import Image
 from pathlib import Path
 
+from dem_codec import gsi_dem_to_height_m, terrarium_to_height_m
+
 RAW_DIR = Path("raw_dem")       # GSI dem_png: raw_dem/{z}/{x}/{y}.png
 TERRA_DIR = Path("terrarium")   # Terrarium:  terrarium/{z}/{x}/{y}.png
 FOCUS_Z = 14                    # まずは最大ズーム推奨（存在しなければ全体）
 
-# GSI dem_png nodata（無効値）
-GSI_NODATA_RGB = (128, 0, 0)
-
-def gsi_dem_to_height_m(rgb: np.ndarray):
-    """
-    GSI dem_png (RGB uint8) -> (height_m float32, nodata_mask bool)
-    h = (R*256*256 + G*256 + B)*0.01
-    if R>=128: h -= 167772.16
-    nodata = (128,0,0)
-    """
-    r = rgb[..., 0].astype(np.int32)
-    g = rgb[..., 1].astype(np.int32)
-    b = rgb[..., 2].astype(np.int32)
-
-    h = (r * 256 * 256 + g * 256 + b).astype(np.float32) * 0.01
-    h = np.where(r >= 128, h - 167772.16, h)
-
-    nodata = (r == GSI_NODATA_RGB[0]) & (g == GSI_NODATA_RGB[1]) & (b == GSI_NODATA_RGB[2])
-    return h, nodata
-
-def terrarium_to_height_m(rgb: np.ndarray) -> np.ndarray:
-    """
-    Terrarium RGB -> height(m)
-    h = (R*256 + G + B/256) - 32768
-    """
-    r = rgb[..., 0].astype(np.float32)
-    g = rgb[..., 1].astype(np.float32)
-    b = rgb[..., 2].astype(np.float32)
-    return (r * 256.0 + g + b / 256.0) - 32768.0
-
 def load_rgb(path: Path) -> np.ndarray:
     return np.array(Image.open(path).convert("RGB"), dtype=np.uint8)
 
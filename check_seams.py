@@ -0,0 +1,362 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+import perf_metrics
+import uniform_tiles
+from check_all import TopN, fixed_histogram, hist_percentile
+from check_write_diff_heatmaps import diff_to_heat_rgb, write_legend_png
+from dem_mosaic import load_tile_height
+from task_stream import StopRequest, bounded_results, ignore_sigint
+from tile_encoder import save_image
+
+# 隣り合うタイルの継ぎ目（端の行・列）の連続性を全ズームで確認する（hillshade に線が出る不具合の検出）
+#   - 横に並ぶ (x, y)-(x+1, y) と縦に並ぶ (x, y)-(x, y+1) の全ペアを1回ずつ比べる
+#   - 継ぎ目の段差から、両側の傾きで説明できる分を引いた残差を見る:
+#       残差 = (b0 - a0) - ((a0 - a1) + (b1 - b0)) / 2     a1, a0 | b0, b1 は継ぎ目をまたぐ4画素
+#     地形がなめらかにつながっていれば残差は曲率ぶんだけ。同じ式をタイル内部（中央）でも計算し、基準にする
+#   - 行順（y, x）に走査し、復号したタイルは LRU キャッシュから使う。キャッシュが2行分あれば各タイルの復号は約1回
+#     一様タイル（海など）は PNG を復号せず1画素の値から作る（dem_mosaic.load_tile_height）
+#   - ズームごとに行の帯（CHUNK_ROWS 行）をワーカーに分ける。帯の次の1行は下の継ぎ目のためにもう一度復号する
+#   - タスクはズームを1つずつ走査しながら作る（持つのはそのズームのタイル座標の行ごとの一覧だけ）。Ctrl-C ならそこまでで止める
+#   - 継ぎ目の平均 |残差| がタイル内部より大きいペア TOP_N はペアを並べたヒートマップ（継ぎ目を横切る方向の2階差分）に書く
+
+TERRA_DIR = Path("terrarium")       # Terrarium:  terrarium/{z}/{x}/{y}.png
+RAW_DIR = Path("raw_dem")           # GSI dem_png: raw_dem/{z}/{x}/{y}.png
+SOURCE = "terrarium"                # terrarium / raw（raw は nodata の画素を比べない）
+OUT_DIR = Path("seam_maps")         # ヒートマップの出力先（None なら書かない）
+REPORT_PATH = Path("seam_report.json")   # None なら書かない
+
+ZOOMS = None                        # None なら全ズーム。(8, 14) のように指定も可
+TOP_N = 5                           # 表示・ヒートマップを書く継ぎ目の数
+CLIP_M = 1.0                        # ヒートマップのクリップ幅（±m）
+
+CACHE_TILES = 1024                  # LRU キャッシュのタイル数（帯の幅 x 2 以上あれば再復号しない）
+WORKERS = os.cpu_count() or 1
+CHUNK_ROWS = 16                     # 1タスクでワーカーに渡すタイル行数
+
+# ===== |残差| ヒストグラム（範囲外は最後のビン） =====
+RESID_MAX_M = 100.0
+RESID_BIN_M = 0.01
+PERCENTILES = (50, 99)
+
+# どのズームでも 継ぎ目の平均 |残差| > タイル内部の平均 |残差| x GATE_RATIO なら終了コード1（None で無効）
+GATE_RATIO = 3.0
+
+AXES = ("h", "v")                   # h: 右隣 (x+1, y) / v: 下隣 (x, y+1)
+
+class TileCache:
+    """復号済みタイルの LRU キャッシュ（(x, y) -> (height, nodata)）"""
+
+    def __init__(self, load, capacity: int = CACHE_TILES):
+        self.load = load
+        self.capacity = capacity
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+        self.misses += 1
+        tile = self.tiles[key] = self.load(key)
+        if len(self.tiles) > self.capacity:
+            self.tiles.popitem(last=False)
+        return tile
+
+def seam_residual(a1, a0, b0, b1):
+    """継ぎ目をまたぐ4本の画素列 -> 残差（m）"""
+    return (b0 - a0) - ((a0 - a1) + (b1 - b0)) * 0.5
+
+def edge_lines(a, b, axis: str):
+    """ペア (a, b) の継ぎ目をまたぐ4本と、a の中央をまたぐ4本（基準）"""
+    if axis == "h":
+        n = a.shape[1] // 2
+        return (a[:, -2], a[:, -1], b[:, 0], b[:, 1]), (a[:, n - 2], a[:, n - 1], a[:, n], a[:, n + 1])
+    n = a.shape[0] // 2
+    return (a[-2], a[-1], b[0], b[1]), (a[n - 2], a[n - 1], a[n], a[n + 1])
+
+class ZoomSeamStats:
+    """1ズーム分の集計（固定長のヒストグラム + 合計値のみ）"""
+
+    BINS = int(round(RESID_MAX_M / RESID_BIN_M))
+
+    def __init__(self):
+        self.tiles = 0
+        self.pairs = {axis: 0 for axis in AXES}
+        self.n = 0
+        self.sum_abs = 0.0
+        self.max_abs = 0.0
+        self.inner_n = 0
+        self.inner_sum_abs = 0.0
+        self.seam_hist = np.zeros(self.BINS, dtype=np.int64)
+        self.inner_hist = np.zeros(self.BINS, dtype=np.int64)
+
+    def add_pair(self, axis: str, seam: np.ndarray, inner: np.ndarray):
+        self.pairs[axis] += 1
+        self.n += seam.size
+        self.sum_abs += float(np.sum(seam))
+        self.max_abs = max(self.max_abs, float(np.max(seam)))
+        self.inner_n += inner.size
+        self.inner_sum_abs += float(np.sum(inner))
+        self.seam_hist += fixed_histogram(seam, 0.0, RESID_BIN_M, self.BINS)
+        self.inner_hist += fixed_histogram(inner, 0.0, RESID_BIN_M, self.BINS)
+
+    def merge(self, other: "ZoomSeamStats"):
+        self.tiles += other.tiles
+        for axis in AXES:
+            self.pairs[axis] += other.pairs[axis]
+        self.n += other.n
+        self.sum_abs += other.sum_abs
+        self.inner_n += other.inner_n
+        self.inner_sum_abs += other.inner_sum_abs
+        self.max_abs = max(self.max_abs, other.max_abs)
+        self.seam_hist += other.seam_hist
+        self.inner_hist += other.inner_hist
+
+    def percentiles(self, counts: np.ndarray) -> dict:
+        return {f"p{q}": hist_percentile(counts, q, RESID_BIN_M) for q in PERCENTILES}
+
+    def to_dict(self) -> dict:
+        return {
+            "tiles": self.tiles,
+            "pairs_h": self.pairs["h"],
+            "pairs_v": self.pairs["v"],
+            "seam_pixels": self.n,
+            "seam_mean_abs_m": self.sum_abs / self.n if self.n else None,
+            "seam_max_abs_m": self.max_abs if self.n else None,
+            "inner_mean_abs_m": self.inner_sum_abs / self.inner_n if self.inner_n else None,
+            "seam_abs_percentiles_m": self.percentiles(self.seam_hist),
+            "inner_abs_percentiles_m": self.percentiles(self.inner_hist),
+        }
+
+class SeamStats:
+    """部分集計。ワーカーで作り、main で merge する"""
+
+    def __init__(self, top_n: int = TOP_N):
+        self.zooms = {}
+        self.worst = TopN(top_n)
+        self.decoded = 0
+        self.cache_hits = 0
+
+    def zoom(self, z: int) -> ZoomSeamStats:
+        return self.zooms.setdefault(z, ZoomSeamStats())
+
+    def add_pair(self, z: int, x: int, y: int, axis: str, a, b):
+        """a, b: (height, nodata)。b は a の右（h）または下（v）"""
+        (a_h, a_nd), (b_h, b_nd) = a, b
+        seam_lines, inner_lines = edge_lines(a_h, b_h, axis)
+        nd_seam, nd_inner = edge_lines(a_nd, b_nd, axis)
+        valid = ~(nd_seam[0] | nd_seam[1] | nd_seam[2] | nd_seam[3])
+        valid_inner = ~(nd_inner[0] | nd_inner[1] | nd_inner[2] | nd_inner[3])
+        if not valid.any():
+            return
+        seam = np.abs(seam_residual(*(line.astype(np.float64) for line in seam_lines)))[valid]
+        inner = np.abs(seam_residual(*(line.astype(np.float64) for line in inner_lines)))[valid_inner]
+        self.zoom(z).add_pair(axis, seam, inner)
+        # 順位は「継ぎ目の平均 |残差| - タイル内部の平均 |残差|」（起伏の大きい所・低ズームが常に上に来ないように）
+        # 同じ値なら z, y, x の小さい方を優先（ワーカーの分け方に依らず同じ結果）
+        seam_mean = float(np.mean(seam))
+        excess = seam_mean - (float(np.mean(inner)) if inner.size else 0.0)
+        self.worst.push((excess, -z, -y, -x, axis == "h"),
+                        (z, x, y, axis, excess, seam_mean, float(np.max(seam))))
+
+    def merge(self, other: "SeamStats"):
+        for z, zs in other.zooms.items():
+            self.zoom(z).merge(zs)
+        self.worst.merge(other.worst)
+        self.decoded += other.decoded
+        self.cache_hits += other.cache_hits
+
+    def to_report(self) -> dict:
+        return {
+            "generated_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "source": SOURCE,
+            "zooms": {str(z): self.zooms[z].to_dict() for z in sorted(self.zooms)},
+            "worst": [{"z": z, "x": x, "y": y, "axis": axis, "excess_m": excess, "mean_abs_m": mean, "max_abs_m": m}
+                      for z, x, y, axis, excess, mean, m in self.worst.items()],
+        }
+
+def source_dir() -> Path:
+    return {"terrarium": TERRA_DIR, "raw": RAW_DIR}[SOURCE]
+
+def tile_loader(z: int):
+    z_dir = source_dir() / str(z)
+
+    def load(key):
+        with perf_metrics.timer("load"):
+            return load_tile_height(z_dir / str(key[0]) / f"{key[1]}.png", SOURCE)
+
+    return load
+
+def scan_zoom(z: int):
+    """-> {y: [x, ...]}（x は昇順）"""
+    rows = {}
+    for p in (source_dir() / str(z)).glob("*/*.png"):
+        rows.setdefault(int(p.stem), []).append(int(p.parent.name))
+    for xs in rows.values():
+        xs.sort()
+    return rows
+
+def check_rows(task):
+    """ワーカー: (z, {y: [x]}（帯の行 + 次の1行）, 帯の行数) -> (SeamStats, 計測値, 見つけた一様タイル)"""
+    z, rows, band = task
+    stats = SeamStats()
+    cache = TileCache(tile_loader(z))
+    present = {(x, y) for y, xs in rows.items() for x in xs}
+    for y in sorted(rows)[:band]:
+        for x in rows[y]:
+            a = cache.get((x, y))
+            if (x + 1, y) in present:
+                b = cache.get((x + 1, y))
+                with perf_metrics.timer("seam"):
+                    stats.add_pair(z, x, y, "h", a, b)
+            if (x, y + 1) in present:
+                b = cache.get((x, y + 1))
+                with perf_metrics.timer("seam"):
+                    stats.add_pair(z, x, y, "v", a, b)
+            stats.zoom(z).tiles += 1
+    stats.decoded = cache.misses
+    stats.cache_hits = cache.hits
+    perf_metrics.count("tiles", sum(stats.zoom(z).tiles for z in stats.zooms))
+    perf_metrics.count("decoded", cache.misses)
+    return stats, perf_metrics.take(), uniform_tiles.take_learned()
+
+def iter_tasks(z: int, rows: dict):
+    ys = sorted(rows)
+    for i in range(0, len(ys), CHUNK_ROWS):
+        band = ys[i:i + CHUNK_ROWS]
+        task_rows = {y: rows[y] for y in band}
+        if band[-1] + 1 in rows:
+            task_rows[band[-1] + 1] = rows[band[-1] + 1]
+        yield z, task_rows, len(band)
+
+def merge_result(total: SeamStats, result):
+    stats, snap, learned = result
+    total.merge(stats)
+    perf_metrics.merge(snap)
+    uniform_tiles.remember(learned)
+
+def run_seams(zooms, workers: int = WORKERS, stop: StopRequest = None) -> SeamStats:
+    tasks = (t for z in zooms for t in iter_tasks(z, scan_zoom(z)))
+    total = SeamStats()
+    if workers <= 1:
+        for result in bounded_results(None, check_rows, tasks, 1, stop):
+            merge_result(total, result)
+        return total
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=ignore_sigint) as ex:
+        for result in bounded_results(ex, check_rows, tasks, workers * 2, stop):
+            merge_result(total, result)
+    return total
+
+def write_seam_heatmap(z: int, x: int, y: int, axis: str, clip_m: float, out_dir: Path) -> Path:
+    """ペアを並べて、継ぎ目を横切る方向の2階差分をヒートマップにする（継ぎ目に段差があれば線になる）"""
+    load = tile_loader(z)
+    (a_h, a_nd), (b_h, b_nd) = load((x, y)), load((x + 1, y) if axis == "h" else (x, y + 1))
+    cat = 1 if axis == "h" else 0
+    h = np.concatenate([a_h, b_h], axis=cat).astype(np.float64)
+    nd = np.concatenate([a_nd, b_nd], axis=cat)
+    d2 = np.zeros_like(h)
+    valid = np.zeros(h.shape, dtype=bool)
+    if axis == "h":
+        d2[:, 1:-1] = h[:, 2:] - 2.0 * h[:, 1:-1] + h[:, :-2]
+        valid[:, 1:-1] = ~(nd[:, 2:] | nd[:, 1:-1] | nd[:, :-2])
+    else:
+        d2[1:-1] = h[2:] - 2.0 * h[1:-1] + h[:-2]
+        valid[1:-1] = ~(nd[2:] | nd[1:-1] | nd[:-2])
+    path = out_dir / f"seam_{z}_{x}_{y}_{axis}_clip{clip_m}m.png"
+    save_image(path, diff_to_heat_rgb(d2, valid, clip_m), "fast")
+    return path
+
+def gate_failures(stats: SeamStats) -> list:
+    failures = []
+    if GATE_RATIO is None:
+        return failures
+    for z in sorted(stats.zooms):
+        zs = stats.zooms[z]
+        if zs.n == 0:
+            continue
+        seam_mean = zs.sum_abs / zs.n
+        inner_mean = zs.inner_sum_abs / zs.inner_n if zs.inner_n else 0.0
+        if seam_mean > inner_mean * GATE_RATIO:
+            failures.append(f"z{z}: seam mean |resid| {seam_mean:.3f} m > inner mean {inner_mean:.3f} m x {GATE_RATIO}")
+    return failures
+
+@perf_metrics.stage("seams")
+def main():
+    if not source_dir().exists():
+        raise SystemExit(f"Input dir not found: {source_dir().resolve()}")
+    zooms = sorted(int(p.name) for p in source_dir().iterdir() if p.is_dir() and p.name.isdigit())
+    if ZOOMS is not None:
+        zooms = [z for z in zooms if ZOOMS[0] <= z <= ZOOMS[1]]
+    if not zooms:
+        raise SystemExit("No zoom dirs found.")
+
+    t0 = time.perf_counter()
+    with StopRequest() as stop:
+        try:
+            stats = run_seams(zooms, stop=stop)
+        finally:
+            uniform_tiles.save()
+    dt = time.perf_counter() - t0
+    if stop.requested:
+        print("Interrupted: results below cover only the rows checked so far")
+
+    tiles = sum(zs.tiles for zs in stats.zooms.values())
+    print(f"Seam check ({SOURCE}): tiles {tiles:,}  decoded {stats.decoded:,}  cache hits {stats.cache_hits:,}  ({dt:.1f}s)")
+    print(f"{'z':>3} {'tiles':>7} {'pairs':>7} {'mean':>8} "
+          + " ".join(f"{'p' + str(q):>8}" for q in PERCENTILES) + f" {'max':>8}  {'in mean':>8} "
+          + " ".join(f"{'in p' + str(q):>8}" for q in PERCENTILES))
+    for z in sorted(stats.zooms):
+        d = stats.zooms[z].to_dict()
+        if d["seam_pixels"] == 0:
+            print(f"{z:>3} {d['tiles']:>7,}  (no neighbouring tiles)")
+            continue
+        seam_pct, inner_pct = d["seam_abs_percentiles_m"], d["inner_abs_percentiles_m"]
+        print(f"{z:>3} {d['tiles']:>7,} {d['pairs_h'] + d['pairs_v']:>7,} {d['seam_mean_abs_m']:>8.3f} "
+              + " ".join(f"{seam_pct[f'p{q}']:>8.3f}" for q in PERCENTILES) + f" {d['seam_max_abs_m']:>8.3f}  "
+              + f"{d['inner_mean_abs_m']:>8.3f} " + " ".join(f"{inner_pct[f'p{q}']:>8.3f}" for q in PERCENTILES))
+
+    print(f"\n--- Worst seams by mean |resid| above the tile interior (top {TOP_N}) ---")
+    for z, x, y, axis, excess, seam_mean, seam_max in stats.worst.items():
+        other = f"{z}/{x + 1}/{y}" if axis == "h" else f"{z}/{x}/{y + 1}"
+        print(f"{z}/{x}/{y} | {other}  excess={excess:+.3f}  mean={seam_mean:.3f}  max={seam_max:.3f}")
+
+    if OUT_DIR is not None and stats.worst.heap:
+        OUT_DIR.mkdir(parents=True, exist_ok=True)
+        legend = OUT_DIR / f"legend_clip_{CLIP_M}m.png"
+        write_legend_png(legend, CLIP_M)
+        print(f"\nWriting heatmaps: top {TOP_N} seams")
+        for z, x, y, axis, *_ in stats.worst.items():
+            with perf_metrics.timer("heatmap"):
+                path = write_seam_heatmap(z, x, y, axis, CLIP_M, OUT_DIR)
+            print(f"  {path}")
+        print(f"Legend: {legend}")
+
+    if REPORT_PATH is not None:
+        report = stats.to_report()
+        report["interrupted"] = stop.requested
+        REPORT_PATH.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"Report: {REPORT_PATH.resolve()}")
+    stop.exit_if_requested("seam check stopped (gate not evaluated)")
+
+    failures = gate_failures(stats)
+    if failures:
+        print("\nGATE FAILED:")
+        for f in failures:
+            print(f"  {f}")
+        raise SystemExit(1)
+    print("\nGate: OK")
+
+if __name__ == "__main__":
+    main()
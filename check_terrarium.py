@@ -2,20 +2,12 @@ import numpy as np
 from PIL import Image
 from pathlib import Path
 
+from dem_codec import terrarium_to_height_m
+
 IN_DIR = Path("terrarium")  # terrarium/{z}/{x}/{y}.png
 # どのズームを重点チェックするか（表示品質に効くので最大ズーム推奨）
 FOCUS_Z = 14
 
-def terrarium_to_height_m(rgb: np.ndarray) -> np.ndarray:
-    """
-    Terrarium RGB -> height in meters (float32)
-      h = (R*256 + G + B/256) - 32768
-    """
-    r = rgb[..., 0].astype(np.float32)
-    g = rgb[..., 1].astype(np.float32)
-    b = rgb[..., 2].astype(np.float32)
-    return (r * 256.0 + g + b / 256.0) - 32768.0
-
 def main():
     if not IN_DIR.exists():
         raise SystemExit(f"Input dir not found: {IN_DIR.resolve()}")
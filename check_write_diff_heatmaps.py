@@ -2,6 +2,9 @@ import numpy as np
 from PIL import Image
 from pathlib import Path
 
+from dem_codec import gsi_dem_to_height_m, terrarium_to_height_m
+from tile_encoder import save_image
+
 RAW_DIR = Path("raw_dem")
 TERRA_DIR = Path("terrarium")
 
@@ -11,29 +14,11 @@ OUT_DIR = Path("diff_maps")
 FOCUS_Z = 14              # まずは最大ズーム
 TOP_N = 3                 # 最大誤差が大きいタイル上位N枚を出力
 CLIP_M = 0.0020           # ヒートマップのクリップ幅（±m）。今回の誤差なら2mm程度が見やすい
-
-GSI_NODATA_RGB = (128, 0, 0)
+ENCODE_MODE = "fast"      # 確認用の画像なので速さ優先（tile_encoder.py の "max" / "fast"）
 
 def load_rgb(path: Path) -> np.ndarray:
     return np.array(Image.open(path).convert("RGB"), dtype=np.uint8)
 
-def gsi_dem_to_height_m(rgb: np.ndarray):
-    r = rgb[..., 0].astype(np.int32)
-    g = rgb[..., 1].astype(np.int32)
-    b = rgb[..., 2].astype(np.int32)
-
-    h = (r * 256 * 256 + g * 256 + b).astype(np.float32) * 0.01
-    h = np.where(r >= 128, h - 167772.16, h)
-
-    nodata = (r == GSI_NODATA_RGB[0]) & (g == GSI_NODATA_RGB[1]) & (b == GSI_NODATA_RGB[2])
-    return h, nodata
-
-def terrarium_to_height_m(rgb: np.ndarray) -> np.ndarray:
-    r = rgb[..., 0].astype(np.float32)
-    g = rgb[..., 1].astype(np.float32)
-    b = rgb[..., 2].astype(np.float32)
-    return (r * 256.0 + g + b / 256.0) - 32768.0
-
 def diff_to_heat_rgb(diff: np.ndarray, valid: np.ndarray, clip_m: float) -> np.ndarray:
     """
     diff(m) をRGBヒートマップにする（簡易）
@@ -65,7 +50,25 @@ def write_legend_png(path: Path, clip_m: float):
     row = np.stack([r, g, b], axis=-1).astype(np.uint8)
     img = np.repeat(row[np.newaxis, :, :], h, axis=0)
 
-    Image.fromarray(img, "RGB").save(path, format="PNG", optimize=True)
+    save_image(path, img, ENCODE_MODE)
+
+def write_tile_heatmaps(rel, diff: np.ndarray, valid: np.ndarray, clip_m: float, out_dir: Path,
+                        mode: str = ENCODE_MODE):
+    """1タイル分のヒートマップとdiff絶対値のグレースケールを書き出す -> (heat_path, gray_path)"""
+    heat = diff_to_heat_rgb(diff, valid, clip_m)
+
+    # 画像出力（ヒートマップ + diff数値の絶対値マップもオプションで）
+    out_name = str(rel).replace("/", "_").replace("\\", "_").replace(".png", "")
+    heat_path = out_dir / f"{out_name}_diff_heat_clip{clip_m}m.png"
+    save_image(heat_path, heat, mode)
+
+    # 参考: diffの絶対値をグレースケール化（0..clip）
+    absd = np.clip(np.abs(diff), 0, clip_m) / clip_m
+    gray = (absd * 255.0).astype(np.uint8)
+    gray_rgb = np.stack([gray, gray, gray], axis=-1)
+    gray_path = out_dir / f"{out_name}_absdiff_gray_clip{clip_m}m.png"
+    save_image(gray_path, gray_rgb, mode)
+    return heat_path, gray_path
 
 def main():
     OUT_DIR.mkdir(parents=True, exist_ok=True)
@@ -124,19 +127,7 @@ def main():
         valid = ~raw_nodata
         diff = (ter_h - raw_h).astype(np.float32)
 
-        heat = diff_to_heat_rgb(diff, valid, CLIP_M)
-
-        # 画像出力（ヒートマップ + diff数値の絶対値マップもオプションで）
-        out_name = str(rel).replace("/", "_").replace("\\", "_").replace(".png", "")
-        heat_path = OUT_DIR / f"{out_name}_diff_heat_clip{CLIP_M}m.png"
-        Image.fromarray(heat, "RGB").save(heat_path, format="PNG", optimize=True)
-
-        # 参考: diffの絶対値をグレースケール化（0..clip）
-        absd = np.clip(np.abs(diff), 0, CLIP_M) / CLIP_M
-        gray = (absd * 255.0).astype(np.uint8)
-        gray_rgb = np.stack([gray, gray, gray], axis=-1)
-        gray_path = OUT_DIR / f"{out_name}_absdiff_gray_clip{CLIP_M}m.png"
-        Image.fromarray(gray_rgb, "RGB").save(gray_path, format="PNG", optimize=True)
+        heat_path, gray_path = write_tile_heatmaps(rel, diff, valid, CLIP_M, OUT_DIR)
 
         print(f"- {rel}  max_abs={max_abs:.6f} m")
         print(f"  {heat_path}")
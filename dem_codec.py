@@ -0,0 +1,152 @@
+import functools
+
+import numpy as np
+
+# GSI dem_png / Terrarium の符号化・復号（各スクリプト共通）
+#   - RGB 3ch を 24bit 整数にパックして（uint32 ビュー）1回の演算で扱う
+#   - out= / buf= を渡せば作業領域を使い回し、呼び出しごとの一時配列を作らない
+#   - 先頭に任意の次元を持てる: (256,256,3) でも (N,256,256,3) でも同じ関数で処理する
+# 結果は従来の各スクリプトの実装とビット単位で一致する（float32 の演算順序を変えていない）
+
+# GSI dem_png の nodata（無効値）: RGB=(128,0,0) = 0x800000
+GSI_NODATA_RGB = (128, 0, 0)
+GSI_NODATA = 0x800000
+GSI_SIGN_OFFSET = np.float32(167772.16)     # 2^24 * 0.01
+GSI_SCALE = np.float32(0.01)
+
+TERRARIUM_OFFSET = np.float32(32768.0)
+TERRARIUM_SCALE = np.float32(256.0)
+TERRARIUM_INV_SCALE = np.float32(1.0 / 256.0)
+
+class TileBuffers:
+    """
+    1タイル（または1バッチ）分の作業領域。shape は画素の形（(H, W) や (N, H, W)）
+    スレッド間で共有しないこと
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.rgba = np.zeros(self.shape + (4,), dtype=np.uint8)   # [B, G, R, 0] -> <u4 で R<<16|G<<8|B
+        self.packed = self.rgba.view("<u4")[..., 0]
+        self.f32 = np.empty(self.shape, dtype=np.float32)
+        self.i32 = np.empty(self.shape, dtype=np.int32)
+        # 呼び出し側が out= に渡す用
+        self.height = np.empty(self.shape, dtype=np.float32)
+        self.nodata = np.empty(self.shape, dtype=bool)
+        self.rgb = np.empty(self.shape + (3,), dtype=np.uint8)
+
+@functools.lru_cache(maxsize=8)
+def buffers_for(shape) -> TileBuffers:
+    """shape ごとに1つの作業領域を使い回す（プロセス内キャッシュ）"""
+    return TileBuffers(shape)
+
+def pack_rgb24(rgb: np.ndarray, buf: TileBuffers = None) -> np.ndarray:
+    """(..., 3) uint8 -> (...) uint32 = R<<16 | G<<8 | B（buf.rgba のビュー）"""
+    if buf is None:
+        buf = TileBuffers(rgb.shape[:-1])
+    # チャンネルごとにコピーする方が rgb[..., ::-1] の一括コピーより速い
+    rgba = buf.rgba
+    rgba[..., 0] = rgb[..., 2]
+    rgba[..., 1] = rgb[..., 1]
+    rgba[..., 2] = rgb[..., 0]
+    return buf.packed
+
+def gsi_dem_to_height_m(rgb: np.ndarray, out: np.ndarray = None, nodata_out: np.ndarray = None,
+                        buf: TileBuffers = None):
+    """
+    GSI dem_png (RGB uint8) -> (height_m float32, nodata_mask bool)
+    仕様:
+      h = (R*256*256 + G*256 + B) * 0.01
+      if R >= 128: h -= 167772.16
+      nodata = (128,0,0)
+    """
+    if buf is None:
+        buf = TileBuffers(rgb.shape[:-1])
+    packed = pack_rgb24(rgb, buf)
+    shape = packed.shape
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    if nodata_out is None:
+        nodata_out = np.empty(shape, dtype=bool)
+
+    np.copyto(out, packed, casting="unsafe")          # 24bit なので float32 で正確
+    np.multiply(out, GSI_SCALE, out=out)
+    # 符号付き補正（R>=128）: nodata_out を一時的に符号マスクとして使う
+    # subtract(where=) は分岐が多いと遅いので、0 か 167772.16 の配列を作って引く（v - 0 = v なので結果は同じ）
+    np.greater_equal(packed, GSI_NODATA, out=nodata_out)
+    offset = buf.f32
+    offset.fill(0)
+    np.copyto(offset, GSI_SIGN_OFFSET, where=nodata_out)
+    np.subtract(out, offset, out=out)
+    np.equal(packed, GSI_NODATA, out=nodata_out)
+    return out, nodata_out
+
+def height_m_to_terrarium_rgb(height_m: np.ndarray, nodata_mask: np.ndarray = None, out: np.ndarray = None,
+                              buf: TileBuffers = None) -> np.ndarray:
+    """
+    height(m) -> Terrarium PNG RGB (uint8)
+    Terrarium:
+      v = h + 32768
+      R = floor(v / 256)
+      G = floor(v) % 256
+      B = floor((v - floor(v)) * 256)
+    q = floor(v * 256) とすると R = q >> 16, G = (q >> 8) & 255, B = q & 255（整数演算だけで分解できる）
+    nodata は 0m (v=32768) に落とす（見た目の破綻を抑える）
+    """
+    shape = height_m.shape
+    if buf is None:
+        buf = TileBuffers(shape)
+    if out is None:
+        out = np.empty(shape + (3,), dtype=np.uint8)
+    v, q = buf.f32, buf.i32
+
+    np.copyto(v, height_m, casting="unsafe")   # 従来どおり float32 にしてから足す
+    np.add(v, TERRARIUM_OFFSET, out=v)
+    if nodata_mask is not None:
+        np.copyto(v, TERRARIUM_OFFSET, where=nodata_mask)
+    np.multiply(v, TERRARIUM_SCALE, out=v)   # 2の冪なので誤差なし
+    np.floor(v, out=v)
+    np.copyto(q, v, casting="unsafe")
+
+    np.bitwise_and(q, 0xFF, out=out[..., 2], casting="unsafe")
+    np.right_shift(q, 8, out=q)
+    np.bitwise_and(q, 0xFF, out=out[..., 1], casting="unsafe")
+    np.right_shift(q, 8, out=q)
+    # 範囲クリップ（安全策）
+    np.clip(q, 0, 255, out=q)
+    np.copyto(out[..., 0], q, casting="unsafe")
+    return out
+
+def terrarium_to_height_m(rgb: np.ndarray, out: np.ndarray = None, buf: TileBuffers = None) -> np.ndarray:
+    """
+    Terrarium RGB -> height in meters (float32)
+      h = (R*256 + G + B/256) - 32768
+    """
+    packed = pack_rgb24(rgb, buf)
+    if out is None:
+        out = np.empty(packed.shape, dtype=np.float32)
+    np.copyto(out, packed, casting="unsafe")
+    np.multiply(out, TERRARIUM_INV_SCALE, out=out)
+    np.subtract(out, TERRARIUM_OFFSET, out=out)
+    return out
+
+def height_m_to_gsi_rgb(height_m: np.ndarray, nodata_mask: np.ndarray = None, out: np.ndarray = None) -> np.ndarray:
+    """
+    height(m) -> GSI dem_png RGB (uint8)
+      v = round(h / 0.01)。負なら 2^24 を足す（24bit 2の補数）
+      R = v >> 16, G = (v >> 8) & 255, B = v & 255
+      nodata = (128,0,0)
+    """
+    if out is None:
+        out = np.empty(height_m.shape + (3,), dtype=np.uint8)
+    v = np.rint(height_m.astype(np.float64) * 100.0).astype(np.int64)
+    np.bitwise_and(v, 0xFFFFFF, out=v)   # 2の補数の下位24bit = 負なら +2^24
+
+    np.bitwise_and(v, 0xFF, out=out[..., 2], casting="unsafe")
+    np.right_shift(v, 8, out=v)
+    np.bitwise_and(v, 0xFF, out=out[..., 1], casting="unsafe")
+    np.right_shift(v, 8, out=v)
+    np.copyto(out[..., 0], v, casting="unsafe")
+    if nodata_mask is not None:
+        out[nodata_mask] = GSI_NODATA_RGB
+    return out
@@ -0,0 +1,204 @@
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import uniform_tiles
+from dem_codec import gsi_dem_to_height_m, terrarium_to_height_m
+
+# 1ズーム分（またはその一部の矩形）のタイルを1回だけ復号し、ディスク上の float32 標高配列（memmap）にまとめる。
+#   mosaic/z14.height.f32  : (rows*256, cols*256) float32 の標高（行優先。nodata は 0）
+#   mosaic/z14.nodata.u8   : 同じ形の nodata マスク（1 = nodata / タイル無し）
+#   mosaic/z14.present.npy : (rows, cols) のタイル有無
+#   mosaic/z14.json        : 範囲（x0, y0, cols, rows）・タイルサイズ・元データ
+# 以降の解析（継ぎ目・傾斜・地域統計・タイルの切り直し）は Mosaic で開いて、必要な窓をコピー無しで読む。
+# 配列はディスク上にあるので、RAM より大きい範囲も扱える。
+
+RAW_DIR = Path("raw_dem")           # GSI dem_png: raw_dem/{z}/{x}/{y}.png
+TERRA_DIR = Path("terrarium")       # Terrarium:  terrarium/{z}/{x}/{y}.png
+MOSAIC_DIR = Path("mosaic")
+
+Z = 14
+SOURCE = "raw"                      # raw（GSI dem_png）/ terrarium
+TILE_RANGE = None                   # (x_min, x_max, y_min, y_max)。None ならある分のタイル全体
+TILE_SIZE = 256
+
+WORKERS = os.cpu_count() or 1
+CHUNKSIZE = 64
+BAND_ROWS = 16                      # 統計を取るときに一度に読むタイル行数（メモリ上限）
+
+def mosaic_paths(z: int, mosaic_dir: Path = None):
+    d = Path(mosaic_dir or MOSAIC_DIR)
+    return d / f"z{z}.json", d / f"z{z}.height.f32", d / f"z{z}.nodata.u8", d / f"z{z}.present.npy"
+
+def source_dir(source: str) -> Path:
+    return {"raw": RAW_DIR, "terrarium": TERRA_DIR}[source]
+
+def rgb_to_height(rgb: np.ndarray, source: str):
+    if source == "raw":
+        return gsi_dem_to_height_m(rgb)
+    # Terrarium には nodata が無い（変換時に 0m にしている）
+    return terrarium_to_height_m(rgb), np.zeros(rgb.shape[:2], dtype=bool)
+
+def load_tile_height(path: Path, source: str):
+    """-> (標高, nodata)"""
+    data = path.read_bytes()
+    found = uniform_tiles.detect(data)
+    if found is not None:
+        # 一様タイル（海など）は PNG を復号せず、1画素だけ変換して広げる（全画素を変換したのと同じ値）
+        pixel, shape = found
+        h, nodata = rgb_to_height(np.array([[pixel]], dtype=np.uint8), source)
+        return np.full(shape, h[0, 0], dtype=h.dtype), np.full(shape, nodata[0, 0], dtype=bool)
+    return rgb_to_height(np.array(Image.open(io.BytesIO(data)).convert("RGB"), dtype=np.uint8), source)
+
+def scan_tiles(z: int, source: str):
+    """-> [(x, y)]（ファイルがあるタイル）"""
+    tiles = []
+    for p in (source_dir(source) / str(z)).glob("*/*.png"):
+        tiles.append((int(p.parent.name), int(p.stem)))
+    return tiles
+
+class Mosaic:
+    """build_mosaic で作ったモザイクを memmap で開く（読み取り専用が既定）"""
+
+    def __init__(self, z: int = Z, mosaic_dir: Path = None, mode: str = "r"):
+        meta_path, height_path, nodata_path, present_path = mosaic_paths(z, mosaic_dir)
+        self.meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        self.z = self.meta["z"]
+        self.x0, self.y0 = self.meta["x0"], self.meta["y0"]
+        self.cols, self.rows = self.meta["cols"], self.meta["rows"]
+        self.tile_size = self.meta["tile_size"]
+        shape = (self.rows * self.tile_size, self.cols * self.tile_size)
+        self.height = np.memmap(height_path, dtype=np.float32, mode=mode, shape=shape)
+        self.nodata = np.memmap(nodata_path, dtype=np.uint8, mode=mode, shape=shape)
+        self.present = np.load(present_path, mmap_mode=mode)
+
+    @property
+    def shape(self):
+        return self.height.shape
+
+    def has_tile(self, x: int, y: int) -> bool:
+        c, r = x - self.x0, y - self.y0
+        return 0 <= c < self.cols and 0 <= r < self.rows and bool(self.present[r, c])
+
+    def pixel_origin(self, x: int, y: int):
+        """タイル (x, y) の左上画素 (row, col)"""
+        return (y - self.y0) * self.tile_size, (x - self.x0) * self.tile_size
+
+    def offset(self, x: int, y: int) -> int:
+        """タイル (x, y) の左上画素の、height ファイル先頭からのバイトオフセット（nodata は要素オフセットと同じ）"""
+        r, c = self.pixel_origin(x, y)
+        return (r * self.shape[1] + c) * self.height.itemsize
+
+    def window(self, row: int, col: int, h: int, w: int):
+        """画素の矩形 -> (height, nodata) のビュー（コピーしない）"""
+        return self.height[row:row + h, col:col + w], self.nodata[row:row + h, col:col + w]
+
+    def tile(self, x: int, y: int):
+        """タイル (x, y) -> (height, nodata) のビュー"""
+        r, c = self.pixel_origin(x, y)
+        return self.window(r, c, self.tile_size, self.tile_size)
+
+    def iter_bands(self, band_rows: int = BAND_ROWS):
+        """タイル band_rows 行ずつの (行番号, height, nodata) ビュー（全体を読むときのメモリ上限）"""
+        step = band_rows * self.tile_size
+        for r in range(0, self.shape[0], step):
+            yield r, self.height[r:r + step], self.nodata[r:r + step]
+
+    def flush(self):
+        self.height.flush()
+        self.nodata.flush()
+
+def fill_chunk(task):
+    """ワーカー: (z, source, mosaic_dir, [(x, y)]) -> 書き込んだタイル数。各タイルは重ならない領域なので並列に書ける"""
+    z, source, mosaic_dir, tiles = task
+    m = Mosaic(z, mosaic_dir, mode="r+")
+    src = source_dir(source) / str(z)
+    try:
+        for x, y in tiles:
+            h, nodata = load_tile_height(src / str(x) / f"{y}.png", source)
+            th, tn = m.tile(x, y)
+            th[:] = np.where(nodata, 0.0, h)
+            tn[:] = nodata
+        m.flush()
+    finally:
+        del m
+    return len(tiles)
+
+def build_mosaic(z: int = Z, source: str = SOURCE, tile_range=None, mosaic_dir: Path = None,
+                 workers: int = WORKERS) -> Mosaic:
+    mosaic_dir = Path(mosaic_dir or MOSAIC_DIR)
+    tiles = scan_tiles(z, source)
+    if tile_range is None:
+        if not tiles:
+            raise ValueError(f"No tiles under {source_dir(source) / str(z)}")
+        xs, ys = [t[0] for t in tiles], [t[1] for t in tiles]
+        tile_range = (min(xs), max(xs), min(ys), max(ys))
+    x_min, x_max, y_min, y_max = tile_range
+    tiles = sorted((x, y) for x, y in tiles if x_min <= x <= x_max and y_min <= y <= y_max)
+    cols, rows = x_max - x_min + 1, y_max - y_min + 1
+
+    mosaic_dir.mkdir(parents=True, exist_ok=True)
+    meta_path, height_path, nodata_path, present_path = mosaic_paths(z, mosaic_dir)
+    meta = {"z": z, "x0": x_min, "y0": y_min, "cols": cols, "rows": rows, "tile_size": TILE_SIZE,
+            "source": source, "tiles": len(tiles)}
+
+    # ファイルを確保（0 で埋まった疎なファイル）。タイルの無い部分だけ nodata=1 にし、ある部分はワーカーが書く
+    shape = (rows * TILE_SIZE, cols * TILE_SIZE)
+    present = np.zeros((rows, cols), dtype=np.uint8)
+    for x, y in tiles:
+        present[y - y_min, x - x_min] = 1
+    np.memmap(height_path, dtype=np.float32, mode="w+", shape=shape).flush()
+    nodata = np.memmap(nodata_path, dtype=np.uint8, mode="w+", shape=shape)
+    for r, c in zip(*np.nonzero(present == 0)):
+        nodata[r * TILE_SIZE:(r + 1) * TILE_SIZE, c * TILE_SIZE:(c + 1) * TILE_SIZE] = 1
+    nodata.flush()
+    del nodata
+    np.save(present_path, present)
+    meta_path.write_text(json.dumps(meta, indent=2), encoding="utf-8")
+
+    chunks = [(z, source, str(mosaic_dir), tiles[i:i + CHUNKSIZE]) for i in range(0, len(tiles), CHUNKSIZE)]
+    workers = max(1, min(workers, len(chunks)))
+    if workers == 1:
+        for c in chunks:
+            fill_chunk(c)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(fill_chunk, chunks))
+    return Mosaic(z, mosaic_dir)
+
+def main():
+    if not (source_dir(SOURCE) / str(Z)).exists():
+        raise SystemExit(f"Input dir not found: {(source_dir(SOURCE) / str(Z)).resolve()}")
+
+    t0 = time.perf_counter()
+    m = build_mosaic(Z, SOURCE, TILE_RANGE)
+    dt = time.perf_counter() - t0
+
+    # 帯ごとに集計（全体を一度にメモリに載せない）
+    valid_px = 0
+    h_min, h_max = float("inf"), float("-inf")
+    for _, h, nd in m.iter_bands():
+        valid = nd == 0
+        if valid.any():
+            v = h[valid]
+            h_min, h_max = min(h_min, float(v.min())), max(h_max, float(v.max()))
+            valid_px += v.size
+
+    meta_path, height_path, _, _ = mosaic_paths(Z)
+    total_px = m.shape[0] * m.shape[1]
+    print(f"Mosaic z{Z} ({SOURCE}): tiles {m.meta['tiles']:,} in {m.cols}x{m.rows}  "
+          f"x={m.x0}..{m.x0 + m.cols - 1} y={m.y0}..{m.y0 + m.rows - 1}  ({dt:.1f}s)")
+    print(f"Pixels: {m.shape[1]}x{m.shape[0]}  valid={valid_px / total_px * 100:.2f}%")
+    if valid_px:
+        print(f"Height min/max (m): {h_min:.3f} .. {h_max:.3f}")
+    print(f"Height: {height_path.resolve()}  ({height_path.stat().st_size:,} bytes)")
+    print(f"Meta: {meta_path.resolve()}")
+
+if __name__ == "__main__":
+    main()
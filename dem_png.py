@@ -2,10 +2,14 @@ import math
 import os
 import time
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
+import perf_metrics
+from fetch_ledger import LEDGER_PATH, FetchLedger
+from task_stream import StopRequest, bounded_results
+
 # ===== 設定 =====
 BBOX_W, BBOX_S, BBOX_E, BBOX_N = (
     144.124997317805,
@@ -17,15 +21,25 @@ BBOX_W, BBOX_S, BBOX_E, BBOX_N = (
 Z_MIN = 8
 Z_MAX = 14
 
+# True: Z_MAX だけ取得し、下位ズームは build_overviews.py で縮小して作る（リクエスト数を約1/3削減）
+FETCH_MAX_ZOOM_ONLY = False
+FETCH_Z_MIN = Z_MAX if FETCH_MAX_ZOOM_ONLY else Z_MIN
+
 OUT_DIR = Path("raw_dem")   # raw_dem/{z}/{x}/{y}.png
 BASE_URL = "https://cyberjapandata.gsi.go.jp/xyz/dem_png/{z}/{x}/{y}.png"
 
 MAX_WORKERS = 8            # 429が出るなら 4～6へ
+IN_FLIGHT = MAX_WORKERS * 4   # 投入中のタスク数の上限（タスクは生成しながら投入するので、全体の一覧はメモリに作らない）
 TIMEOUT_SEC = 30
 RETRIES = 5
 BACKOFF_BASE = 1.6         # リトライ待ちの指数バックオフ
 SLEEP_BETWEEN_REQ = 0.0    # サーバに優しくしたいなら 0.05 とか
 
+# 取得状態の記録（fetch_state.sqlite）
+USE_LEDGER = True          # 404/失敗/ETag を記録し、既知の404は再リクエストしない
+REFRESH = False            # True: 取得済みタイルも条件付きGETで更新確認（304なら据え置き）
+RETRY_FAILED_ONLY = False  # True: 前回までに失敗したタイルだけ再試行
+
 # ===== タイル計算（XYZ）=====
 def lon2tilex(lon: float, z: int) -> int:
     return int(math.floor((lon + 180.0) / 360.0 * (2 ** z)))
@@ -43,10 +57,18 @@ def tile_range_for_bbox(w, s, e, n, z):
     y_max = lat2tiley(s, z)
     return x_min, x_max, y_min, y_max
 
+def iter_tiles(w=BBOX_W, s=BBOX_S, e=BBOX_E, n=BBOX_N, z_min=FETCH_Z_MIN, z_max=Z_MAX):
+    """bbox の (z, x, y) を順に生成する"""
+    for z in range(z_min, z_max + 1):
+        x_min, x_max, y_min, y_max = tile_range_for_bbox(w, s, e, n, z)
+        for x in range(x_min, x_max + 1):
+            for y in range(y_min, y_max + 1):
+                yield z, x, y
+
 def estimate_counts():
     total = 0
     per_z = {}
-    for z in range(Z_MIN, Z_MAX + 1):
+    for z in range(FETCH_Z_MIN, Z_MAX + 1):
         x_min, x_max, y_min, y_max = tile_range_for_bbox(BBOX_W, BBOX_S, BBOX_E, BBOX_N, z)
         nx = x_max - x_min + 1
         ny = y_max - y_min + 1
@@ -56,87 +78,136 @@ def estimate_counts():
     return per_z, total
 
 # ===== ダウンロード =====
-def download_one(session: requests.Session, z: int, x: int, y: int):
+def download_one(session: requests.Session, z: int, x: int, y: int, ledger: FetchLedger = None):
     url = BASE_URL.format(z=z, x=x, y=y)
     out_path = OUT_DIR / str(z) / str(x) / f"{y}.png"
     out_path.parent.mkdir(parents=True, exist_ok=True)
 
-    if out_path.exists() and out_path.stat().st_size > 0:
+    have_file = out_path.exists() and out_path.stat().st_size > 0
+    if have_file and not REFRESH:
         return "skip", z, x, y
 
+    row = ledger.get(z, x, y) if ledger else None
+    if ledger and ledger.is_known_404(row):
+        return "cached404", z, x, y
+    headers = FetchLedger.conditional_headers(row) if have_file else {}
+
+    def finish(status, r=None):
+        if ledger and status not in ("skip", "cached404"):
+            etag = r.headers.get("ETag") if r is not None else None
+            last_modified = r.headers.get("Last-Modified") if r is not None else None
+            ledger.record(z, x, y, "ok" if status == "notmod" else status, etag, last_modified)
+        return status, z, x, y
+
     for i in range(RETRIES):
         try:
             if SLEEP_BETWEEN_REQ > 0:
                 time.sleep(SLEEP_BETWEEN_REQ)
 
-            r = session.get(url, timeout=TIMEOUT_SEC)
+            with perf_metrics.timer("http"):
+                r = session.get(url, timeout=TIMEOUT_SEC, headers=headers)
+            perf_metrics.count("requests")
             if r.status_code == 200:
-                out_path.write_bytes(r.content)
-                return "ok", z, x, y
+                with perf_metrics.timer("write"):
+                    out_path.write_bytes(r.content)
+                perf_metrics.count("bytes_in", len(r.content))
+                return finish("ok", r)
+
+            # 条件付きGET: 手元のファイルが最新
+            if r.status_code == 304:
+                return finish("notmod", r)
 
             # 404は「そのタイルにデータが無い」可能性もあるので保存せずスキップ
             if r.status_code == 404:
-                return "404", z, x, y
+                return finish("404", r)
 
             # 429/5xx はリトライ
             if r.status_code in (429, 500, 502, 503, 504):
                 wait = (BACKOFF_BASE ** i) + (0.05 * i)
-                time.sleep(wait)
+                with perf_metrics.timer("backoff"):
+                    time.sleep(wait)
                 continue
 
-            return f"HTTP{r.status_code}", z, x, y
+            return finish(f"HTTP{r.status_code}", r)
 
         except (requests.Timeout, requests.ConnectionError):
+            perf_metrics.count("conn_errors")
             wait = (BACKOFF_BASE ** i) + (0.05 * i)
-            time.sleep(wait)
+            with perf_metrics.timer("backoff"):
+                time.sleep(wait)
             continue
 
-    return "fail", z, x, y
+    return finish("fail")
 
-def run_download():
-    tasks = []
-    for z in range(Z_MIN, Z_MAX + 1):
-        x_min, x_max, y_min, y_max = tile_range_for_bbox(BBOX_W, BBOX_S, BBOX_E, BBOX_N, z)
-        for x in range(x_min, x_max + 1):
-            for y in range(y_min, y_max + 1):
-                tasks.append((z, x, y))
+def run_download(tiles=None):
+    """tiles: (z, x, y) の列（run_job.py の計画など）。None なら BBOX_* / ズーム設定から作る"""
+    ledger = FetchLedger(LEDGER_PATH) if USE_LEDGER else None
+
+    # タスクは生成しながら投入する（総数が分かるときだけ進捗に出す）
+    if tiles is not None:
+        tasks, total = tiles, len(tiles) if hasattr(tiles, "__len__") else None
+    elif RETRY_FAILED_ONLY and ledger:
+        tasks = list(ledger.iter_failed())
+        total = len(tasks)
+    else:
+        tasks, total = iter_tiles(), estimate_counts()[1]
 
-    print(f"Download tasks: {len(tasks):,} tiles")
+    print(f"Download tasks: {f'{total:,}' if total is not None else '(streamed)'} tiles")
 
-    ok = skip = nf = fail = other = 0
+    ok = skip = nf = cached = notmod = fail = other = 0
+    idx = 0
     t0 = time.time()
 
-    with requests.Session() as session:
-        # 軽いUA（弾かれにくくする）
-        session.headers.update({"User-Agent": "offline-dem-fetch/1.0"})
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
-            futures = [ex.submit(download_one, session, z, x, y) for (z, x, y) in tasks]
-            for idx, f in enumerate(as_completed(futures), 1):
-                status, z, x, y = f.result()
-                if status == "ok":
-                    ok += 1
-                elif status == "skip":
-                    skip += 1
-                elif status == "404":
-                    nf += 1
-                elif status == "fail":
-                    fail += 1
-                else:
-                    other += 1
-
-                if idx % 500 == 0 or idx == len(tasks):
-                    dt = time.time() - t0
-                    print(
-                        f"[{idx:,}/{len(tasks):,}] ok={ok:,} skip={skip:,} 404={nf:,} fail={fail:,} other={other:,}  ({dt:.1f}s)"
-                    )
-
-    print("Done.")
-    print(f"ok={ok:,}, skip={skip:,}, 404={nf:,}, fail={fail:,}, other={other:,}")
+    try:
+        with StopRequest() as stop, perf_metrics.stage("fetch"), requests.Session() as session:
+            # 軽いUA（弾かれにくくする）
+            session.headers.update({"User-Agent": "offline-dem-fetch/1.0"})
+
+            def fetch(t):
+                return download_one(session, *t, ledger)
+
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+                for idx, (status, z, x, y) in enumerate(bounded_results(ex, fetch, tasks, IN_FLIGHT, stop), 1):
+                    perf_metrics.count(f"status_{status}")
+                    if status == "ok":
+                        ok += 1
+                    elif status == "skip":
+                        skip += 1
+                    elif status == "404":
+                        nf += 1
+                    elif status == "cached404":
+                        cached += 1
+                    elif status == "notmod":
+                        notmod += 1
+                    elif status == "fail":
+                        fail += 1
+                    else:
+                        other += 1
+
+                    if idx % 500 == 0 or idx == total:
+                        dt = time.time() - t0
+                        progress = f"{idx:,}/{total:,}" if total is not None else f"{idx:,}"
+                        print(
+                            f"[{progress}] ok={ok:,} skip={skip:,} 404={nf:,} cached404={cached:,} "
+                            f"notmod={notmod:,} fail={fail:,} other={other:,}  ({dt:.1f}s)"
+                        )
+    finally:
+        if ledger:
+            ledger.close()
+
+    if not stop.requested:
+        print("Done.")
+    print(
+        f"ok={ok:,}, skip={skip:,}, 404={nf:,}, cached404={cached:,}, notmod={notmod:,}, "
+        f"fail={fail:,}, other={other:,}"
+    )
+    # 取得済みのファイルと台帳は残っているので、再実行すれば続きから（取得済みは skip）
+    stop.exit_if_requested(f"download stopped after {idx:,} tiles (rerun to resume)")
 
 if __name__ == "__main__":
     per_z, total = estimate_counts()
     print("=== Tile count estimate (XYZ) ===")
-    for z in range(Z_MIN, Z_MAX + 1):
+    for z in range(FETCH_Z_MIN, Z_MAX + 1):
         nx, ny, cnt = per_z[z]
         print(f"z{z}: {nx} x {ny} = {cnt:,}")
     print(f"TOTAL: {total:,} tiles\n")
@@ -0,0 +1,235 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import perf_metrics
+from dem_png import (
+    BACKOFF_BASE, BASE_URL, FETCH_Z_MIN, OUT_DIR, REFRESH, RETRIES, RETRY_FAILED_ONLY, TIMEOUT_SEC, USE_LEDGER,
+    Z_MAX, estimate_counts, iter_tiles,
+)
+from fetch_ledger import LEDGER_PATH, FetchLedger
+from task_stream import StopRequest
+
+# dem_png.py の非同期版。
+#   - タスクは tile_range_for_bbox から遅延生成（bboxが大きくてもメモリが増えない）
+#   - トークンバケットで平均リクエスト数/秒を制限
+#   - 同時実行数を AIMD で調整（429/5xx/通信エラーで半減、成功が続けば +1）
+#   - バックオフは asyncio.sleep（他のリクエストを止めない）
+# HTTP は requests の keep-alive 接続プール（pool_maxsize=MAX_CONCURRENCY）をスレッド経由で使う。
+
+# ===== 設定 =====
+MAX_CONCURRENCY = 32       # 同時リクエストの上限（= 接続プールの大きさ）
+MIN_CONCURRENCY = 2
+START_CONCURRENCY = 8
+RATE_PER_SEC = 50.0        # 平均リクエスト数/秒（トークンバケット）
+BURST = 20                 # バケット容量
+DECREASE_COOLDOWN = 1.0    # 連続した 429 で一気に下げすぎないための間隔（秒）
+PROGRESS_EVERY = 500
+
+THROTTLE_STATUS = (429, 500, 502, 503, 504)
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.t = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.t) * self.rate)
+            self.t = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return
+            await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+class AIMDLimiter:
+    """同時実行数の上限を AIMD（加算増加・乗算減少）で調整する"""
+
+    def __init__(self, start: int, lo: int, hi: int):
+        self.limit = start
+        self.lo = lo
+        self.hi = hi
+        self.inflight = 0
+        self.successes = 0
+        self.last_decrease = 0.0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.inflight < self.limit)
+            self.inflight += 1
+
+    async def release(self):
+        async with self.cond:
+            self.inflight -= 1
+            self.cond.notify_all()
+
+    def on_success(self):
+        # 現在の上限ぶん成功が続いたら +1（おおよそ1往復ごとに1増える）
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.hi:
+            self.limit += 1
+            self.successes = 0
+
+    def on_throttle(self):
+        now = time.monotonic()
+        if now - self.last_decrease < DECREASE_COOLDOWN:
+            return
+        self.limit = max(self.lo, self.limit // 2)
+        self.successes = 0
+        self.last_decrease = now
+
+def make_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    # 軽いUA（弾かれにくくする）
+    session.headers.update({"User-Agent": "offline-dem-fetch/1.0"})
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def fetch_to_file(session: requests.Session, url: str, out_path: Path, headers: dict):
+    # スレッド側で実行: 1回だけGETし、200なら保存して (status, ETag, Last-Modified) を返す
+    with perf_metrics.timer("http"):
+        r = session.get(url, timeout=TIMEOUT_SEC, headers=headers)
+    perf_metrics.count("requests")
+    if r.status_code == 200:
+        with perf_metrics.timer("write"):
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            out_path.write_bytes(r.content)
+        perf_metrics.count("bytes_in", len(r.content))
+    return r.status_code, r.headers.get("ETag"), r.headers.get("Last-Modified")
+
+class AsyncDownloader:
+    def __init__(self, out_dir: Path = OUT_DIR, base_url: str = BASE_URL,
+                 max_concurrency: int = MAX_CONCURRENCY, rate_per_sec: float = RATE_PER_SEC,
+                 ledger: FetchLedger = None, refresh: bool = REFRESH, stop: StopRequest = None):
+        self.out_dir = Path(out_dir)
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.rate_per_sec = rate_per_sec
+        self.ledger = ledger
+        self.refresh = refresh
+        self.stop = stop            # Ctrl-C で立つ。各ワーカーは実行中のタイルを終えてから止まる
+        self.counts = {"ok": 0, "skip": 0, "404": 0, "cached404": 0, "notmod": 0, "fail": 0, "other": 0}
+        self.done = 0
+
+    async def download_one(self, z: int, x: int, y: int) -> str:
+        out_path = self.out_dir / str(z) / str(x) / f"{y}.png"
+        have_file = out_path.exists() and out_path.stat().st_size > 0
+        if have_file and not self.refresh:
+            return "skip"
+
+        row = self.ledger.get(z, x, y) if self.ledger else None
+        if self.ledger and self.ledger.is_known_404(row):
+            return "cached404"
+        headers = FetchLedger.conditional_headers(row) if have_file else {}
+
+        url = self.base_url.format(z=z, x=x, y=y)
+        loop = asyncio.get_running_loop()
+        etag = last_modified = None
+        for i in range(RETRIES):
+            with perf_metrics.timer("wait_limiter"):
+                await self.limiter.acquire()
+            perf_metrics.gauge("inflight", self.limiter.inflight)
+            try:
+                with perf_metrics.timer("wait_rate"):
+                    await self.bucket.acquire()
+                status, etag, last_modified = await loop.run_in_executor(
+                    self.executor, fetch_to_file, self.session, url, out_path, headers
+                )
+            except (requests.Timeout, requests.ConnectionError):
+                status = None
+            finally:
+                await self.limiter.release()
+
+            # 200 / 304（手元が最新） / 404（データ無し）は成功扱い
+            if status in (200, 304, 404):
+                self.limiter.on_success()
+                result = {200: "ok", 304: "notmod", 404: "404"}[status]
+                break
+            # 429/5xx/通信エラーは同時実行数を下げてリトライ
+            if status is None or status in THROTTLE_STATUS:
+                self.limiter.on_throttle()
+                await asyncio.sleep((BACKOFF_BASE ** i) + (0.05 * i))
+                continue
+            result = f"HTTP{status}"
+            break
+        else:
+            result = "fail"
+
+        if self.ledger:
+            self.ledger.record(z, x, y, "ok" if result == "notmod" else result, etag, last_modified)
+        return result
+
+    async def worker(self, tiles):
+        # tiles は全ワーカーで共有するジェネレータ（イベントループは単一スレッドなので next() は安全）
+        for z, x, y in tiles:
+            if self.stop is not None and self.stop.requested:
+                return
+            status = await self.download_one(z, x, y)
+            perf_metrics.count(f"status_{status}")
+            self.counts[status if status in self.counts else "other"] += 1
+            self.done += 1
+            if self.done % PROGRESS_EVERY == 0:
+                self.report()
+
+    def report(self):
+        c = self.counts
+        dt = time.time() - self.t0
+        print(
+            f"[{self.done:,}] ok={c['ok']:,} skip={c['skip']:,} 404={c['404']:,} cached404={c['cached404']:,} "
+            f"notmod={c['notmod']:,} fail={c['fail']:,} other={c['other']:,}  "
+            f"limit={self.limiter.limit}  ({dt:.1f}s)"
+        )
+
+    async def run(self, tiles=None):
+        tiles = iter(tiles if tiles is not None else iter_tiles())
+        self.t0 = time.time()
+        self.bucket = TokenBucket(self.rate_per_sec, BURST)
+        self.limiter = AIMDLimiter(min(START_CONCURRENCY, self.max_concurrency),
+                                   min(MIN_CONCURRENCY, self.max_concurrency), self.max_concurrency)
+        self.session = make_session(self.max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            await asyncio.gather(*(self.worker(tiles) for _ in range(self.max_concurrency)))
+        finally:
+            self.executor.shutdown(wait=True)
+            self.session.close()
+        if self.done % PROGRESS_EVERY:
+            self.report()
+        return self.counts
+
+def run_download_async(tiles=None, **kwargs):
+    ledger = None
+    if "ledger" not in kwargs and USE_LEDGER:
+        ledger = kwargs["ledger"] = FetchLedger(LEDGER_PATH)
+        if tiles is None and RETRY_FAILED_ONLY:
+            tiles = ledger.iter_failed()
+    try:
+        with StopRequest() as stop, perf_metrics.stage("fetch"):
+            counts = asyncio.run(AsyncDownloader(stop=stop, **kwargs).run(tiles))
+    finally:
+        if ledger:
+            ledger.close()
+    stop.exit_if_requested(f"download stopped after {sum(counts.values()):,} tiles (rerun to resume)")
+    return counts
+
+if __name__ == "__main__":
+    per_z, total = estimate_counts()
+    print("=== Tile count estimate (XYZ) ===")
+    for z in range(FETCH_Z_MIN, Z_MAX + 1):
+        nx, ny, cnt = per_z[z]
+        print(f"z{z}: {nx} x {ny} = {cnt:,}")
+    print(f"TOTAL: {total:,} tiles\n")
+
+    counts = run_download_async()
+    print("Done.")
+    print(", ".join(f"{k}={v:,}" for k, v in counts.items()))
@@ -0,0 +1,95 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# z/x/y ごとの取得結果を SQLite に残す（プロセス終了後も 404 や失敗を覚えておく）
+#   - 404 は NOT_FOUND_TTL_SEC の間は再リクエストしない（海・範囲外タイル）
+#   - fail / HTTPxxx だけを再試行できる
+#   - ETag / Last-Modified を保存し、更新確認は条件付きGET（304なら再ダウンロードしない）
+
+LEDGER_PATH = Path("fetch_state.sqlite")
+NOT_FOUND_TTL_SEC = 30 * 24 * 3600   # 404 を信じる期間（30日）
+COMMIT_EVERY = 200
+
+class FetchLedger:
+    def __init__(self, path: Path = LEDGER_PATH, not_found_ttl: float = NOT_FOUND_TTL_SEC):
+        self.path = Path(path)
+        self.not_found_ttl = not_found_ttl
+        # ダウンロードスレッドから共有するので1接続 + ロック
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+
+        CREATE TABLE IF NOT EXISTS fetch (
+            z INTEGER,
+            x INTEGER,
+            y INTEGER,
+            status TEXT,            -- ok / 404 / fail / HTTPxxx
+            etag TEXT,
+            last_modified TEXT,
+            updated_at REAL,
+            retries INTEGER,        -- 連続して失敗した実行回数（成功で0に戻る）
+            PRIMARY KEY (z, x, y)
+        ) WITHOUT ROWID;
+        """)
+
+    def get(self, z: int, x: int, y: int):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status, etag, last_modified, updated_at, retries FROM fetch WHERE z=? AND x=? AND y=?",
+                (z, x, y),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("status", "etag", "last_modified", "updated_at", "retries"), row))
+
+    def is_known_404(self, row) -> bool:
+        return bool(row) and row["status"] == "404" and time.time() - row["updated_at"] < self.not_found_ttl
+
+    @staticmethod
+    def conditional_headers(row) -> dict:
+        headers = {}
+        if row and row.get("etag"):
+            headers["If-None-Match"] = row["etag"]
+        if row and row.get("last_modified"):
+            headers["If-Modified-Since"] = row["last_modified"]
+        return headers
+
+    def record(self, z: int, x: int, y: int, status: str, etag: str = None, last_modified: str = None):
+        failed = status not in ("ok", "404")
+        with self.lock:
+            # ETag/Last-Modified は新しい値が無ければ（304など）前回の値を残す
+            self.conn.execute(
+                """
+                INSERT INTO fetch(z, x, y, status, etag, last_modified, updated_at, retries)
+                VALUES(?,?,?,?,?,?,?,?)
+                ON CONFLICT(z, x, y) DO UPDATE SET
+                    status = excluded.status,
+                    etag = COALESCE(excluded.etag, fetch.etag),
+                    last_modified = COALESCE(excluded.last_modified, fetch.last_modified),
+                    updated_at = excluded.updated_at,
+                    retries = CASE WHEN excluded.retries > 0 THEN fetch.retries + 1 ELSE 0 END
+                """,
+                (z, x, y, status, etag, last_modified, time.time(), 1 if failed else 0),
+            )
+            self.pending += 1
+            if self.pending >= COMMIT_EVERY:
+                self.conn.commit()
+                self.pending = 0
+
+    def iter_failed(self):
+        """前回までに失敗したタイル（404以外のエラー）だけを列挙"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT z, x, y FROM fetch WHERE status NOT IN ('ok', '404') ORDER BY z, x, y"
+            ).fetchall()
+        yield from rows
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,270 @@
+import bisect
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import perf_metrics
+import uniform_tiles
+from check_seams import TileCache
+from dem_codec import height_m_to_gsi_rgb
+from dem_mosaic import load_tile_height
+from task_stream import StopRequest, bounded_results, ignore_sigint
+from tile_encoder import save_image
+
+# GSI dem_png の nodata の穴を、周りの標高から補間して埋める（Terrarium 変換で 0m に平らにされないように）
+#   raw_dem/{z}/{x}/{y}.png -> raw_filled/{z}/{x}/{y}.png（GSI dem_png のまま。埋めた画素以外はそのまま）
+#   - 各 nodata 画素から左右上下に最も近い有効画素を探し（累積 max で一括）、距離の逆数で重み付け平均する
+#   - 左右（または上下）の有効画素の間隔が MAX_GAP_PX 以下の「挟まれた穴」だけ埋める。海のような広い nodata は残す
+#   - 隣のタイルの端 MAX_GAP_PX 画素も文脈に入れるので、タイルの端にかかる穴も隣から埋まる
+#   - WIN_TILES x WIN_TILES タイルを1枚の配列に並べてまとめて計算する（タイルごとのループにしない）
+#   - 行の帯（WIN_TILES 行）ごとにワーカーに分け、帯の中は左から順に処理する。復号したタイルは LRU キャッシュに置き、
+#     帯の外（上下の行）のタイルは端の MAX_GAP_PX 行だけ持つ
+# 埋めた後に to_terrarium.py の IN_DIR を raw_filled にして変換する
+
+IN_DIR = Path("raw_dem")            # GSI dem_png: raw_dem/{z}/{x}/{y}.png
+OUT_DIR = Path("raw_filled")
+REPORT_PATH = Path("fill_report.json")   # タイル別の穴埋め率（None なら書かない）
+
+MAX_GAP_PX = 16                     # これより幅の広い nodata は埋めない（隣のタイルから読む幅も同じ）
+WIN_TILES = 4                       # 一度に並べて計算するタイル数（一辺）
+TILE_SIZE = 256
+ENCODE_MODE = "fast"                # 中間データなので速さ優先（tile_encoder.py。どのモードもロスレス）
+TOP_N = 5                           # 穴埋め率の高いタイルを表示する数
+
+CACHE_TILES = 64                    # 復号済みタイルの LRU（(WIN_TILES + 2) x 2 列分あれば再復号しない）
+WORKERS = os.cpu_count() or 1
+
+def nearest_valid(h: np.ndarray, valid: np.ndarray, axis: int, reverse: bool):
+    """各画素から axis 方向（reverse なら逆向き）に見て最も近い有効画素 -> (距離, 標高)。無ければ距離 inf"""
+    if axis == 0:
+        d, v = nearest_valid(h.T, valid.T, 1, reverse)
+        return d.T, v.T
+    if reverse:
+        d, v = nearest_valid(h[:, ::-1], valid[:, ::-1], 1, False)
+        return d[:, ::-1], v[:, ::-1]
+    cols = np.arange(h.shape[1], dtype=np.int32)
+    idx = np.where(valid, cols, -1).astype(np.int32)
+    np.maximum.accumulate(idx, axis=1, out=idx)
+    dist = np.where(idx >= 0, (cols - idx).astype(np.float32), np.float32(np.inf))
+    value = np.take_along_axis(h, np.maximum(idx, 0), axis=1)
+    return dist, value
+
+def fill_gaps(h: np.ndarray, nodata: np.ndarray, max_gap: int = MAX_GAP_PX):
+    """
+    (H, W) の標高と nodata -> (埋めた標高, 埋めた画素のマスク)
+    左右の有効画素の間隔が max_gap 以下なら左右から、上下も同様。両方なら4方向の逆距離加重平均
+    """
+    filled = np.zeros(nodata.shape, dtype=bool)
+    if not nodata.any() or nodata.all():
+        return h, filled
+    valid = ~nodata
+    num = np.zeros(h.shape, dtype=np.float64)
+    den = np.zeros(h.shape, dtype=np.float64)
+    for axis in (1, 0):
+        d0, v0 = nearest_valid(h, valid, axis, False)
+        d1, v1 = nearest_valid(h, valid, axis, True)
+        enclosed = nodata & (d0 + d1 - 1 <= max_gap)
+        for d, v in ((d0, v0), (d1, v1)):
+            w = np.divide(1.0, d, out=np.zeros(h.shape, dtype=np.float64), where=enclosed)
+            num += w * v
+            den += w
+        filled |= enclosed
+    out = h.copy()
+    out[filled] = (num[filled] / den[filled]).astype(h.dtype)
+    return out, filled
+
+def tile_loader(z: int, margin: int):
+    """キー (x, y) は復号したタイル全体、(x, y, "top"/"bottom") は端の margin 行だけ -> (height, nodata, 先頭の行)"""
+    z_dir = IN_DIR / str(z)
+
+    def load(key):
+        with perf_metrics.timer("load"):
+            h, nodata = load_tile_height(z_dir / str(key[0]) / f"{key[1]}.png", "raw")
+        if len(key) == 2:
+            return h, nodata, 0
+        if key[2] == "top":
+            return h[:margin].copy(), nodata[:margin].copy(), 0
+        return h[-margin:].copy(), nodata[-margin:].copy(), h.shape[0] - margin
+
+    return load
+
+def build_canvas(cache: TileCache, present: set, x0: int, x1: int, y0: int, y1: int, margin: int):
+    """タイル x0..x1, y0..y1 を並べ、周りに隣のタイルの端 margin 画素を付けた (標高, nodata)。タイルの無い所は nodata"""
+    t = TILE_SIZE
+    shape = ((y1 - y0 + 1) * t + 2 * margin, (x1 - x0 + 1) * t + 2 * margin)
+    h = np.zeros(shape, dtype=np.float32)
+    nodata = np.ones(shape, dtype=bool)
+    for ty in range(y0 - 1, y1 + 2):
+        for tx in range(x0 - 1, x1 + 2):
+            if (tx, ty) not in present:
+                continue
+            if ty < y0:
+                key = (tx, ty, "bottom")
+            elif ty > y1:
+                key = (tx, ty, "top")
+            else:
+                key = (tx, ty)
+            th, tn, row = cache.get(key)
+            r0 = (ty - y0) * t + margin + row
+            c0 = (tx - x0) * t + margin
+            # キャンバスに入る部分だけ切り出す
+            rs, re = max(r0, 0), min(r0 + th.shape[0], shape[0])
+            cs, ce = max(c0, 0), min(c0 + th.shape[1], shape[1])
+            if rs >= re or cs >= ce:
+                continue
+            h[rs:re, cs:ce] = th[rs - r0:re - r0, cs - c0:ce - c0]
+            nodata[rs:re, cs:ce] = tn[rs - r0:re - r0, cs - c0:ce - c0]
+    return h, nodata
+
+def write_tile(z: int, x: int, y: int, height: np.ndarray, filled: np.ndarray):
+    """埋めた画素だけ GSI RGB に置き換えて書く（それ以外の画素は元の RGB のまま）。埋めていなければコピー"""
+    rel = f"{z}/{x}/{y}.png"
+    out_path = OUT_DIR / rel
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    if not filled.any():
+        shutil.copyfile(IN_DIR / rel, out_path)
+        return
+    rgb = np.array(Image.open(IN_DIR / rel).convert("RGB"), dtype=np.uint8)
+    rgb[filled] = height_m_to_gsi_rgb(height[filled])
+    tmp = out_path.with_name(out_path.name + ".tmp")
+    save_image(tmp, rgb, ENCODE_MODE)
+    os.replace(tmp, out_path)
+
+def fill_strip(task):
+    """ワーカー: (z, y0, y1, present) -> ([(rel, nodata画素, 埋めた画素)], 復号数, 計測値, 見つけた一様タイル)"""
+    z, y0, y1, present = task
+    t, m = TILE_SIZE, MAX_GAP_PX
+    cache = TileCache(tile_loader(z, m), CACHE_TILES)
+    xs = sorted({x for x, y in present if y0 <= y <= y1})
+    records = []
+    i = 0
+    while i < len(xs):
+        # 窓は x0..x0+WIN_TILES-1（x は疎なこともあるので、次の窓は x1 より右の最初のタイルから）
+        x0 = xs[i]
+        x1 = x0 + WIN_TILES - 1
+        i = bisect.bisect_right(xs, x1)
+        with perf_metrics.timer("canvas"):
+            h, nodata = build_canvas(cache, present, x0, x1, y0, y1, m)
+        inner = (slice(m, h.shape[0] - m), slice(m, h.shape[1] - m))
+        if nodata[inner].any():
+            with perf_metrics.timer("fill"):
+                h, filled = fill_gaps(h, nodata, m)
+        else:
+            filled = np.zeros(nodata.shape, dtype=bool)
+        for y in range(y0, y1 + 1):
+            for x in range(x0, x1 + 1):
+                if (x, y) not in present:
+                    continue
+                r, c = (y - y0) * t + m, (x - x0) * t + m
+                tile = (slice(r, r + t), slice(c, c + t))
+                with perf_metrics.timer("write"):
+                    write_tile(z, x, y, h[tile], filled[tile])
+                records.append((f"{z}/{x}/{y}.png", int(np.count_nonzero(nodata[tile])),
+                                int(np.count_nonzero(filled[tile]))))
+    perf_metrics.count("tiles", len(records))
+    perf_metrics.count("decoded", cache.misses)
+    return records, cache.misses, perf_metrics.take(), uniform_tiles.take_learned()
+
+def iter_tasks(z: int):
+    """帯ごとのタスクを順に作る（持つのはこのズームのタイル座標の行ごとの一覧だけ）"""
+    rows = {}
+    for p in (IN_DIR / str(z)).glob("*/*.png"):
+        rows.setdefault(int(p.stem), []).append(int(p.parent.name))
+    if not rows:
+        return
+    ys = sorted(rows)
+    for y0 in range(ys[0], ys[-1] + 1, WIN_TILES):
+        y1 = y0 + WIN_TILES - 1
+        if not any(y in rows for y in range(y0, y1 + 1)):
+            continue
+        # 帯の行と上下1行のタイルだけ渡す
+        present = {(x, y) for y in range(y0 - 1, y1 + 2) for x in rows.get(y, ())}
+        yield z, y0, y1, present
+
+class FillSummary:
+    """ズームごとの合計と、nodata のあったタイルだけの一覧（穴の無いタイルは数えるだけ）"""
+
+    def __init__(self):
+        self.by_zoom = {}       # z -> [タイル数, nodata のあるタイル数, nodata 画素, 埋めた画素]
+        self.holes = []         # [(rel, nodata 画素, 埋めた画素)]
+        self.decoded = 0
+
+    def add(self, result):
+        records, decoded, snap, learned = result
+        perf_metrics.merge(snap)
+        uniform_tiles.remember(learned)
+        self.decoded += decoded
+        for rel, nodata_px, filled_px in records:
+            s = self.by_zoom.setdefault(int(rel.split("/")[0]), [0, 0, 0, 0])
+            s[0] += 1
+            s[1] += nodata_px > 0
+            s[2] += nodata_px
+            s[3] += filled_px
+            if nodata_px:
+                self.holes.append((rel, nodata_px, filled_px))
+
+    @property
+    def tiles(self) -> int:
+        return sum(s[0] for s in self.by_zoom.values())
+
+def run_fill(zooms, workers: int = WORKERS, stop: StopRequest = None) -> FillSummary:
+    tasks = (t for z in zooms for t in iter_tasks(z))
+    summary = FillSummary()
+    if workers <= 1:
+        for result in bounded_results(None, fill_strip, tasks, 1, stop):
+            summary.add(result)
+        return summary
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=ignore_sigint) as ex:
+        for result in bounded_results(ex, fill_strip, tasks, workers * 2, stop):
+            summary.add(result)
+    return summary
+
+@perf_metrics.stage("fill")
+def main():
+    if not IN_DIR.exists():
+        raise SystemExit(f"Input dir not found: {IN_DIR.resolve()}")
+    zooms = sorted(int(p.name) for p in IN_DIR.iterdir() if p.is_dir() and p.name.isdigit())
+
+    t0 = time.perf_counter()
+    with StopRequest() as stop:
+        try:
+            summary = run_fill(zooms, stop=stop)
+        finally:
+            uniform_tiles.save()
+    dt = time.perf_counter() - t0
+    holes = sorted(summary.holes, key=lambda r: tuple(int(v) for v in r[0][:-4].split("/")))
+
+    print(f"Tiles: {summary.tiles:,}  decoded {summary.decoded:,}  ({dt:.1f}s)")
+    print(f"{'z':>3} {'tiles':>7} {'w/nodata':>9} {'nodata px':>11} {'filled px':>11} {'filled':>8}")
+    for z, (tiles, with_nodata, nodata_px, filled_px) in sorted(summary.by_zoom.items()):
+        ratio = f"{filled_px / nodata_px * 100:>7.2f}%" if nodata_px else f"{'-':>8}"
+        print(f"{z:>3} {tiles:>7,} {with_nodata:>9,} {nodata_px:>11,} {filled_px:>11,} {ratio}")
+
+    print(f"\n--- Tiles by fill ratio (top {TOP_N}) ---")
+    for rel, nodata_px, filled_px in sorted(holes, key=lambda r: (-r[2] / r[1], r[0]))[:TOP_N]:
+        print(f"{rel}  nodata={nodata_px:,}  filled={filled_px:,}  ({filled_px / nodata_px * 100:.2f}%)")
+
+    if REPORT_PATH is not None:
+        report = {
+            "generated_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "max_gap_px": MAX_GAP_PX,
+            "interrupted": stop.requested,
+            "tiles": [{"tile": rel, "nodata_px": nodata_px, "filled_px": filled_px,
+                       "fill_ratio": filled_px / nodata_px} for rel, nodata_px, filled_px in holes],
+        }
+        REPORT_PATH.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"Report: {REPORT_PATH.resolve()}")
+    print(f"Output dir: {OUT_DIR.resolve()}")
+    # 書き終えたタイルはそのまま残る（途中の帯は未出力）
+    stop.exit_if_requested(f"filled {summary.tiles:,} tiles before stopping (rerun to redo)")
+
+if __name__ == "__main__":
+    main()
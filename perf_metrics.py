@@ -0,0 +1,256 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from pathlib import Path
+
+# 各ステージ（取得・変換・MBTiles・検証）の計測
+#   - タイマー（区間ごとの回数・合計・最大）、カウンタ（タイル数・バイト数）、ゲージ（キューの深さなど。最後の値と最大）
+#   - ステージの最後に、合計時間の多い順に表示し、JSON Lines（1ステージ1行）/ Prometheus のテキスト形式に書き出す
+#   - ワーカープロセスの計測値は take() でチャンクごとに持ち帰り、親で merge() する
+#   - PROFILE で cProfile / tracemalloc をステージ全体にかける（親プロセスのメインスレッドのみ。
+#     ワーカーの中まで見るときは WORKERS = 1 で実行する）
+
+ENABLED = True                  # False なら timer/count/gauge は何もしない（表示・書き出しもしない）
+PROFILE = None                  # None / "cprofile" / "tracemalloc"
+PROFILE_DIR = Path("perf_profiles")     # cProfile の .prof（snakeviz などで見る）
+PROFILE_TOP = 15                # 表示する関数・行の数
+
+EXPORT_PATH = Path("perf_metrics.jsonl")   # ステージごとに1行追記（None なら書かない）
+PROM_DIR = None                 # Path を入れると {stage}.prom を書く（node_exporter の textfile collector 用）
+PROM_PREFIX = "dem_pipeline"
+
+class Metrics:
+    """タイマー・カウンタ・ゲージ。スレッドから呼んでよい（ロックで守る）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}        # name -> [回数, 合計秒, 最大秒]
+            self.counters = {}      # name -> 値
+            self.gauges = {}        # name -> [最後の値, 最大]
+
+    def add_time(self, name: str, dt: float, n: int = 1):
+        with self.lock:
+            t = self.timers.get(name)
+            if t is None:
+                self.timers[name] = [n, dt, dt]
+            else:
+                t[0] += n
+                t[1] += dt
+                if dt > t[2]:
+                    t[2] = dt
+
+    def count(self, name: str, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name: str, value):
+        with self.lock:
+            g = self.gauges.get(name)
+            if g is None:
+                self.gauges[name] = [value, value]
+            else:
+                g[0] = value
+                if value > g[1]:
+                    g[1] = value
+
+    def snapshot(self) -> dict:
+        """pickle できる形（ワーカーから返す）"""
+        with self.lock:
+            return {
+                "timers": {k: list(v) for k, v in self.timers.items()},
+                "counters": dict(self.counters),
+                "gauges": {k: list(v) for k, v in self.gauges.items()},
+            }
+
+    def merge(self, snap: dict):
+        with self.lock:
+            for k, (n, total, mx) in snap["timers"].items():
+                t = self.timers.get(k)
+                if t is None:
+                    self.timers[k] = [n, total, mx]
+                else:
+                    t[0] += n
+                    t[1] += total
+                    t[2] = max(t[2], mx)
+            for k, v in snap["counters"].items():
+                self.counters[k] = self.counters.get(k, 0) + v
+            for k, (last, mx) in snap["gauges"].items():
+                g = self.gauges.get(k)
+                self.gauges[k] = [last, mx if g is None else max(g[1], mx)]
+
+    def to_dict(self) -> dict:
+        snap = self.snapshot()
+        return {
+            "timers": {k: {"count": n, "total_s": round(total, 6), "mean_ms": round(total / n * 1000, 4) if n else None,
+                           "max_ms": round(mx * 1000, 4)}
+                       for k, (n, total, mx) in sorted(snap["timers"].items(), key=lambda kv: -kv[1][1])},
+            "counters": snap["counters"],
+            "gauges": {k: {"last": last, "max": mx} for k, (last, mx) in snap["gauges"].items()},
+        }
+
+class Timer:
+    __slots__ = ("metrics", "name", "t0")
+
+    def __init__(self, metrics: Metrics, name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.name, time.perf_counter() - self.t0)
+        return False
+
+# プロセスごとに1つ（ワーカーでも親でも同じ名前で呼ぶ）
+METRICS = Metrics()
+NULL_TIMER = nullcontext()
+
+def reset_after_fork():
+    # fork したワーカーは親の途中までの計測値を引き継ぐので空にする（ロックも作り直す）
+    METRICS.lock = threading.Lock()
+    METRICS.reset()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+def timer(name: str):
+    return Timer(METRICS, name) if ENABLED else NULL_TIMER
+
+def count(name: str, n=1):
+    if ENABLED:
+        METRICS.count(name, n)
+
+def gauge(name: str, value):
+    if ENABLED:
+        METRICS.gauge(name, value)
+
+def take():
+    """ワーカー側: ここまでの計測値を返して空にする（None なら計測していない）"""
+    if not ENABLED:
+        return None
+    snap = METRICS.snapshot()
+    METRICS.reset()
+    return snap
+
+def merge(snap):
+    """親側: take() の結果を足す"""
+    if snap is not None:
+        METRICS.merge(snap)
+
+# ===== 書き出し =====
+def prom_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+def to_prometheus(stage: str, d: dict) -> str:
+    s = prom_label(stage)
+    lines = [
+        f"# HELP {PROM_PREFIX}_step_seconds_total Time spent in each step.",
+        f"# TYPE {PROM_PREFIX}_step_seconds_total counter",
+    ]
+    lines += [f'{PROM_PREFIX}_step_seconds_total{{stage="{s}",step="{prom_label(k)}"}} {v["total_s"]}'
+              for k, v in d["timers"].items()]
+    lines += [f"# HELP {PROM_PREFIX}_step_calls_total Number of timed calls of each step.",
+              f"# TYPE {PROM_PREFIX}_step_calls_total counter"]
+    lines += [f'{PROM_PREFIX}_step_calls_total{{stage="{s}",step="{prom_label(k)}"}} {v["count"]}'
+              for k, v in d["timers"].items()]
+    lines += [f"# HELP {PROM_PREFIX}_events_total Counters (tiles, bytes).",
+              f"# TYPE {PROM_PREFIX}_events_total counter"]
+    lines += [f'{PROM_PREFIX}_events_total{{stage="{s}",name="{prom_label(k)}"}} {v}'
+              for k, v in d["counters"].items()]
+    lines += [f"# HELP {PROM_PREFIX}_gauge_max Maximum of gauges (queue depth etc.).",
+              f"# TYPE {PROM_PREFIX}_gauge_max gauge"]
+    lines += [f'{PROM_PREFIX}_gauge_max{{stage="{s}",name="{prom_label(k)}"}} {v["max"]}'
+              for k, v in d["gauges"].items()]
+    return "\n".join(lines) + "\n"
+
+def export(stage: str, d: dict):
+    if EXPORT_PATH is not None:
+        rec = {"ts": datetime.now(timezone.utc).isoformat(timespec="seconds"), "stage": stage, "pid": os.getpid(), **d}
+        with open(EXPORT_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    if PROM_DIR is not None:
+        # textfile collector が書きかけを読まないように置き換える
+        PROM_DIR.mkdir(parents=True, exist_ok=True)
+        path = PROM_DIR / f"{stage}.prom"
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(to_prometheus(stage, d), encoding="utf-8")
+        os.replace(tmp, path)
+
+def print_summary(stage: str, d: dict, wall: float):
+    print(f"\n--- Perf: {stage} ({wall:.2f}s wall) ---")
+    if d["timers"]:
+        print(f"{'step':<16} {'calls':>9} {'total s':>9} {'mean ms':>9} {'max ms':>9}")
+        for k, v in d["timers"].items():
+            print(f"{k:<16} {v['count']:>9,} {v['total_s']:>9.3f} {v['mean_ms'] or 0:>9.3f} {v['max_ms']:>9.3f}")
+    if d["counters"]:
+        print("  ".join(f"{k}={v:,}" for k, v in d["counters"].items()))
+    if d["gauges"]:
+        print("  ".join(f"{k}(max)={v['max']:,}" for k, v in d["gauges"].items()))
+
+# ===== プロファイル =====
+def start_profile():
+    if PROFILE == "cprofile":
+        prof = cProfile.Profile()
+        prof.enable()
+        return prof
+    if PROFILE == "tracemalloc":
+        tracemalloc.start()
+        return "tracemalloc"
+    if PROFILE is not None:
+        raise ValueError(f"Unknown PROFILE: {PROFILE!r} (None / 'cprofile' / 'tracemalloc')")
+    return None
+
+def stop_profile(prof, stage: str):
+    if isinstance(prof, cProfile.Profile):
+        prof.disable()
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        path = PROFILE_DIR / f"{stage}.prof"
+        prof.dump_stats(str(path))
+        out = io.StringIO()
+        pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        print(f"\n--- cProfile: {stage} (top {PROFILE_TOP} by cumulative) -> {path} ---")
+        print(out.getvalue().strip())
+    elif prof == "tracemalloc":
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        gauge("tracemalloc_peak_bytes", peak)
+        print(f"\n--- tracemalloc: {stage} (peak {peak / 1024 / 1024:.1f} MiB, top {PROFILE_TOP} lines) ---")
+        for s in snapshot.statistics("lineno")[:PROFILE_TOP]:
+            print(s)
+
+@contextmanager
+def stage(name: str):
+    """
+    ステージ全体を囲む: 計測値を空にしてから始め、終わったら（失敗しても）表示・書き出しする
+        with perf_metrics.stage("terrarium"):
+            ...
+    """
+    if not ENABLED:
+        yield
+        return
+    METRICS.reset()
+    prof = start_profile()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - t0
+        stop_profile(prof, name)
+        d = METRICS.to_dict()
+        d["wall_s"] = round(wall, 6)
+        print_summary(name, d, wall)
+        export(name, d)
@@ -0,0 +1,427 @@
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+# PMTiles v3 の最小限の読み書き（外部の `pmtiles convert` を使わずに書き出す）
+# 仕様: https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+
+# ===== 入出力（単体実行時: MBTiles -> PMTiles）=====
+IN_MB = Path("dem_terrarium_z8-14.mbtiles")
+OUT_PM = Path("dem_terrarium_z8-14.pmtiles")
+
+HEADER_LEN = 127
+ROOT_DIR_MAX = 16384 - HEADER_LEN   # ヘッダ + ルートディレクトリは先頭16KiBに収める
+
+# Compression
+COMPRESSION_NONE = 1
+COMPRESSION_GZIP = 2
+
+# TileType
+TILETYPE_UNKNOWN = 0
+TILETYPE_PNG = 2
+TILETYPE_JPEG = 3
+TILETYPE_WEBP = 4
+
+TILETYPE_BY_FORMAT = {"png": TILETYPE_PNG, "jpg": TILETYPE_JPEG, "jpeg": TILETYPE_JPEG, "webp": TILETYPE_WEBP}
+
+_HEADER_STRUCT = struct.Struct("<7sB11Q6B4iB2i")
+
+DIR_CACHE = 64                      # PMTilesReader が展開済みで持つディレクトリ数（ルート + リーフ）
+
+# ===== Hilbert TileID =====
+def zxy_to_tileid(z: int, x: int, y: int) -> int:
+    """z/x/y -> PMTiles TileID（ズームごとの累積数 + Hilbert曲線上の位置）"""
+    if x >= (1 << z) or y >= (1 << z):
+        raise ValueError(f"Tile out of range: {z}/{x}/{y}")
+    acc = ((1 << (2 * z)) - 1) // 3
+    for a in range(z - 1, -1, -1):
+        s = 1 << a
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        acc += ((3 * rx) ^ ry) << (2 * a)
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+    return acc
+
+def tileid_to_zxy(tile_id: int):
+    """PMTiles TileID -> (z, x, y)"""
+    acc = 0
+    for z in range(32):
+        num = 1 << (2 * z)
+        if tile_id < acc + num:
+            t = tile_id - acc
+            x = y = 0
+            s = 1
+            while s < (1 << z):
+                rx = 1 & (t // 2)
+                ry = 1 & (t ^ rx)
+                if ry == 0:
+                    if rx == 1:
+                        x = s - 1 - x
+                        y = s - 1 - y
+                    x, y = y, x
+                x += s * rx
+                y += s * ry
+                t //= 4
+                s *= 2
+            return z, x, y
+        acc += num
+    raise ValueError(f"TileID out of range: {tile_id}")
+
+# ===== varint / ディレクトリ =====
+def write_varint(buf: bytearray, v: int):
+    while v >= 0x80:
+        buf.append((v & 0x7F) | 0x80)
+        v >>= 7
+    buf.append(v)
+
+def read_varint(data: bytes, pos: int):
+    v = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        v |= (b & 0x7F) << shift
+        if b < 0x80:
+            return v, pos
+        shift += 7
+
+def serialize_directory(entries) -> bytes:
+    """entries: [(tile_id, offset, length, run_length)] -> gzip圧縮済みディレクトリ"""
+    buf = bytearray()
+    write_varint(buf, len(entries))
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        write_varint(buf, tile_id - last_id)
+        last_id = tile_id
+    for _, _, _, run_length in entries:
+        write_varint(buf, run_length)
+    for _, _, length, _ in entries:
+        write_varint(buf, length)
+    for i, (_, offset, _, _) in enumerate(entries):
+        prev = entries[i - 1] if i > 0 else None
+        if prev is not None and offset == prev[1] + prev[2]:
+            write_varint(buf, 0)   # 直前の続き
+        else:
+            write_varint(buf, offset + 1)
+    return gzip.compress(bytes(buf), mtime=0)
+
+def deserialize_directory(data: bytes):
+    data = gzip.decompress(data)
+    n, pos = read_varint(data, 0)
+    ids, runs, lengths, offsets = [], [], [], []
+    last_id = 0
+    for _ in range(n):
+        d, pos = read_varint(data, pos)
+        last_id += d
+        ids.append(last_id)
+    for _ in range(n):
+        v, pos = read_varint(data, pos)
+        runs.append(v)
+    for _ in range(n):
+        v, pos = read_varint(data, pos)
+        lengths.append(v)
+    for i in range(n):
+        v, pos = read_varint(data, pos)
+        if v == 0 and i > 0:
+            offsets.append(offsets[i - 1] + lengths[i - 1])
+        else:
+            offsets.append(v - 1)
+    return list(zip(ids, offsets, lengths, runs))
+
+def build_directories(entries):
+    """
+    ルートが ROOT_DIR_MAX に収まらなければリーフディレクトリに分割する。
+    -> (root_bytes, leaves_bytes)
+    """
+    root = serialize_directory(entries)
+    if len(root) <= ROOT_DIR_MAX:
+        return root, b""
+
+    leaf_size = 4096
+    while True:
+        root_entries = []
+        leaves = bytearray()
+        for i in range(0, len(entries), leaf_size):
+            chunk = entries[i:i + leaf_size]
+            leaf = serialize_directory(chunk)
+            # run_length=0 はリーフディレクトリへの参照
+            root_entries.append((chunk[0][0], len(leaves), len(leaf), 0))
+            leaves += leaf
+        root = serialize_directory(root_entries)
+        if len(root) <= ROOT_DIR_MAX:
+            return root, bytes(leaves)
+        leaf_size = int(leaf_size * 1.2)
+
+# ===== ヘッダ =====
+def serialize_header(h: dict) -> bytes:
+    return _HEADER_STRUCT.pack(
+        b"PMTiles", 3,
+        h["root_offset"], h["root_length"],
+        h["metadata_offset"], h["metadata_length"],
+        h["leaf_directory_offset"], h["leaf_directory_length"],
+        h["tile_data_offset"], h["tile_data_length"],
+        h["addressed_tiles_count"], h["tile_entries_count"], h["tile_contents_count"],
+        1 if h["clustered"] else 0,
+        h["internal_compression"], h["tile_compression"], h["tile_type"],
+        h["min_zoom"], h["max_zoom"],
+        h["min_lon_e7"], h["min_lat_e7"], h["max_lon_e7"], h["max_lat_e7"],
+        h["center_zoom"], h["center_lon_e7"], h["center_lat_e7"],
+    )
+
+def deserialize_header(data: bytes) -> dict:
+    v = _HEADER_STRUCT.unpack(data[:HEADER_LEN])
+    if v[0] != b"PMTiles" or v[1] != 3:
+        raise ValueError("Not a PMTiles v3 archive")
+    keys = (
+        "root_offset", "root_length", "metadata_offset", "metadata_length",
+        "leaf_directory_offset", "leaf_directory_length", "tile_data_offset", "tile_data_length",
+        "addressed_tiles_count", "tile_entries_count", "tile_contents_count",
+        "clustered", "internal_compression", "tile_compression", "tile_type", "min_zoom", "max_zoom",
+        "min_lon_e7", "min_lat_e7", "max_lon_e7", "max_lat_e7", "center_zoom", "center_lon_e7", "center_lat_e7",
+    )
+    h = dict(zip(keys, v[2:]))
+    h["clustered"] = bool(h["clustered"])
+    return h
+
+# ===== Writer =====
+class PMTilesWriter:
+    """
+    タイルを順不同で受け取り、finalize() で PMTiles v3 を書き出す。
+      - タイル本体はいったん一時ファイルへ追記（同一内容はハッシュで1回だけ）
+      - finalize() で TileID 順に並べ替え、クラスタ化したタイルデータとして書き出す
+      - 連続する TileID が同じ内容を指す場合は run_length でまとめる（RLE）
+    """
+
+    def __init__(self, path: Path, tile_type: int = TILETYPE_PNG):
+        self.path = Path(path)
+        self.tile_type = tile_type
+        self.tmp_path = self.path.with_name(self.path.name + ".tiles.tmp")
+        self.tmp = open(self.tmp_path, "w+b")
+        self.tmp_size = 0
+        self.entries = {}     # tile_id -> (tmp_offset, length)
+        self.by_hash = {}     # md5 -> (tmp_offset, length)
+        self.min_zoom = 255
+        self.max_zoom = 0
+
+    def write_tile(self, z: int, x: int, y: int, data: bytes):
+        key = hashlib.md5(data).digest()
+        loc = self.by_hash.get(key)
+        if loc is None:
+            loc = (self.tmp_size, len(data))
+            self.tmp.write(data)
+            self.tmp_size += len(data)
+            self.by_hash[key] = loc
+        self.entries[zxy_to_tileid(z, x, y)] = loc
+        self.min_zoom = min(self.min_zoom, z)
+        self.max_zoom = max(self.max_zoom, z)
+
+    def finalize(self, metadata: dict, bounds=None, center=None):
+        """
+        metadata: JSONにしてgzipで格納する
+        bounds: (w, s, e, n)。省略時は metadata["bounds"]（"w,s,e,n"）
+        center: (lon, lat, zoom)。省略時は metadata["center"]（"lon,lat,zoom"）、それも無ければ bounds の中心 / min_zoom
+        """
+        if not self.entries:
+            raise ValueError("No tiles written")
+        self.tmp.flush()
+
+        # TileID順に並べ、内容は最初に現れた順で配置（= クラスタ化）
+        final_offset = {}    # tmp_offset -> 出力側 offset
+        order = []           # 出力順の (tmp_offset, length)
+        data_len = 0
+        dir_entries = []
+        for tile_id in sorted(self.entries):
+            tmp_off, length = self.entries[tile_id]
+            off = final_offset.get(tmp_off)
+            if off is None:
+                off = data_len
+                final_offset[tmp_off] = off
+                order.append((tmp_off, length))
+                data_len += length
+            last = dir_entries[-1] if dir_entries else None
+            if last and last[1] == off and last[0] + last[3] == tile_id:
+                dir_entries[-1] = (last[0], last[1], last[2], last[3] + 1)
+            else:
+                dir_entries.append((tile_id, off, length, 1))
+
+        root, leaves = build_directories(dir_entries)
+        meta = gzip.compress(json.dumps(metadata, ensure_ascii=False).encode("utf-8"), mtime=0)
+
+        if bounds is None:
+            bounds = [float(v) for v in metadata["bounds"].split(",")]
+        w, s, e, n = bounds
+        if center is None and metadata.get("center"):
+            center = [float(v) for v in metadata["center"].split(",")]
+        if center is None:
+            center = ((w + e) / 2, (s + n) / 2, self.min_zoom)
+
+        header = {
+            "root_offset": HEADER_LEN,
+            "root_length": len(root),
+            "metadata_offset": HEADER_LEN + len(root),
+            "metadata_length": len(meta),
+            "leaf_directory_offset": HEADER_LEN + len(root) + len(meta),
+            "leaf_directory_length": len(leaves),
+            "tile_data_offset": HEADER_LEN + len(root) + len(meta) + len(leaves),
+            "tile_data_length": data_len,
+            "addressed_tiles_count": len(self.entries),
+            "tile_entries_count": len(dir_entries),
+            "tile_contents_count": len(order),
+            "clustered": True,
+            "internal_compression": COMPRESSION_GZIP,
+            "tile_compression": COMPRESSION_NONE,   # PNG/WebPはそれ自体が圧縮済み
+            "tile_type": self.tile_type,
+            "min_zoom": self.min_zoom,
+            "max_zoom": self.max_zoom,
+            "min_lon_e7": round(w * 1e7),
+            "min_lat_e7": round(s * 1e7),
+            "max_lon_e7": round(e * 1e7),
+            "max_lat_e7": round(n * 1e7),
+            "center_zoom": int(center[2]),
+            "center_lon_e7": round(center[0] * 1e7),
+            "center_lat_e7": round(center[1] * 1e7),
+        }
+
+        with open(self.path, "wb") as f:
+            f.write(serialize_header(header))
+            f.write(root)
+            f.write(meta)
+            f.write(leaves)
+            for tmp_off, length in order:
+                self.tmp.seek(tmp_off)
+                f.write(self.tmp.read(length))
+
+        self.close()
+        return header
+
+    def close(self):
+        if not self.tmp.closed:
+            self.tmp.close()
+        if self.tmp_path.exists():
+            self.tmp_path.unlink()
+
+# ===== Reader =====
+def find_tile(entries, tile_id: int):
+    lo, hi = 0, len(entries) - 1
+    while lo <= hi:
+        mid = (lo + hi) >> 1
+        c = tile_id - entries[mid][0]
+        if c > 0:
+            lo = mid + 1
+        elif c < 0:
+            hi = mid - 1
+        else:
+            return entries[mid]
+    # 直前のエントリが run_length の範囲に含むか、リーフディレクトリなら返す
+    if hi >= 0:
+        e = entries[hi]
+        if e[3] == 0 or tile_id - e[0] < e[3]:
+            return e
+    return None
+
+class PMTilesReader:
+    """ファイルへのレンジ読み出しだけでタイルを引く"""
+
+    def __init__(self, path: Path, dir_cache: int = DIR_CACHE):
+        self.path = Path(path)
+        self.f = open(self.path, "rb")
+        self.lock = threading.Lock()
+        self.header = deserialize_header(self.read(0, HEADER_LEN))
+        # 展開済みディレクトリの LRU（タイルごとに gzip 展開し直さない）
+        self.dir_cache = OrderedDict()
+        self.dir_cache_size = dir_cache
+
+    def read(self, offset: int, length: int) -> bytes:
+        with self.lock:
+            self.f.seek(offset)
+            return self.f.read(length)
+
+    def directory(self, offset: int, length: int):
+        key = (offset, length)
+        with self.lock:
+            entries = self.dir_cache.get(key)
+            if entries is not None:
+                self.dir_cache.move_to_end(key)
+                return entries
+        entries = deserialize_directory(self.read(offset, length))
+        with self.lock:
+            self.dir_cache[key] = entries
+            if len(self.dir_cache) > self.dir_cache_size:
+                self.dir_cache.popitem(last=False)
+        return entries
+
+    def metadata(self) -> dict:
+        h = self.header
+        return json.loads(gzip.decompress(self.read(h["metadata_offset"], h["metadata_length"])))
+
+    def get_tile(self, z: int, x: int, y: int):
+        h = self.header
+        tile_id = zxy_to_tileid(z, x, y)
+        dir_offset, dir_length = h["root_offset"], h["root_length"]
+        for _ in range(4):   # ルート + リーフは仕様上たかだか数段
+            e = find_tile(self.directory(dir_offset, dir_length), tile_id)
+            if e is None:
+                return None
+            if e[3] > 0:
+                return self.read(h["tile_data_offset"] + e[1], e[2])
+            dir_offset = h["leaf_directory_offset"] + e[1]
+            dir_length = e[2]
+        return None
+
+    def iter_entries(self, dir_offset=None, dir_length=None):
+        """全タイルを (tile_id, offset, length) で列挙（RLEは展開する）"""
+        h = self.header
+        if dir_offset is None:
+            dir_offset, dir_length = h["root_offset"], h["root_length"]
+        for tile_id, offset, length, run_length in deserialize_directory(self.read(dir_offset, dir_length)):
+            if run_length == 0:
+                yield from self.iter_entries(h["leaf_directory_offset"] + offset, length)
+            else:
+                for i in range(run_length):
+                    yield tile_id + i, offset, length
+
+    def close(self):
+        self.f.close()
+
+# ===== MBTiles -> PMTiles =====
+def convert_mbtiles(in_mb: Path, out_pm: Path) -> dict:
+    conn = sqlite3.connect(str(in_mb))
+    try:
+        metadata = dict(conn.execute("SELECT name, value FROM metadata"))
+        writer = PMTilesWriter(out_pm, TILETYPE_BY_FORMAT.get(metadata.get("format", ""), TILETYPE_UNKNOWN))
+        try:
+            for z, x, tile_row, data in conn.execute(
+                "SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles"
+            ):
+                # MBTilesはTMS（y反転）
+                writer.write_tile(z, x, (1 << z) - 1 - tile_row, bytes(data))
+            return writer.finalize(metadata)
+        finally:
+            writer.close()
+    finally:
+        conn.close()
+
+def main():
+    if not IN_MB.exists():
+        raise SystemExit(f"MBTiles not found: {IN_MB.resolve()}")
+
+    h = convert_mbtiles(IN_MB, OUT_PM)
+
+    print(f"PMTiles written: {OUT_PM.resolve()}")
+    print(f"# of addressed tiles: {h['addressed_tiles_count']}")
+    print(f"# of tile entries (after RLE): {h['tile_entries_count']}")
+    print(f"# of tile contents: {h['tile_contents_count']}")
+    print(f"Total dir bytes: {h['root_length'] + h['leaf_directory_length']}")
+    print(f"File size: {os.path.getsize(OUT_PM):,} bytes")
+
+if __name__ == "__main__":
+    main()
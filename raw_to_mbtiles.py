@@ -0,0 +1,273 @@
+import functools
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import perf_metrics
+import uniform_tiles
+from pmtiles_io import TILETYPE_BY_FORMAT, PMTilesWriter
+from task_stream import StopRequest, bounded_results, iter_chunks, iter_tile_files
+from tile_encoder import FORMAT_BY_MODE
+from tileset_stats import TilesetStats, coverage_path
+from to_terrarium import RoundTripError, encode_tile_stats, init_worker, seed_uniform_blobs
+from terrarium_to_mbtiles import (
+    BULK_LOAD, MAXZOOM, MINZOOM, apply_bulk_pragmas, build_metadata, count_images, ensure_schema,
+    finish_bulk_load, insert_tiles, write_metadata, xyz_y_to_tms_y,
+)
+
+# raw_dem/{z}/{x}/{y}.png -> Terrarium -> MBTiles / PMTiles を1段で行う。
+# terrarium/ ディレクトリにタイルごとのPNGを書かない（小さいファイル大量のI/O・inode消費を避ける）
+
+# ===== 入出力 =====
+IN_DIR = Path("raw_dem")                   # raw_dem/{z}/{x}/{y}.png
+OUT_MB = Path("dem_terrarium_z8-14.mbtiles")    # None なら MBTiles を書かない
+OUT_PM = Path("dem_terrarium_z8-14.pmtiles")    # None なら PMTiles を書かない
+
+# ===== 並列・バッチ設定 =====
+WORKERS = os.cpu_count() or 1   # エンコード用プロセス数
+CHUNKSIZE = 64                  # 1タスクでワーカーに渡すタイル数
+QUEUE_SIZE = 4096               # ライタースレッドへのキュー上限（タイル数）
+BATCH_SIZE = 1000               # executemany + commit の単位
+PROGRESS_EVERY = 1000
+
+# タイルのエンコード（tile_encoder.py）: "max" / "fast" / "webp"（webp なら format=webp で書く）
+ENCODE_MODE = "max"
+
+def parse_rel(rel: str):
+    # z/x/y.png
+    parts = rel.split("/")
+    if len(parts) != 3:
+        raise ValueError(f"Unexpected path: {rel}")
+    return int(parts[0]), int(parts[1]), int(parts[2].replace(".png", ""))
+
+def encode_chunk(rels, mode: str = ENCODE_MODE, in_dir: Path = IN_DIR):
+    """
+    ワーカー: 相対パスのリスト -> ([(z, x, y, terrarium_tile_bytes, 標高min, 標高max)], 計測値, 見つけた一様タイル)
+    入力ディレクトリとモードは親から渡す（spawn のワーカーは親で書き換えたモジュール変数を見ない）
+    """
+    out = []
+    for rel in rels:
+        z, x, y = parse_rel(rel)
+        with perf_metrics.timer("read"):
+            raw = (in_dir / rel).read_bytes()
+        try:
+            data, (hmin, hmax, _) = encode_tile_stats(raw, mode)
+        except RoundTripError as e:
+            raise RoundTripError(f"{rel}: {e}") from None
+        out.append((z, x, y, data, hmin, hmax))
+    perf_metrics.count("tiles", len(rels))
+    return out, perf_metrics.take(), uniform_tiles.take_learned()
+
+def iter_rels():
+    """MINZOOM..MAXZOOM の入力タイルの相対パスを順に（一覧を作らない）"""
+    for p in iter_tile_files(IN_DIR):
+        rel = p.relative_to(IN_DIR).as_posix()
+        if MINZOOM <= parse_rel(rel)[0] <= MAXZOOM:
+            yield rel
+
+class TileWriter(threading.Thread):
+    """
+    キューから受け取ったタイルを書く単一ライター
+      - MBTiles: BATCH_SIZE ごとに executemany + commit
+      - PMTiles: PMTilesWriter に渡し、最後に finalize
+      - キュー待ち（queue_wait）・書き込み・commit・finalize の時間を perf_metrics に足す
+      - 書いたタイルの座標・標高から metadata（bounds/zoom/center/タイル数/標高範囲）を作って最後に書く
+      - aborted が立っていれば終端を受け取っても metadata / finalize をせずに終わる（出力は呼び出し側で消す）
+    """
+
+    def __init__(self, mb_path: Path, pm_path: Path, metadata: dict, q: queue.Queue):
+        super().__init__(daemon=True)
+        self.mb_path = mb_path
+        self.pm_path = pm_path
+        self.metadata = metadata
+        self.q = q
+        self.inserted = 0
+        self.unique = 0
+        self.stats = TilesetStats()
+        self.error = None
+        self.got_sentinel = False
+        self.aborted = False
+
+    def run(self):
+        conn = sqlite3.connect(str(self.mb_path)) if self.mb_path else None
+        tile_type = TILETYPE_BY_FORMAT[self.metadata["format"]]
+        pm = PMTilesWriter(self.pm_path, tile_type) if self.pm_path else None
+        try:
+            cur = conn.cursor() if conn else None
+            if cur and BULK_LOAD:
+                apply_bulk_pragmas(cur)
+            batch = []
+            while True:
+                # ライターが待っている時間（長ければエンコード側が遅い）
+                with perf_metrics.timer("queue_wait"):
+                    item = self.q.get()
+                if item is not None:
+                    z, x, y, data, hmin, hmax = item
+                    self.stats.add(z, x, y, hmin, hmax)
+                    if pm:
+                        with perf_metrics.timer("pmtiles_write"):
+                            pm.write_tile(z, x, y, data)
+                    if not cur:
+                        self.inserted += 1
+                        continue
+                    batch.append((z, x, xyz_y_to_tms_y(z, y), data))
+                if batch and (item is None or len(batch) >= BATCH_SIZE):
+                    with perf_metrics.timer("insert"):
+                        insert_tiles(cur, batch)
+                    with perf_metrics.timer("commit"):
+                        conn.commit()
+                    self.inserted += len(batch)
+                    batch = []
+                if item is None:
+                    self.got_sentinel = True
+                    break
+            if self.aborted:
+                return
+            self.metadata = self.stats.to_metadata(self.metadata)
+            if cur:
+                write_metadata(cur, self.metadata)
+                conn.commit()
+                with perf_metrics.timer("finalize"):
+                    if BULK_LOAD:
+                        finish_bulk_load(conn)
+                    else:
+                        cur.execute("ANALYZE;")
+                        conn.commit()
+                self.unique = count_images(cur)
+            if pm and self.inserted:
+                with perf_metrics.timer("pmtiles_finalize"):
+                    pm.finalize(self.metadata)
+        except Exception as e:
+            self.error = e
+            # 生産側がブロックしないようにキューを捨てる（終端を受け取った後の失敗なら捨てるものは無い）
+            if not self.got_sentinel:
+                while self.q.get() is not None:
+                    pass
+        finally:
+            if conn:
+                conn.close()
+            if pm:
+                pm.close()
+
+def remove_outputs():
+    """失敗・中断したビルドの出力を消す（完成して見える MBTiles / PMTiles と、前回のサイドカーを残さない）"""
+    for path in (OUT_MB, OUT_PM):
+        if path:
+            path.unlink(missing_ok=True)
+            coverage_path(path).unlink(missing_ok=True)
+
+@perf_metrics.stage("raw_to_mbtiles")
+def main():
+    if not IN_DIR.exists():
+        raise SystemExit(f"Input dir not found: {IN_DIR.resolve()}")
+
+    if next(iter_rels(), None) is None:
+        raise SystemExit("No input PNG tiles found under raw_dem/")
+
+    if not OUT_MB and not OUT_PM:
+        raise SystemExit("Set OUT_MB and/or OUT_PM")
+
+    metadata = build_metadata()
+    metadata["format"] = FORMAT_BY_MODE[ENCODE_MODE]
+    if OUT_MB:
+        if OUT_MB.exists():
+            OUT_MB.unlink()
+        conn = sqlite3.connect(str(OUT_MB))
+        try:
+            cur = conn.cursor()
+            ensure_schema(cur, bulk=BULK_LOAD)
+            write_metadata(cur, metadata)
+            conn.commit()
+        finally:
+            conn.close()
+
+    workers = max(1, WORKERS)
+    outputs = ", ".join(str(p) for p in (OUT_MB, OUT_PM) if p)
+    print(f"Streaming tiles -> {outputs} (workers={workers}, chunksize={CHUNKSIZE}, encode={ENCODE_MODE})")
+
+    q = queue.Queue(maxsize=QUEUE_SIZE)
+    writer = TileWriter(OUT_MB, OUT_PM, metadata, q)
+    writer.start()
+
+    done = 0
+    t0 = time.perf_counter()
+
+    def put_results(result):
+        nonlocal done
+        tiles, snap, learned = result
+        perf_metrics.merge(snap)
+        uniform_tiles.remember(learned)
+        for t in tiles:
+            if writer.error:
+                return
+            perf_metrics.gauge("queue_depth", q.qsize())
+            # キューが一杯ならライターが追いつくまで待つ（背圧。長ければ書き込み側が遅い）
+            with perf_metrics.timer("queue_put"):
+                q.put(t)
+            done += 1
+            if done % PROGRESS_EVERY == 0:
+                dt = time.perf_counter() - t0
+                print(f"[{done:,}] {done / dt if dt > 0 else 0.0:,.1f} tiles/s  ({dt:.1f}s)")
+
+    # 入力は辿りながらチャンクにし、投入中のチャンクは workers*2 個までにしてメモリを抑える
+    chunks = iter_chunks(iter_rels(), CHUNKSIZE)
+    encode = functools.partial(encode_chunk, mode=ENCODE_MODE, in_dir=IN_DIR)
+    with StopRequest() as stop:
+        try:
+            if workers == 1:
+                for result in bounded_results(None, encode, chunks, 1, stop):
+                    put_results(result)
+                    if writer.error:
+                        break
+            else:
+                # 一様タイル（海など）の出力は親で作ってワーカーに渡す
+                blobs = seed_uniform_blobs(ENCODE_MODE)
+                with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(blobs,)) as ex:
+                    for result in bounded_results(ex, encode, chunks, workers * 2, stop):
+                        put_results(result)
+                        if writer.error:
+                            break
+            if stop.requested:
+                # 止めたときは範囲の足りない MBTiles / PMTiles を完成品として残さない（metadata / finalize をさせずに消す）
+                writer.aborted = True
+        except RoundTripError as e:
+            # 誤差が許容値を超えたら、書けた分で metadata / finalize をさせずに止める
+            writer.aborted = True
+            raise SystemExit(f"Round-trip check failed: {e}")
+        except BaseException:
+            writer.aborted = True
+            raise
+        finally:
+            q.put(None)
+            writer.join()
+            # ワーカーが見つけた一様タイル（海など）を次の実行・検証スクリプトのために残す
+            uniform_tiles.save()
+            if writer.aborted or writer.error:
+                remove_outputs()
+
+    if writer.error:
+        raise writer.error
+    stop.exit_if_requested(f"removed the partial outputs after {done:,} tiles (rerun to rebuild)")
+
+    dt = time.perf_counter() - t0
+    if OUT_MB:
+        print(f"MBTiles written: {OUT_MB.resolve()}")
+    if OUT_PM:
+        print(f"PMTiles written: {OUT_PM.resolve()}")
+    print(f"Tiles written: {writer.inserted}")
+    if OUT_MB:
+        print(f"Unique tile images: {writer.unique}")
+    for path in (OUT_MB, OUT_PM):
+        if path and writer.inserted:
+            print(f"Coverage: {writer.stats.write_sidecar(path)}")
+    m = writer.metadata
+    print(f"Bounds: {m['bounds']}  zoom {m['minzoom']}-{m['maxzoom']}  "
+          f"elevation {m.get('elevation_min_m', '-')} .. {m.get('elevation_max_m', '-')} m")
+    print(f"Throughput: {writer.inserted / dt if dt > 0 else 0.0:,.1f} tiles/s  ({dt:.1f}s)")
+
+if __name__ == "__main__":
+    main()
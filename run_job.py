@@ -0,0 +1,156 @@
+import json
+import time
+import tomllib
+from datetime import datetime, timezone
+from pathlib import Path
+
+import build_overviews
+import check_all
+import dem_png
+import dem_png_async
+import fill_nodata
+import pmtiles_io
+import terrarium_to_mbtiles
+import to_terrarium
+from tile_plan import TilePlan, max_zoom_plan, plan_regions
+
+# ジョブファイル（TOML）に書いた複数の範囲（bbox / ポリゴン）とズーム範囲から、取得〜PMTiles までを通しで実行する
+#   - 各スクリプトの BBOX_* / ズームの定数を書き換えなくてよい（ここで各モジュールの設定値を上書きして main を呼ぶ）
+#     ワーカーが使う値（入出力のディレクトリなど）は各モジュールの main が引数で渡すので、spawn のワーカーでも効く
+#   - 範囲はズームごとに和集合をとる（tile_plan.py）。重なった範囲のタイルは1回だけ取得・変換する
+#   - ステージごとの所要時間を表示し、job_report.json に書く
+# ジョブファイルの例は job.example.toml
+
+JOB_PATH = Path("job.toml")
+REPORT_PATH = Path("job_report.json")   # None なら書かない
+
+STAGES = ("fetch", "overviews", "fill", "terrarium", "mbtiles", "pmtiles", "check")
+DEFAULT_STAGES = ("fetch", "overviews", "terrarium", "mbtiles", "pmtiles")
+
+def load_job(path: Path) -> dict:
+    with open(path, "rb") as f:
+        job = tomllib.load(f)
+    if not job.get("regions"):
+        raise SystemExit(f"No [[regions]] in {path}")
+    unknown = [s for s in job.get("stages", DEFAULT_STAGES) if s not in STAGES]
+    if unknown:
+        raise SystemExit(f"Unknown stages {unknown} (choose from {STAGES})")
+    return job
+
+def print_plan(job: dict, plan: TilePlan):
+    z_min, z_max = plan.zoom_range()
+    separate = sum(plan_regions([r], job["zoom"]).count() for r in job["regions"])
+    union = plan.count()
+    print(f"=== Plan: {len(job['regions'])} regions, z{z_min}-{z_max} ===")
+    for z in range(z_min, z_max + 1):
+        print(f"z{z}: {plan.count(z):,}")
+    print(f"TOTAL: {union:,} tiles (regions summed: {separate:,}, shared: {separate - union:,})\n")
+
+class JobRunner:
+    def __init__(self, job: dict):
+        self.job = job
+        self.plan = plan_regions(job["regions"], job["zoom"])
+        # ズーム範囲は範囲ごとの zoom も含めた計画から（job 全体の zoom だけではない）
+        self.z_min, self.z_max = self.plan.zoom_range()
+        self.max_zoom_only = job.get("fetch_max_zoom_only", False)
+        # fetch_max_zoom_only では各範囲をその範囲の最大ズームで取得する
+        self.sources = max_zoom_plan(job["regions"], job["zoom"])
+        self.out_mb = Path(job.get("out_mbtiles", terrarium_to_mbtiles.OUT_MB))
+        self.out_pm = Path(job["out_pmtiles"]) if job.get("out_pmtiles") else None
+        self.timings = []       # [(stage, 秒, 状態)]
+
+    def stage_fetch(self):
+        tiles = self.sources.iter_tiles() if self.max_zoom_only else self.plan.iter_tiles()
+        if self.job.get("fetch", "async") == "async":
+            dem_png_async.run_download_async(tiles)
+        else:
+            dem_png.run_download(tiles)
+
+    def stage_overviews(self):
+        if not self.max_zoom_only:
+            print("fetch_max_zoom_only = false: nothing to build")
+            return
+        written = build_overviews.OverviewBuilder(self.z_min, self.z_max, plan=self.plan, sources=self.sources).run()
+        print(f"Overviews: {sum(written.values()):,} tiles")
+
+    def stage_fill(self):
+        fill_nodata.main()
+        # 以降の変換は埋めたタイルから
+        to_terrarium.IN_DIR = fill_nodata.OUT_DIR
+
+    def stage_terrarium(self):
+        # 変換は計画した範囲のタイルだけ（IN_DIR にある範囲外のタイルはそのまま）
+        to_terrarium.TILE_FILTER = self.plan.contains
+        to_terrarium.main()
+
+    def stage_mbtiles(self):
+        m = terrarium_to_mbtiles
+        m.OUT_MB = self.out_mb
+        m.MINZOOM, m.MAXZOOM = self.z_min, self.z_max
+        m.BOUNDS_W, m.BOUNDS_S, m.BOUNDS_E, m.BOUNDS_N = self.plan.lon_lat_bounds
+        m.TILE_FILTER = self.plan.contains
+        m.main()
+
+    def stage_pmtiles(self):
+        if self.out_pm is None:
+            print("out_pmtiles is not set: skipped")
+            return
+        h = pmtiles_io.convert_mbtiles(self.out_mb, self.out_pm)
+        print(f"PMTiles written: {self.out_pm.resolve()}  ({h['addressed_tiles_count']:,} tiles)")
+
+    def stage_check(self):
+        check_all.main()
+
+    def run(self, stages):
+        for stage in stages:
+            print(f"\n===== {stage} =====")
+            t0 = time.perf_counter()
+            status = "ok"
+            try:
+                getattr(self, f"stage_{stage}")()
+            except SystemExit as e:
+                # ステージが SystemExit で止まったら（入力が無い・判定NGなど）以降は実行しない
+                status = f"failed: {e.code}"
+                raise
+            except BaseException as e:
+                # 例外や2回目の Ctrl-C（KeyboardInterrupt）も失敗として記録する
+                status = f"failed: {type(e).__name__}: {e}" if str(e) else f"failed: {type(e).__name__}"
+                raise
+            finally:
+                self.timings.append((stage, time.perf_counter() - t0, status))
+
+    def report(self) -> dict:
+        return {
+            "generated_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "name": self.job.get("name", ""),
+            "regions": [r.get("name", str(i)) for i, r in enumerate(self.job["regions"])],
+            "zoom": [self.z_min, self.z_max],
+            "planned_tiles": {str(z): self.plan.count(z) for z in sorted(self.plan.zooms)},
+            "stages": [{"stage": s, "seconds": round(dt, 3), "status": st} for s, dt, st in self.timings],
+        }
+
+def main():
+    if not JOB_PATH.exists():
+        raise SystemExit(f"Job file not found: {JOB_PATH.resolve()} (copy job.example.toml)")
+    job = load_job(JOB_PATH)
+    t0 = time.perf_counter()
+    runner = JobRunner(job)
+    plan_dt = time.perf_counter() - t0
+    print_plan(job, runner.plan)
+
+    try:
+        runner.run(job.get("stages", DEFAULT_STAGES))
+    finally:
+        print("\n===== Timings =====")
+        print(f"{'plan':<10} {plan_dt:>9.2f}s")
+        for stage, dt, status in runner.timings:
+            print(f"{stage:<10} {dt:>9.2f}s  {status}")
+        print(f"{'total':<10} {plan_dt + sum(t[1] for t in runner.timings):>9.2f}s")
+        if REPORT_PATH is not None:
+            report = runner.report()
+            report["plan_seconds"] = round(plan_dt, 3)
+            REPORT_PATH.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+            print(f"Report: {REPORT_PATH.resolve()}")
+
+if __name__ == "__main__":
+    main()
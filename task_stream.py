@@ -0,0 +1,119 @@
+import os
+import signal
+import threading
+from concurrent.futures import FIRST_COMPLETED, wait
+from itertools import islice
+from pathlib import Path
+
+import perf_metrics
+
+# タスクを一覧にせず、生成しながら流す（全国 z14 など数百万タイルでもメモリを一定に保つ）
+#   - iter_tile_files: {z}/{x}/{y}.png をディレクトリごとに並べて辿る（sorted(rglob) と同じ順。一覧をメモリに作らない）
+#   - bounded_results: 投入中のタスクを window 個までにして、終わった順に結果を返す
+#   - StopRequest: 1回目の Ctrl-C で「新しいタスクを出さない」だけにし、実行中の分は終えて記録を書いてから止める
+#     2回目の Ctrl-C は従来どおり KeyboardInterrupt
+#   - StopEvent: StopRequest をワーカープロセスへ伝える（ワーカーは Ctrl-C を無視し、親が立てた Event を見る）
+
+def iter_tile_files(root: Path, suffix: str = ".png"):
+    """root 以下の *.png を sorted(root.rglob("*.png")) と同じ順に返す（ディレクトリ1つ分ずつしか読まない）"""
+    with os.scandir(root) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for e in entries:
+        if e.is_dir():
+            yield from iter_tile_files(Path(e.path), suffix)
+        elif e.name.endswith(suffix):
+            yield Path(e.path)
+
+def iter_chunks(items, size: int):
+    """リストでもジェネレータでも size 個ずつのリストにする"""
+    it = iter(items)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def ignore_sigint():
+    # ワーカープロセスの初期化用: Ctrl-C は親だけが受けて、ワーカーは実行中のタスクを終える
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class StopRequest:
+    """
+    with StopRequest() as stop:
+        for t in tasks:
+            if stop.requested:
+                break
+    メインスレッド以外で使ったときは何もしない（シグナルハンドラはメインスレッドでしか置けない）
+    """
+
+    def __init__(self):
+        self.requested = False
+        self.previous = None
+
+    def handler(self, signum, frame):
+        if self.requested:
+            raise KeyboardInterrupt
+        self.requested = True
+        print("\nInterrupt: finishing tasks in flight and saving progress (Ctrl-C again to abort)", flush=True)
+
+    def __enter__(self):
+        if threading.current_thread() is threading.main_thread():
+            self.previous = signal.signal(signal.SIGINT, self.handler)
+        return self
+
+    def __exit__(self, *exc):
+        if self.previous is not None:
+            signal.signal(signal.SIGINT, self.previous)
+            self.previous = None
+        return False
+
+    def exit_if_requested(self, message: str):
+        """止めたなら SystemExit（run_job.py の後続ステージも走らない）"""
+        if self.requested:
+            raise SystemExit(f"Interrupted: {message}")
+
+class StopEvent:
+    """
+    ワーカープロセス側の StopRequest（親が立てる multiprocessing.Event を .requested で見る）
+    Event はタスクの引数では渡せないので、ProcessPoolExecutor の initializer で渡す
+    """
+
+    def __init__(self, event):
+        self.event = event
+
+    @property
+    def requested(self) -> bool:
+        return self.event.is_set()
+
+def bounded_results(ex, fn, items, window: int, stop: StopRequest = None):
+    """
+    items の各要素に fn を実行し、終わった順に結果を返す。投入中のタスクは window 個まで
+    ex=None なら直列（順番どおり）。stop が立ったら残りは投入せず、投入済みの分だけ返して終わる
+    """
+    it = iter(items)
+    if ex is None:
+        for item in it:
+            if stop is not None and stop.requested:
+                return
+            yield fn(item)
+        return
+
+    pending = set()
+    try:
+        for item in it:
+            if stop is not None and stop.requested:
+                break
+            pending.add(ex.submit(fn, item))
+            perf_metrics.gauge("in_flight", len(pending))
+            if len(pending) >= window:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    yield f.result()
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in finished:
+                yield f.result()
+    finally:
+        # 例外や2回目の Ctrl-C で抜けたときは、まだ始まっていないタスクを取り消す
+        for f in pending:
+            f.cancel()
@@ -1,11 +1,30 @@
+import hashlib
+import multiprocessing
+import os
 import sqlite3
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
 
+import numpy as np
+
+import perf_metrics
+import uniform_tiles
+from dem_codec import terrarium_to_height_m
+from pmtiles_io import zxy_to_tileid
+from task_stream import StopEvent, StopRequest, ignore_sigint, iter_chunks, iter_tile_files
+from tileset_stats import TilesetStats
+from to_terrarium import MANIFEST, content_hash, decode_png
+
 # ===== 入出力 =====
 IN_DIR = Path("terrarium")                 # terrarium/{z}/{x}/{y}.png
 OUT_MB = Path("dem_terrarium_z8-14.mbtiles")
 
-# ===== メタ情報（bbox固定）=====
+# ===== メタ情報 =====
+# bounds / minzoom / maxzoom / center は実際に書いたタイルから求める（tileset_stats.py）。
+# 下の値はズームの絞り込みと、タイルが1枚も無いときの既定値にだけ使う
+# 標高の範囲は書いたタイルごとに to_terrarium.py のマニフェストから引いて（無ければ復号して）求める
 BOUNDS_W, BOUNDS_S, BOUNDS_E, BOUNDS_N = (
     144.124997317805,
     43.8750031560014,
@@ -14,47 +33,419 @@ BOUNDS_W, BOUNDS_S, BOUNDS_E, BOUNDS_N = (
 )
 MINZOOM = 8
 MAXZOOM = 14
+TILE_FILTER = None          # (z, x, y) -> bool。None なら全タイル（run_job.py が計画した範囲だけに絞るのに使う）
+
+# 同一内容のタイル（海・nodataの一様タイルなど）を1つのBLOBにまとめる
+# True: map/images スキーマ + tiles ビュー（mbutil 等と同じ標準的な重複排除形式）
+DEDUP = True
+
+# ===== 一括投入 =====
+# journal_mode=OFF / synchronous=OFF で入れ、(z,x,y) の UNIQUE インデックスは投入後に作る
+# 途中で落ちたファイルは壊れている可能性があるので作り直すこと（毎回新規作成なので問題ない）
+BULK_LOAD = True
+BATCH_SIZE = 5000           # executemany + commit の単位
+READ_THREADS = 4            # ファイル読み込みの先読みスレッド数
+READ_CHUNK = 256            # 1スレッドタスクで読むファイル数（タイルごとに submit するとオーバーヘッドが勝つ）
+PREFETCH = 2048             # 先読みしてメモリに持つタイル数の上限
+PAGE_SIZE = 16384           # 新規作成時の page_size（タイルBLOBが数十KBあるので既定の4096より大きめ）
+VACUUM = False              # 最後に VACUUM してページを並べ直す（配布用。DBサイズ分の書き直しになるので既定は無効）
+
+# ===== シャード並列 =====
+# SHARDS > 1 なら Hilbert 順（PMTiles の TileID 順）に同数ずつ分けて、プロセスごとに別の MBTiles（シャード）へ書き、
+# 最後に ATTACH + INSERT ... SELECT で1つにまとめる（SQLite のライターが1つしかない制約を避ける）
+# パスの一覧は作らない: 1パス目で TileID の分布を数えて区間を決め、2パス目は各ワーカーが入力を辿って自分の区間だけ読む
+SHARDS = 1                  # 例: os.cpu_count()
+KEEP_SHARDS = False         # True ならマージ後もシャードを残す（調査用）
+SPLIT_BITS = 16             # 区間を決めるときに数える TileID のバケットは 2**SPLIT_BITS 個まで（超えたら粗くする）
 
 def xyz_y_to_tms_y(z: int, y_xyz: int) -> int:
     # MBTiles tiles.tile_row は TMS（XYZからy反転）
     return (2 ** z - 1 - y_xyz)
 
-def ensure_schema(cur: sqlite3.Cursor):
+def apply_bulk_pragmas(cur: sqlite3.Cursor):
+    # ジャーナル無し・fsync無し（接続ごとの設定なので書き込む接続で毎回呼ぶ）
     cur.executescript("""
-    PRAGMA journal_mode=WAL;
-    PRAGMA synchronous=NORMAL;
-
-    CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
-    CREATE TABLE IF NOT EXISTS tiles (
-        zoom_level INTEGER,
-        tile_column INTEGER,
-        tile_row INTEGER,
-        tile_data BLOB
-    );
-    CREATE UNIQUE INDEX IF NOT EXISTS tile_index
-      ON tiles (zoom_level, tile_column, tile_row);
+    PRAGMA journal_mode=OFF;
+    PRAGMA synchronous=OFF;
     """)
 
+def ensure_schema(cur: sqlite3.Cursor, dedup: bool = DEDUP, bulk: bool = False):
+    """bulk=True: 一括投入用（page_size 設定・ジャーナル無し・(z,x,y) インデックスは create_indexes で後から）"""
+    if bulk:
+        # page_size は空のDBでテーブルを作る前に設定する
+        cur.execute(f"PRAGMA page_size={int(PAGE_SIZE)};")
+        apply_bulk_pragmas(cur)
+    else:
+        cur.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        """)
+    cur.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);")
+    if dedup:
+        # tiles は map と images を結合したビュー（読み手からは通常のMBTilesに見える）
+        cur.executescript("""
+        CREATE TABLE IF NOT EXISTS map (
+            zoom_level INTEGER,
+            tile_column INTEGER,
+            tile_row INTEGER,
+            tile_id TEXT
+        );
+        CREATE TABLE IF NOT EXISTS images (
+            tile_data BLOB,
+            tile_id TEXT
+        );
+        -- 重複排除（INSERT OR IGNORE）に使うので images_id は最初から作る
+        CREATE UNIQUE INDEX IF NOT EXISTS images_id
+          ON images (tile_id);
+        CREATE VIEW IF NOT EXISTS tiles AS
+          SELECT map.zoom_level AS zoom_level,
+                 map.tile_column AS tile_column,
+                 map.tile_row AS tile_row,
+                 images.tile_data AS tile_data
+          FROM map JOIN images ON images.tile_id = map.tile_id;
+        """)
+    else:
+        cur.executescript("""
+        CREATE TABLE IF NOT EXISTS tiles (
+            zoom_level INTEGER,
+            tile_column INTEGER,
+            tile_row INTEGER,
+            tile_data BLOB
+        );
+        """)
+    if not bulk:
+        create_indexes(cur, dedup)
+
+def create_indexes(cur: sqlite3.Cursor, dedup: bool = DEDUP):
+    if dedup:
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row);")
+    else:
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);")
+
+def finish_bulk_load(conn: sqlite3.Connection, dedup: bool = DEDUP, vacuum: bool = VACUUM):
+    """一括投入の後処理: インデックス作成 -> ANALYZE -> VACUUM -> 通常のジャーナルに戻す"""
+    cur = conn.cursor()
+    create_indexes(cur, dedup)
+    cur.execute("ANALYZE;")
+    conn.commit()
+    if vacuum:
+        cur.execute("VACUUM;")
+    # 読み手（タイルサーバ等）が -wal/-shm を作らないよう rollback ジャーナルにしておく
+    cur.execute("PRAGMA journal_mode=DELETE;")
+    conn.commit()
+
+def insert_tiles(cur: sqlite3.Cursor, rows, dedup: bool = DEDUP):
+    """rows: [(zoom_level, tile_column, tile_row(TMS), data)]"""
+    if not dedup:
+        cur.executemany(
+            "INSERT OR REPLACE INTO tiles(zoom_level, tile_column, tile_row, tile_data) VALUES(?,?,?,?)",
+            [(z, x, row, sqlite3.Binary(data)) for z, x, row, data in rows],
+        )
+        return
+    # 内容ハッシュをキーに images は1回だけ入れる
+    images = {}
+    mapping = []
+    for z, x, row, data in rows:
+        tile_id = hashlib.md5(data).hexdigest()
+        images.setdefault(tile_id, data)
+        mapping.append((z, x, row, tile_id))
+    cur.executemany(
+        "INSERT OR IGNORE INTO images(tile_data, tile_id) VALUES(?,?)",
+        [(sqlite3.Binary(data), tile_id) for tile_id, data in images.items()],
+    )
+    cur.executemany(
+        "INSERT OR REPLACE INTO map(zoom_level, tile_column, tile_row, tile_id) VALUES(?,?,?,?)",
+        mapping,
+    )
+
+def count_images(cur: sqlite3.Cursor, dedup: bool = DEDUP) -> int:
+    table = "images" if dedup else "tiles"
+    return cur.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
 def upsert_metadata(cur: sqlite3.Cursor, name: str, value: str):
     cur.execute("DELETE FROM metadata WHERE name = ?", (name,))
     cur.execute("INSERT INTO metadata(name, value) VALUES(?, ?)", (name, value))
 
+def build_metadata() -> dict:
+    # ---- metadata（最低限 + 使えるもの）----
+    return {
+        "name": "GSI DEM (Terrarium) z8-14",
+        "format": "png",
+        "minzoom": str(MINZOOM),
+        "maxzoom": str(MAXZOOM),
+        "bounds": f"{BOUNDS_W},{BOUNDS_S},{BOUNDS_E},{BOUNDS_N}",
+        "type": "overlay",
+        "description": "Converted from GSI dem_png to Terrarium encoding for MapLibre raster-dem.",
+    }
+
+def write_metadata(cur: sqlite3.Cursor, metadata: dict = None):
+    for name, value in (metadata or build_metadata()).items():
+        upsert_metadata(cur, name, value)
+
 def parse_zxy(p: Path):
-    # terrarium/z/x/y.png
-    rel = p.relative_to(IN_DIR)
-    if len(rel.parts) < 3:
+    # .../z/x/y.png（末尾の3階層から読むので IN_DIR を見ない。シャードのワーカーからも呼ぶ）
+    parts = Path(p).parts
+    if len(parts) < 3:
         raise ValueError(f"Unexpected path: {p}")
-    z = int(rel.parts[0])
-    x = int(rel.parts[1])
-    y = int(rel.parts[2].replace(".png", ""))
+    z = int(parts[-3])
+    x = int(parts[-2])
+    y = int(parts[-1].replace(".png", ""))
     return z, x, y
 
+def read_tiles(paths):
+    """[Path] -> [(z, x, tile_row, data)]"""
+    rows = []
+    with perf_metrics.timer("read"):
+        for p in paths:
+            z, x, y = parse_zxy(p)
+            rows.append((z, x, xyz_y_to_tms_y(z, y), p.read_bytes()))
+    perf_metrics.count("bytes_in", sum(len(r[3]) for r in rows))
+    return rows
+
+def prefetch_tiles(paths, threads: int = READ_THREADS, window: int = PREFETCH, chunk: int = READ_CHUNK,
+                   stop: StopRequest = None):
+    """
+    スレッドプールで先読みしつつ、入力順に (z, x, tile_row, data) を返す（先読みは window タイル程度まで）
+    paths はジェネレータでもよい。stop が立ったら残りは読まない
+    """
+    with ThreadPoolExecutor(max_workers=threads) as ex:
+        pending = deque()
+        for part in iter_chunks(paths, chunk):
+            if stop is not None and stop.requested:
+                break
+            pending.append(ex.submit(read_tiles, part))
+            perf_metrics.gauge("prefetch_chunks", len(pending))
+            if len(pending) * chunk >= window:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+class ElevationLookup:
+    """
+    書いたタイルの標高 (min, max)。to_terrarium.py のマニフェストの行（rel が同じで、出力のハッシュがタイルの中身と一致するもの）から引く。
+    引けなければ Terrarium を復号して求める（Terrarium には nodata が無いので、nodata の画素は 0m として入る）
+    """
+
+    def __init__(self, manifest: Path = None):
+        self.conn = None
+        path = Path(manifest) if manifest else None
+        if path is None or not path.exists():
+            return
+        self.conn = sqlite3.connect(f"file:{path.as_posix()}?mode=ro", uri=True)
+        # 標高の列が無い古いマニフェストは使わない
+        if "valid_px" not in {row[1] for row in self.conn.execute("PRAGMA table_info(tiles)")}:
+            self.close()
+
+    def get(self, z: int, x: int, y: int, data: bytes):
+        """-> (min, max)。全面 nodata なら (None, None)"""
+        if self.conn is not None:
+            row = self.conn.execute(
+                "SELECT out_hash, elev_min, elev_max, valid_px FROM tiles WHERE rel = ?", (f"{z}/{x}/{y}.png",)
+            ).fetchone()
+            if row is not None and row[3] is not None and row[0] == content_hash(data):
+                perf_metrics.count("elev_manifest")
+                return row[1], row[2]
+        perf_metrics.count("elev_decoded")
+        with perf_metrics.timer("elev_decode"):
+            found = uniform_tiles.detect(data)
+            rgb = np.array([[found[0]]], dtype=np.uint8) if found is not None else decode_png(data)
+            h = terrarium_to_height_m(rgb)
+        return float(h.min()), float(h.max())
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+def load_tiles(conn: sqlite3.Connection, paths, stats: TilesetStats, label: str = "", stop: StopRequest = None,
+               elevations: ElevationLookup = None) -> int:
+    """paths のタイルを BATCH_SIZE ごとに投入し、座標と標高を stats に足す -> 投入数"""
+    cur = conn.cursor()
+    inserted = 0
+    # 読み込みはスレッドで先読み、書き込みはこのスレッドだけ（SQLite のライターは1つ）
+    batch = []
+    for row in prefetch_tiles(paths, stop=stop):
+        z, x, tile_row, data = row
+        y = xyz_y_to_tms_y(z, tile_row)     # TMS の反転は自分自身が逆変換
+        stats.add(z, x, y, *(elevations.get(z, x, y, data) if elevations is not None else (None, None)))
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            with perf_metrics.timer("insert"):
+                insert_tiles(cur, batch)
+            with perf_metrics.timer("commit"):
+                conn.commit()
+            inserted += len(batch)
+            batch = []
+            print(f"{label}Inserted {inserted} tiles...")
+    if batch:
+        with perf_metrics.timer("insert"):
+            insert_tiles(cur, batch)
+        with perf_metrics.timer("commit"):
+            conn.commit()
+        inserted += len(batch)
+    perf_metrics.count("tiles", inserted)
+    return inserted
+
+def shard_path(i: int) -> Path:
+    return OUT_MB.with_name(f"{OUT_MB.stem}.shard{i:03d}{OUT_MB.suffix}")
+
+def split_by_hilbert(paths, n: int, bits: int = SPLIT_BITS, stop: StopRequest = None):
+    """
+    TileID（Hilbert）順で n 個の連続区間 [lo, hi) に分ける（近いタイルが同じシャードに入る。hi=None は上限なし）
+    パスは持たず、TileID を shift ビット落としたバケットごとの件数だけ数える。バケットが 2**bits 個を超えたら
+    shift を1つ増やしてまとめ直す（入力が狭い範囲なら細かいまま）。バケットの途中では切らないので区間の件数はおおよそ同じ
+    -> ([(lo, hi)], タイル数)
+    """
+    shift = 0
+    hist = Counter()
+    for p in paths:
+        if stop is not None and stop.requested:
+            break
+        hist[zxy_to_tileid(*parse_zxy(p)) >> shift] += 1
+        while len(hist) > 1 << bits:
+            shift += 1
+            coarse = Counter()
+            for b, c in hist.items():
+                coarse[b >> 1] += c
+            hist = coarse
+    total = sum(hist.values())
+    bounds = [0]
+    acc = 0
+    for b in sorted(hist):
+        if len(bounds) < n and acc >= total * len(bounds) / n:
+            bounds.append(b << shift)
+        acc += hist[b]
+    return list(zip(bounds, bounds[1:] + [None])), total
+
+SHARD_STOP = None           # シャードのワーカーが見る StopEvent（init_shard_worker で置く）
+
+def init_shard_worker(event):
+    # Ctrl-C は親だけが受け、親が立てる Event で投入を止める（実行中のバッチは書き切ってシャードを閉じる）
+    global SHARD_STOP
+    ignore_sigint()
+    SHARD_STOP = StopEvent(event)
+
+def iter_shard_targets(in_dir: Path, zooms, tile_filter, lo: int, hi: int):
+    """2パス目（ワーカー）: 入力を辿って、zooms と tile_filter に合い TileID が [lo, hi) のタイルだけ返す"""
+    minzoom, maxzoom = zooms
+    for p in iter_tile_files(in_dir):
+        z, x, y = parse_zxy(p)
+        if not minzoom <= z <= maxzoom:
+            continue
+        tile_id = zxy_to_tileid(z, x, y)
+        if lo <= tile_id and (hi is None or tile_id < hi) and (tile_filter is None or tile_filter(z, x, y)):
+            yield p
+
+def build_shard(task):
+    """
+    ワーカー: (シャード番号, シャードのパス, マニフェスト, 入力ディレクトリ, (minzoom, maxzoom), TILE_FILTER, (lo, hi))
+      -> (シャードのパス, 投入数, TilesetStats, 計測値)
+    入出力先・絞り込みは親から渡す（spawn のワーカーは親で書き換えた OUT_MB などを見ない）
+    """
+    i, path, manifest, in_dir, zooms, tile_filter, (lo, hi) = task
+    paths = iter_shard_targets(in_dir, zooms, tile_filter, lo, hi)
+    if path.exists():
+        path.unlink()
+    stats = TilesetStats()
+    elevations = ElevationLookup(manifest)
+
+    conn = sqlite3.connect(str(path))
+    try:
+        # シャードは使い捨てなのでインデックス（images_id 以外）も VACUUM も不要
+        ensure_schema(conn.cursor(), bulk=True)
+        inserted = load_tiles(conn, paths, stats, label=f"[shard {i}] ", stop=SHARD_STOP, elevations=elevations)
+        # シャード単体でも MBTiles として読めるように metadata を入れておく
+        write_metadata(conn.cursor(), stats.to_metadata(build_metadata()))
+        conn.commit()
+    finally:
+        conn.close()
+        elevations.close()
+    return path, inserted, stats, perf_metrics.take()
+
+def merge_shards(conn: sqlite3.Connection, shards, dedup: bool = DEDUP) -> int:
+    """シャードを ATTACH して INSERT ... SELECT で取り込む -> 取り込んだタイル数"""
+    cur = conn.cursor()
+    merged = 0
+    for path, expected, *_ in shards:
+        cur.execute("ATTACH DATABASE ? AS shard", (str(path),))
+        try:
+            if dedup:
+                # シャードをまたいで同じ内容のタイルがあれば images_id で弾く
+                cur.execute("INSERT OR IGNORE INTO images(tile_data, tile_id) SELECT tile_data, tile_id FROM shard.images")
+                cur.execute(
+                    "INSERT INTO map(zoom_level, tile_column, tile_row, tile_id)"
+                    " SELECT zoom_level, tile_column, tile_row, tile_id FROM shard.map"
+                )
+            else:
+                cur.execute(
+                    "INSERT INTO tiles(zoom_level, tile_column, tile_row, tile_data)"
+                    " SELECT zoom_level, tile_column, tile_row, tile_data FROM shard.tiles"
+                )
+            if cur.rowcount != expected:
+                raise RuntimeError(f"Shard {path}: merged {cur.rowcount} tiles, expected {expected}")
+            merged += cur.rowcount
+            conn.commit()
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            cur.execute("DETACH DATABASE shard")
+        print(f"Merged {path.name}: {expected} tiles")
+    return merged
+
+def run_shards(ex, tasks, stop: StopRequest = None, event=None):
+    """シャードを並列に作る。待っている間に stop が立ったら event を立ててワーカーに伝える -> 結果（タスク順）"""
+    futures = [ex.submit(build_shard, t) for t in tasks]
+    pending = set(futures)
+    while pending:
+        if stop is not None and stop.requested:
+            event.set()
+        _, pending = wait(pending, timeout=0.5)
+    return [f.result() for f in futures]
+
+def build_sharded(conn: sqlite3.Connection, ranges, files: int, stats: TilesetStats, stop: StopRequest = None) -> int:
+    """ranges: split_by_hilbert の区間、files: 1パス目で数えた入力タイル数"""
+    tasks = [(i, shard_path(i), MANIFEST, IN_DIR, (MINZOOM, MAXZOOM), TILE_FILTER, r) for i, r in enumerate(ranges)]
+    event = multiprocessing.Event()
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=min(len(tasks), os.cpu_count() or 1),
+                                 initializer=init_shard_worker, initargs=(event,)) as ex:
+            results = run_shards(ex, tasks, stop, event)
+        merged = merge_shards(conn, results)
+        # 件数の突き合わせ（入力ファイル数 = シャードの合計 = マージ後の map/tiles 行数）
+        # 止めたときはシャードが途中までなので、入力ファイル数とは比べない
+        table = "map" if DEDUP else "tiles"
+        total = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        shard_total = sum(r[1] for r in results)
+        stopped = stop is not None and stop.requested
+        if not ((stopped or files == shard_total) and shard_total == merged == total):
+            raise RuntimeError(f"Tile count mismatch: files={files} shards={shard_total} "
+                               f"merged={merged} table={total}")
+        for r in results:
+            stats.merge(r[2])
+            perf_metrics.merge(r[3])
+    finally:
+        if not KEEP_SHARDS:
+            # 途中で失敗したシャードも残さない
+            for _, path, *_ in tasks:
+                path.unlink(missing_ok=True)
+    return merged
+
+def iter_targets(counts: dict, in_dir: Path, zooms, tile_filter):
+    """zooms=(minzoom, maxzoom) と tile_filter に合う入力タイルを入力順に（外れたタイルは counts["skipped"] に数える）"""
+    minzoom, maxzoom = zooms
+    for p in iter_tile_files(in_dir):
+        z, x, y = parse_zxy(p)
+        if minzoom <= z <= maxzoom and (tile_filter is None or tile_filter(z, x, y)):
+            yield p
+        else:
+            counts["skipped"] += 1
+
+@perf_metrics.stage("mbtiles")
 def main():
     if not IN_DIR.exists():
         raise SystemExit(f"Input dir not found: {IN_DIR.resolve()}")
-
-    files = sorted(IN_DIR.rglob("*.png"))
-    if not files:
+    if next(iter_tile_files(IN_DIR), None) is None:
         raise SystemExit("No PNG files found under terrarium/")
 
     if OUT_MB.exists():
@@ -63,50 +454,59 @@ def main():
     conn = sqlite3.connect(str(OUT_MB))
     try:
         cur = conn.cursor()
-        ensure_schema(cur)
-
-        # ---- metadata（最低限 + 使えるもの）----
-        upsert_metadata(cur, "name", "GSI DEM (Terrarium) z8-14")
-        upsert_metadata(cur, "format", "png")
-        upsert_metadata(cur, "minzoom", str(MINZOOM))
-        upsert_metadata(cur, "maxzoom", str(MAXZOOM))
-        upsert_metadata(cur, "bounds", f"{BOUNDS_W},{BOUNDS_S},{BOUNDS_E},{BOUNDS_N}")
-        upsert_metadata(cur, "type", "overlay")
-        upsert_metadata(cur, "description", "Converted from GSI dem_png to Terrarium encoding for MapLibre raster-dem.")
-        conn.commit()
-
-        inserted = 0
-        skipped = 0
+        ensure_schema(cur, bulk=BULK_LOAD)
 
-        cur.execute("BEGIN;")
-        for p in files:
-            z, x, y = parse_zxy(p)
-            if z < MINZOOM or z > MAXZOOM:
-                skipped += 1
-                continue
-
-            tile_row = xyz_y_to_tms_y(z, y)
-            data = p.read_bytes()
-
-            cur.execute(
-                "INSERT OR REPLACE INTO tiles(zoom_level, tile_column, tile_row, tile_data) VALUES(?,?,?,?)",
-                (z, x, tile_row, sqlite3.Binary(data)),
-            )
-            inserted += 1
+        write_metadata(cur)
+        conn.commit()
 
-            if inserted % 1000 == 0:
-                print(f"Inserted {inserted} tiles...")
+        t0 = time.perf_counter()
+        stats = TilesetStats()
+        counts = {"skipped": 0}
+        # 入力は辿りながら投入する（先読みは PREFETCH タイルまで）
+        targets = iter_targets(counts, IN_DIR, (MINZOOM, MAXZOOM), TILE_FILTER)
+        files = 0
+        elevations = ElevationLookup(MANIFEST)
+        try:
+            with StopRequest() as stop:
+                if SHARDS > 1:
+                    # 1パス目: TileID の分布だけ数えて区間を決める（パスの一覧は作らない）
+                    ranges, files = split_by_hilbert(targets, SHARDS, stop=stop)
+                    targets = iter_targets({"skipped": 0}, IN_DIR, (MINZOOM, MAXZOOM), TILE_FILTER)
+                if SHARDS > 1 and files > SHARDS:
+                    inserted = build_sharded(conn, ranges, files, stats, stop=stop)
+                else:
+                    inserted = load_tiles(conn, targets, stats, stop=stop, elevations=elevations)
+        finally:
+            elevations.close()
+        skipped = counts["skipped"]
 
+        # 実際に書いたタイル（座標・標高）から metadata を作り直す
+        metadata = stats.to_metadata(build_metadata())
+        write_metadata(cur, metadata)
         conn.commit()
 
         # 統計/最適化
-        cur.execute("ANALYZE;")
-        conn.commit()
+        with perf_metrics.timer("finalize"):
+            if BULK_LOAD:
+                finish_bulk_load(conn)
+            else:
+                cur.execute("ANALYZE;")
+                conn.commit()
+        dt = time.perf_counter() - t0
 
         print(f"MBTiles written: {OUT_MB.resolve()}")
         print(f"Tiles inserted: {inserted}")
+        if DEDUP:
+            print(f"Unique tile images: {count_images(cur)}")
         if skipped:
-            print(f"Tiles skipped (outside z range): {skipped}")
+            print(f"Tiles skipped (outside z range / filter): {skipped}")
+        print(f"Bounds: {metadata['bounds']}  zoom {metadata['minzoom']}-{metadata['maxzoom']}  "
+              f"elevation {metadata.get('elevation_min_m', '-')} .. {metadata.get('elevation_max_m', '-')} m")
+        if inserted:
+            print(f"Coverage: {stats.write_sidecar(OUT_MB)}")
+        print(f"Throughput: {inserted / dt if dt > 0 else 0.0:,.1f} tiles/s  ({dt:.1f}s)")
+        # 止めた時点までのタイルで MBTiles としては完結させてある（範囲は足りない）
+        stop.exit_if_requested(f"wrote a partial MBTiles with {inserted:,} tiles (rerun to rebuild)")
 
     finally:
         conn.close()
@@ -0,0 +1,70 @@
+import io
+import struct
+import zlib
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+# RGB タイルの画像エンコード（速度とサイズのトレードオフを選べる）
+#   max : PIL optimize=True（最小サイズ・最も遅い。リリース用。従来の出力と同じ）
+#   fast: numpy でフィルタ（全行同じ種類）を掛けて zlib を低レベルで圧縮する自前PNGライター（開発・CI用）
+#   webp: WebP ロスレス（PNGより小さいことが多い。MBTiles/PMTiles の format は webp になる）
+# どのモードもロスレスなので復号した RGB は同じ
+
+ENCODE_MODES = ("max", "fast", "webp")
+FORMAT_BY_MODE = {"max": "png", "fast": "png", "webp": "webp"}
+
+FAST_ZLIB_LEVEL = 1         # 0..9
+FAST_FILTER = "up"          # none / sub / up（Terrarium は上の行との差が小さいので up が効く）
+WEBP_METHOD = 4             # 0（速い）..6（小さい）
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_FILTER_TYPE = {"none": 0, "sub": 1, "up": 2}
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+def png_filter_rows(rgb: np.ndarray, filt: str = FAST_FILTER) -> np.ndarray:
+    """(H, W, 3) -> (H, 1 + W*3) のフィルタ済みスキャンライン（先頭バイトがフィルタ種別）"""
+    h, w, c = rgb.shape
+    rows = rgb.reshape(h, w * c)
+    out = np.empty((h, 1 + w * c), dtype=np.uint8)
+    out[:, 0] = _PNG_FILTER_TYPE[filt]
+    if filt == "none":
+        out[:, 1:] = rows
+    elif filt == "sub":
+        # 左隣の画素（c バイト前）との差。uint8 の桁あふれは PNG の仕様どおり mod 256
+        out[:, 1:c + 1] = rows[:, :c]
+        np.subtract(rows[:, c:], rows[:, :-c], out=out[:, c + 1:])
+    elif filt == "up":
+        # 上の行との差（1行目は上が 0 なのでそのまま）
+        out[0, 1:] = rows[0]
+        np.subtract(rows[1:], rows[:-1], out=out[1:, 1:])
+    else:
+        raise ValueError(f"Unknown PNG filter: {filt}")
+    return out
+
+def encode_png_fast(rgb: np.ndarray, level: int = FAST_ZLIB_LEVEL, filt: str = FAST_FILTER) -> bytes:
+    """8bit RGB の PNG を直接組み立てる（PIL の適応フィルタ/optimize を通さない）"""
+    h, w, _ = rgb.shape
+    ihdr = struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 0)   # 8bit, truecolor, deflate, 標準フィルタ, 非インターレース
+    idat = zlib.compress(png_filter_rows(np.ascontiguousarray(rgb), filt).tobytes(), level)
+    return _PNG_SIGNATURE + _png_chunk(b"IHDR", ihdr) + _png_chunk(b"IDAT", idat) + _png_chunk(b"IEND", b"")
+
+def encode_image(rgb: np.ndarray, mode: str = "max") -> bytes:
+    """(H, W, 3) uint8 -> 画像バイト列（形式は FORMAT_BY_MODE[mode]）"""
+    if mode == "fast":
+        return encode_png_fast(rgb)
+    out = io.BytesIO()
+    img = Image.fromarray(rgb, mode="RGB")
+    if mode == "max":
+        img.save(out, format="PNG", optimize=True)
+    elif mode == "webp":
+        img.save(out, format="WEBP", lossless=True, quality=100, method=WEBP_METHOD)
+    else:
+        raise ValueError(f"Unknown encode mode: {mode} (choose from {ENCODE_MODES})")
+    return out.getvalue()
+
+def save_image(path: Path, rgb: np.ndarray, mode: str = "max"):
+    Path(path).write_bytes(encode_image(rgb, mode))
@@ -0,0 +1,140 @@
+import math
+
+from dem_png import tile_range_for_bbox
+
+# 複数の範囲（bbox / ポリゴン）とズーム範囲から、取得・変換するタイルの和集合を作る
+#   - ズームごと・行（y）ごとに x の区間 [x0, x1] を持ち、重なる区間はまとめる（重なった範囲のタイルは1回だけ）
+#     タイルを1枚ずつ持たないので、広い範囲でもメモリは行数 x 区間数程度
+#   - bbox は tile_range_for_bbox と同じタイル範囲
+#   - ポリゴン（[lon, lat] の外周リング）はタイルと少しでも重なれば含める（行ごとに辺の範囲 + 行の中央の内外判定）
+
+def lonlat_to_tile_xy(lon: float, lat: float, z: int):
+    """経緯度 -> タイル座標（小数。整数部がタイル番号）"""
+    n = 1 << z
+    lat_rad = math.radians(lat)
+    x = (lon + 180.0) / 360.0 * n
+    y = (1 - math.log(math.tan(math.pi / 4 + lat_rad / 2)) / math.pi) / 2 * n
+    return x, y
+
+def merge_intervals(intervals):
+    """[(x0, x1)]（両端を含む）-> 重なり・隣接をまとめた昇順のリスト"""
+    out = []
+    for x0, x1 in sorted(intervals):
+        if out and x0 <= out[-1][1] + 1:
+            if x1 > out[-1][1]:
+                out[-1] = (out[-1][0], x1)
+        else:
+            out.append((x0, x1))
+    return out
+
+def polygon_row_intervals(ring, z: int):
+    """ポリゴンの外周リング -> {y: [(x0, x1)]}（ポリゴンと重なるタイル）"""
+    pts = [lonlat_to_tile_xy(lon, lat, z) for lon, lat in ring]
+    if pts[0] != pts[-1]:
+        pts.append(pts[0])
+    edges = list(zip(pts[:-1], pts[1:]))
+    n = 1 << z
+    y_lo = max(0, int(math.floor(min(p[1] for p in pts))))
+    y_hi = min(n - 1, int(math.floor(max(p[1] for p in pts))))
+
+    rows = {}
+    for ty in range(y_lo, y_hi + 1):
+        spans = []
+        # 1. この行（ty <= y < ty+1）を通る辺の x 範囲
+        for (ax, ay), (bx, by) in edges:
+            lo, hi = max(min(ay, by), ty), min(max(ay, by), ty + 1)
+            if lo > hi:
+                continue
+            if ay == by:
+                xa, xb = ax, bx
+            else:
+                xa = ax + (bx - ax) * (lo - ay) / (by - ay)
+                xb = ax + (bx - ax) * (hi - ay) / (by - ay)
+            spans.append((int(math.floor(min(xa, xb))), int(math.floor(max(xa, xb)))))
+        # 2. 行の中央の線でポリゴンの内側になる区間（偶奇規則）
+        yc = ty + 0.5
+        xs = sorted(
+            ax + (bx - ax) * (yc - ay) / (by - ay)
+            for (ax, ay), (bx, by) in edges
+            if (ay <= yc < by) or (by <= yc < ay)
+        )
+        for xa, xb in zip(xs[0::2], xs[1::2]):
+            spans.append((int(math.floor(xa)), int(math.floor(xb))))
+        spans = [(max(0, x0), min(n - 1, x1)) for x0, x1 in spans if x1 >= 0 and x0 <= n - 1]
+        if spans:
+            rows[ty] = merge_intervals(spans)
+    return rows
+
+class TilePlan:
+    """ズームごとのタイル集合（行ごとの x 区間）。add_* で範囲を足すと和集合になる"""
+
+    def __init__(self):
+        self.zooms = {}                 # z -> {y: [(x0, x1)]}
+        self.lon_lat_bounds = None      # 足した範囲全体の (w, s, e, n)
+
+    def add_rows(self, z: int, rows: dict):
+        zrows = self.zooms.setdefault(z, {})
+        for y, spans in rows.items():
+            zrows[y] = merge_intervals(zrows.get(y, []) + list(spans))
+
+    def extend_bounds(self, w: float, s: float, e: float, n: float):
+        b = self.lon_lat_bounds
+        self.lon_lat_bounds = (w, s, e, n) if b is None else (min(b[0], w), min(b[1], s), max(b[2], e), max(b[3], n))
+
+    def add_bbox(self, bbox, z_min: int, z_max: int):
+        w, s, e, n = bbox
+        for z in range(z_min, z_max + 1):
+            x_min, x_max, y_min, y_max = tile_range_for_bbox(w, s, e, n, z)
+            self.add_rows(z, {y: [(x_min, x_max)] for y in range(y_min, y_max + 1)})
+        self.extend_bounds(w, s, e, n)
+
+    def add_polygon(self, ring, z_min: int, z_max: int):
+        for z in range(z_min, z_max + 1):
+            self.add_rows(z, polygon_row_intervals(ring, z))
+        lons, lats = [p[0] for p in ring], [p[1] for p in ring]
+        self.extend_bounds(min(lons), min(lats), max(lons), max(lats))
+
+    def contains(self, z: int, x: int, y: int) -> bool:
+        return any(x0 <= x <= x1 for x0, x1 in self.zooms.get(z, {}).get(y, ()))
+
+    def count(self, z: int = None) -> int:
+        zs = [z] if z is not None else list(self.zooms)
+        return sum(x1 - x0 + 1 for zz in zs for spans in self.zooms.get(zz, {}).values() for x0, x1 in spans)
+
+    def zoom_range(self):
+        return min(self.zooms), max(self.zooms)
+
+    def iter_tiles(self, z_min: int = None, z_max: int = None):
+        """(z, x, y) を z, y, x の順に生成する（取得・変換のタスク列にそのまま渡せる。一覧をメモリに作らない）"""
+        for z in sorted(self.zooms):
+            if (z_min is not None and z < z_min) or (z_max is not None and z > z_max):
+                continue
+            rows = self.zooms[z]
+            for y in sorted(rows):
+                for x0, x1 in rows[y]:
+                    for x in range(x0, x1 + 1):
+                        yield z, x, y
+
+def plan_regions(regions, default_zoom) -> TilePlan:
+    """
+    regions: [{"bbox": [w, s, e, n]} または {"polygon": [[lon, lat], ...]}, 任意で "zoom": [z_min, z_max]]
+    -> 全範囲の和集合の TilePlan
+    """
+    plan = TilePlan()
+    for i, region in enumerate(regions):
+        z_min, z_max = region.get("zoom", default_zoom)
+        if "bbox" in region:
+            plan.add_bbox(region["bbox"], z_min, z_max)
+        elif "polygon" in region:
+            plan.add_polygon(region["polygon"], z_min, z_max)
+        else:
+            raise ValueError(f"Region {region.get('name', i)} has neither bbox nor polygon")
+    return plan
+
+def max_zoom_plan(regions, default_zoom) -> TilePlan:
+    """各範囲をその範囲自身の最大ズームだけで足した TilePlan（fetch_max_zoom_only で取得するタイル）"""
+    top = []
+    for region in regions:
+        z_max = region.get("zoom", default_zoom)[1]
+        top.append(dict(region, zoom=[z_max, z_max]))
+    return plan_regions(top, default_zoom)
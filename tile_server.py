@@ -0,0 +1,313 @@
+import asyncio
+import functools
+import hashlib
+import json
+import queue
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from pmtiles_io import TILETYPE_PNG, TILETYPE_WEBP, PMTilesReader
+from tileset_stats import has_tile, load_coverage
+
+# MBTiles / PMTiles から {z}/{x}/{y}.png を返す小さな HTTP タイルサーバ（オフラインの MapLibre 用。標準ライブラリのみ）
+#   GET /{z}/{x}/{y}.png  タイル（無ければ 404）
+#   GET /tiles.json       TileJSON（MapLibre の raster-dem の url に指定する）
+#   GET /stats            キャッシュのヒット率など
+#   - asyncio で接続を受け、タイルの読み出しはスレッドプールで行う（イベントループを止めない）
+#   - MBTiles は読み取り専用の SQLite 接続をプール（スレッドごとに1つ借りる）、PMTiles はファイルのレンジ読み出し
+#   - タイルのバイト列はサイズ上限付き LRU に置く（無いタイルも覚えておく）。同じタイルへの同時要求は1回だけ読む
+#   - ETag（内容の md5）を付け、If-None-Match が一致すれば 304
+#   - サイドカー（*.coverage.json）があれば、範囲外のタイルはファイルを読まずに 404
+
+SOURCE_PATH = Path("dem_terrarium_z8-14.mbtiles")   # .mbtiles / .pmtiles
+HOST = "127.0.0.1"
+PORT = 8080
+
+DB_POOL = 4                         # 読み出しスレッド数 = MBTiles の接続数
+CACHE_BYTES = 64 * 1024 * 1024      # タイルキャッシュの上限（バイト）
+MISS_ENTRY_BYTES = 64               # 無いタイルを覚えるときに数えるサイズ
+CACHE_CONTROL = "public, max-age=86400"
+KEEPALIVE_SEC = 15                  # keep-alive 接続の待ち時間
+MAX_HEADER_BYTES = 16384
+
+CONTENT_TYPE = {"png": "image/png", "webp": "image/webp", "jpg": "image/jpeg", "json": "application/json"}
+
+class MBTilesSource:
+    """読み取り専用接続のプール。get_tile はスレッドから呼ぶ"""
+
+    def __init__(self, path: Path, pool_size: int = DB_POOL):
+        self.path = Path(path)
+        self.pool = queue.Queue()
+        for _ in range(pool_size):
+            conn = sqlite3.connect(f"file:{self.path.as_posix()}?mode=ro", uri=True, check_same_thread=False)
+            self.pool.put(conn)
+        conn = self.pool.get()
+        try:
+            self.meta = dict(conn.execute("SELECT name, value FROM metadata"))
+        finally:
+            self.pool.put(conn)
+        self.format = self.meta.get("format", "png")
+
+    def get_tile(self, z: int, x: int, y: int):
+        conn = self.pool.get()
+        try:
+            # MBTiles は TMS（y反転）
+            row = conn.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (z, x, (1 << z) - 1 - y),
+            ).fetchone()
+        finally:
+            self.pool.put(conn)
+        return bytes(row[0]) if row else None
+
+    def metadata(self) -> dict:
+        return dict(self.meta)
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get().close()
+
+class PMTilesSource:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.reader = PMTilesReader(self.path)
+        self.meta = {k: v if isinstance(v, str) else json.dumps(v) for k, v in self.reader.metadata().items()}
+        self.format = {TILETYPE_PNG: "png", TILETYPE_WEBP: "webp"}.get(self.reader.header["tile_type"], "png")
+
+    def get_tile(self, z: int, x: int, y: int):
+        if not (0 <= x < (1 << z) and 0 <= y < (1 << z)):
+            return None
+        return self.reader.get_tile(z, x, y)
+
+    def metadata(self) -> dict:
+        return dict(self.meta)
+
+    def close(self):
+        self.reader.close()
+
+def open_source(path: Path):
+    path = Path(path)
+    if path.suffix == ".pmtiles":
+        return PMTilesSource(path)
+    return MBTilesSource(path)
+
+class TileCache:
+    """バイト数で上限を決める LRU。(z, x, y) -> (data, etag)。data=None は「タイル無し」"""
+
+    def __init__(self, max_bytes: int = CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cost(entry) -> int:
+        return len(entry[0]) if entry[0] is not None else MISS_ENTRY_BYTES
+
+    def get(self, key):
+        entry = self.items.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        if key in self.items:
+            self.bytes -= self.cost(self.items.pop(key))
+        size = self.cost(entry)
+        if size > self.max_bytes:
+            return
+        self.items[key] = entry
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, old = self.items.popitem(last=False)
+            self.bytes -= self.cost(old)
+
+def make_tilejson(meta: dict, fmt: str, base_url: str) -> dict:
+    tj = {
+        "tilejson": "3.0.0",
+        "name": meta.get("name", ""),
+        "description": meta.get("description", ""),
+        "tiles": [f"{base_url}/{{z}}/{{x}}/{{y}}.{fmt}"],
+        "minzoom": int(meta.get("minzoom", 0)),
+        "maxzoom": int(meta.get("maxzoom", 22)),
+        "scheme": "xyz",
+        "encoding": "terrarium",
+    }
+    if "bounds" in meta:
+        tj["bounds"] = [float(v) for v in meta["bounds"].split(",")]
+    if "center" in meta:
+        tj["center"] = [float(v) for v in meta["center"].split(",")]
+    return tj
+
+def parse_tile_path(path: str, fmt: str):
+    """/z/x/y.png -> (z, x, y)。形式が違えば None"""
+    parts = path.strip("/").split("/")
+    if len(parts) != 3 or not parts[2].endswith("." + fmt):
+        return None
+    try:
+        z, x, y = int(parts[0]), int(parts[1]), int(parts[2][:-len(fmt) - 1])
+    except ValueError:
+        return None
+    if z < 0 or z > 30:
+        return None
+    return z, x, y
+
+class TileServer:
+    def __init__(self, source_path: Path = None, cache_bytes: int = CACHE_BYTES, threads: int = DB_POOL):
+        self.source_path = Path(source_path or SOURCE_PATH)
+        self.source = open_source(self.source_path)
+        self.coverage = load_coverage(self.source_path)
+        self.cache = TileCache(cache_bytes)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.inflight = {}          # (z, x, y) -> Future（同じタイルの同時要求をまとめる）
+        self.counts = {"200": 0, "304": 0, "404": 0, "500": 0, "bad_path": 0, "coverage404": 0}
+        self.t0 = time.time()
+
+    def read_tile(self, z: int, x: int, y: int):
+        """スレッド側: -> (data, etag)"""
+        data = self.source.get_tile(z, x, y)
+        if data is None:
+            return None, None
+        return data, '"' + hashlib.md5(data).hexdigest() + '"'
+
+    def read_done(self, key, fut):
+        """読み出しの完了時（待っている要求が途中で切れても呼ばれる）にキャッシュへ入れる"""
+        del self.inflight[key]
+        if not fut.cancelled() and fut.exception() is None:
+            self.cache.put(key, fut.result())
+
+    async def get_tile(self, z: int, x: int, y: int):
+        key = (z, x, y)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry
+        fut = self.inflight.get(key)
+        if fut is None:
+            loop = asyncio.get_running_loop()
+            fut = self.inflight[key] = loop.run_in_executor(self.executor, self.read_tile, z, x, y)
+            fut.add_done_callback(functools.partial(self.read_done, key))
+        # 最初の要求も shield する（その接続が切れても、同じタイルを待つ他の要求には結果を返す）
+        return await asyncio.shield(fut)
+
+    def stats(self) -> dict:
+        c = self.cache
+        total = c.hits + c.misses
+        return {
+            "source": str(self.source_path),
+            "uptime_sec": round(time.time() - self.t0, 1),
+            "responses": self.counts,
+            "cache": {"entries": len(c.items), "bytes": c.bytes, "max_bytes": c.max_bytes,
+                      "hits": c.hits, "misses": c.misses, "hit_ratio": c.hits / total if total else None},
+        }
+
+    async def respond(self, target: str, headers: dict):
+        """-> (status, 追加ヘッダ, body)"""
+        path = urlsplit(target).path
+        if path in ("/", "/tiles.json"):
+            base = f"http://{headers.get('host', f'{HOST}:{PORT}')}"
+            body = json.dumps(make_tilejson(self.source.metadata(), self.source.format, base)).encode()
+            return 200, {"Content-Type": CONTENT_TYPE["json"]}, body
+        if path == "/stats":
+            return 200, {"Content-Type": CONTENT_TYPE["json"]}, json.dumps(self.stats()).encode()
+
+        zxy = parse_tile_path(path, self.source.format)
+        if zxy is None:
+            self.counts["bad_path"] += 1
+            return 404, {}, b""
+        if self.coverage is not None and not has_tile(self.coverage, *zxy):
+            self.counts["coverage404"] += 1
+            return 404, {}, b""
+        data, etag = await self.get_tile(*zxy)
+        if data is None:
+            self.counts["404"] += 1
+            return 404, {}, b""
+        extra = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+        if headers.get("if-none-match") == etag:
+            self.counts["304"] += 1
+            return 304, extra, b""
+        self.counts["200"] += 1
+        extra["Content-Type"] = CONTENT_TYPE.get(self.source.format, "application/octet-stream")
+        return 200, extra, data
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_SEC)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        k, v = line.split(":", 1)
+                        headers[k.strip().lower()] = v.strip()
+
+                if method not in ("GET", "HEAD"):
+                    status, extra, body = 405, {"Allow": "GET, HEAD"}, b""
+                else:
+                    try:
+                        status, extra, body = await self.respond(target, headers)
+                    except Exception as e:
+                        # 壊れた DB・レンジ読み出しの失敗などは接続を切らずに 500 を返す
+                        print(f"500 {target}: {e!r}")
+                        self.counts["500"] += 1
+                        status, extra, body = 500, {}, b""
+                keep_alive = (version == "HTTP/1.1" and headers.get("connection", "").lower() != "close") \
+                    or headers.get("connection", "").lower() == "keep-alive"
+
+                reason = {200: "OK", 304: "Not Modified", 404: "Not Found", 405: "Method Not Allowed",
+                          500: "Internal Server Error"}[status]
+                out = [f"HTTP/1.1 {status} {reason}", "Access-Control-Allow-Origin: *",
+                       f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+                out += [f"{k}: {v}" for k, v in extra.items()]
+                if status != 304:
+                    out.append(f"Content-Length: {len(body)}")
+                writer.write(("\r\n".join(out) + "\r\n\r\n").encode("latin-1"))
+                if method == "GET" and status != 304:
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = HOST, port: int = PORT):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_BYTES)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.source.close()
+
+def main():
+    if not SOURCE_PATH.exists():
+        raise SystemExit(f"Tileset not found: {SOURCE_PATH.resolve()}")
+    server = TileServer(SOURCE_PATH)
+    print(f"Serving {SOURCE_PATH.resolve()} ({server.source.format})")
+    print(f"TileJSON: http://{HOST}:{PORT}/tiles.json")
+    print(f"Coverage sidecar: {'yes' if server.coverage is not None else 'no'}  cache={CACHE_BYTES:,} bytes")
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == "__main__":
+    main()
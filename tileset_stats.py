@@ -0,0 +1,138 @@
+import json
+import math
+from array import array
+from pathlib import Path
+
+# 書き出したタイルから MBTiles/PMTiles のメタデータを作る（設定値の bbox やズーム範囲ではなく実際にあるタイルから）
+#   - 書き込み中にタイル座標（と分かれば標高の min/max）を足していくだけなので、追加のパスは要らない
+#   - bounds は最大ズームのタイルの範囲、center はその中心
+#   - ズームごとのタイル数と範囲（coverage）は metadata に、列ごとの y の連続区間はサイドカー JSON に書く
+#     クライアントやタイルサーバは、これを見て存在しないタイルを要求せずに済む
+
+def tile_bounds(z: int, x: int, y: int):
+    """XYZ タイルの (w, s, e, n)（度）"""
+    n = 1 << z
+
+    def lat(yy):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * yy / n))))
+
+    return x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)
+
+def coverage_path(tileset_path: Path) -> Path:
+    """dem.mbtiles -> dem.mbtiles.coverage.json"""
+    tileset_path = Path(tileset_path)
+    return tileset_path.with_name(tileset_path.name + ".coverage.json")
+
+class TilesetStats:
+    def __init__(self):
+        self.columns = {}           # (z, x) -> array("I") の y（メモリはタイルあたり4バイト）
+        self.elev_min = None
+        self.elev_max = None
+
+    def add(self, z: int, x: int, y: int, hmin: float = None, hmax: float = None):
+        col = self.columns.get((z, x))
+        if col is None:
+            col = self.columns[(z, x)] = array("I")
+        col.append(y)
+        self.add_elevation(hmin, hmax)
+
+    def add_elevation(self, hmin: float = None, hmax: float = None):
+        # 全面 nodata のタイルは None
+        if hmin is not None:
+            self.elev_min = hmin if self.elev_min is None else min(self.elev_min, hmin)
+        if hmax is not None:
+            self.elev_max = hmax if self.elev_max is None else max(self.elev_max, hmax)
+
+    def merge(self, other: "TilesetStats"):
+        for key, ys in other.columns.items():
+            col = self.columns.get(key)
+            if col is None:
+                self.columns[key] = array("I", ys)
+            else:
+                col.extend(ys)
+        self.add_elevation(other.elev_min, other.elev_max)
+
+    def counts_by_zoom(self) -> dict:
+        counts = {}
+        for (z, _), ys in self.columns.items():
+            counts[z] = counts.get(z, 0) + len(ys)
+        return dict(sorted(counts.items()))
+
+    def tile_ranges(self) -> dict:
+        """z -> (x_min, y_min, x_max, y_max)"""
+        ranges = {}
+        for (z, x), ys in self.columns.items():
+            y0, y1 = min(ys), max(ys)
+            r = ranges.get(z)
+            ranges[z] = (x, y0, x, y1) if r is None else (min(r[0], x), min(r[1], y0), max(r[2], x), max(r[3], y1))
+        return dict(sorted(ranges.items()))
+
+    def bounds(self):
+        """最大ズームのタイルの範囲 (w, s, e, n)"""
+        ranges = self.tile_ranges()
+        if not ranges:
+            return None
+        z = max(ranges)
+        x0, y0, x1, y1 = ranges[z]
+        w, _, _, n = tile_bounds(z, x0, y0)
+        _, s, e, _ = tile_bounds(z, x1, y1)
+        return w, s, e, n
+
+    def coverage_runs(self) -> dict:
+        """z -> [[x, y_start, y_end], ...]（y の連続区間。両端を含む）"""
+        runs = {}
+        for (z, x) in sorted(self.columns):
+            ys = sorted(set(self.columns[(z, x)]))
+            start = prev = ys[0]
+            for y in ys[1:]:
+                if y != prev + 1:
+                    runs.setdefault(z, []).append([x, start, prev])
+                    start = y
+                prev = y
+            runs.setdefault(z, []).append([x, start, prev])
+        return runs
+
+    def to_metadata(self, base: dict) -> dict:
+        """base（build_metadata()）の bounds / center / zoom を実際のタイルから求めた値で置き換える"""
+        metadata = dict(base)
+        counts = self.counts_by_zoom()
+        if not counts:
+            return metadata
+        w, s, e, n = self.bounds()
+        minzoom, maxzoom = min(counts), max(counts)
+        metadata["minzoom"] = str(minzoom)
+        metadata["maxzoom"] = str(maxzoom)
+        metadata["bounds"] = f"{w:.9f},{s:.9f},{e:.9f},{n:.9f}"
+        metadata["center"] = f"{(w + e) / 2:.9f},{(s + n) / 2:.9f},{minzoom}"
+        metadata["tile_counts"] = json.dumps({str(z): c for z, c in counts.items()})
+        metadata["coverage"] = json.dumps({str(z): list(r) for z, r in self.tile_ranges().items()})
+        if self.elev_min is not None:
+            metadata["elevation_min_m"] = f"{self.elev_min:.3f}"
+            metadata["elevation_max_m"] = f"{self.elev_max:.3f}"
+        return metadata
+
+    def write_sidecar(self, tileset_path: Path) -> Path:
+        path = coverage_path(tileset_path)
+        doc = {
+            "tile_counts": {str(z): c for z, c in self.counts_by_zoom().items()},
+            "tile_ranges": {str(z): list(r) for z, r in self.tile_ranges().items()},
+            "runs": {str(z): r for z, r in self.coverage_runs().items()},
+        }
+        path.write_text(json.dumps(doc, separators=(",", ":")), encoding="utf-8")
+        return path
+
+def load_coverage(tileset_path: Path) -> dict:
+    """サイドカーを読む -> {z: {x: [(y_start, y_end), ...]}}（無ければ None）"""
+    path = coverage_path(tileset_path)
+    if not path.exists():
+        return None
+    doc = json.loads(path.read_text(encoding="utf-8"))
+    coverage = {}
+    for z, runs in doc["runs"].items():
+        cols = coverage.setdefault(int(z), {})
+        for x, y0, y1 in runs:
+            cols.setdefault(x, []).append((y0, y1))
+    return coverage
+
+def has_tile(coverage: dict, z: int, x: int, y: int) -> bool:
+    return any(y0 <= y <= y1 for y0, y1 in coverage.get(z, {}).get(x, ()))
@@ -1,90 +1,357 @@
+import functools
+import hashlib
+import io
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 from PIL import Image
 from pathlib import Path
 
+import perf_metrics
+import uniform_tiles
+from dem_codec import GSI_NODATA_RGB, buffers_for, gsi_dem_to_height_m, height_m_to_terrarium_rgb, terrarium_to_height_m
+from task_stream import StopRequest, bounded_results, ignore_sigint, iter_chunks, iter_tile_files
+from tile_encoder import FORMAT_BY_MODE, encode_image
+
 # 入出力
 IN_DIR = Path("raw_dem")
 OUT_DIR = Path("terrarium")
+TILE_FILTER = None              # (z, x, y) -> bool。None なら IN_DIR の全タイル（run_job.py が計画した範囲だけに絞るのに使う）
 
-# GSI dem_png の nodata（無効値）: RGB=(128,0,0)
-NODATA_RGB = (128, 0, 0)
+# 並列変換（CPUバウンドなのでプロセスプール）
+WORKERS = os.cpu_count() or 1   # 1 なら従来どおり直列
+CHUNKSIZE = 64                  # 1回のタスクでワーカーへまとめて渡すタイル数
+PROGRESS_EVERY = 1000           # 進捗表示の間隔（タイル数）
 
-def gsi_dem_to_height_m(rgb: np.ndarray) -> np.ndarray:
-    """
-    GSI dem_png (RGB) -> height in meters (float32)
-    rgb: HxWx3 uint8
-    仕様:
-      h = (R*256*256 + G*256 + B) * 0.01
-      if R >= 128: h -= 167772.16
-      nodata = (128,0,0)
-    """
-    r = rgb[..., 0].astype(np.int32)
-    g = rgb[..., 1].astype(np.int32)
-    b = rgb[..., 2].astype(np.int32)
+# 差分変換（マニフェストに入力/出力のハッシュを記録し、変化したタイルだけ再変換）
+INCREMENTAL = True              # False なら全タイル再変換（マニフェストは更新する）
+MANIFEST = Path("terrarium_manifest.sqlite")
+COMMIT_EVERY = 500              # マニフェストのコミット間隔（クラッシュ時の巻き戻り幅）
 
-    v = (r * 256 * 256 + g * 256 + b).astype(np.float32) * 0.01
-    # 符号付き補正（R>=128）
-    v = np.where(r >= 128, v - 167772.16, v)
+# PNG エンコード（tile_encoder.py）: "max" = 最小サイズ（リリース用）/ "fast" = 高速（開発・CI用）
+# "webp" は raw_to_mbtiles.py（MBTiles/PMTiles に直接書く）でのみ使える
+ENCODE_MODE = "max"
 
-    # nodata マスク
-    nodata = (r == NODATA_RGB[0]) & (g == NODATA_RGB[1]) & (b == NODATA_RGB[2])
-    return v, nodata
+# 変換と同じパスで往復を確認する（出力を読み直す検証を毎回しなくて済む）
+#   作った Terrarium RGB をメモリ上で復号し、元の標高（nodata は 0m）との差の最大が VERIFY_TOL_M を超えたら変換を止める
+#   Terrarium は 1/256 m 刻みに切り捨てるので、誤差は 1/256 m 未満になるはず
+VERIFY_ROUNDTRIP = True
+VERIFY_TOL_M = 1.0 / 256
+VERIFY_PNG = False              # エンコードしたバイト列もメモリ上で復号して RGB が一致するか見る（遅い）
 
-def height_m_to_terrarium_rgb(height_m: np.ndarray, nodata_mask: np.ndarray) -> np.ndarray:
-    """
-    height(m) -> Terrarium PNG RGB (uint8)
-    Terrarium:
-      v = h + 32768
-      R = floor(v / 256)
-      G = floor(v) % 256
-      B = floor((v - floor(v)) * 256)
-    nodata は 0m (v=32768) に落とす（見た目の破綻を抑える）
-    """
-    h = height_m.astype(np.float32)
+# 一様タイル（海の全面 nodata など）の出力は色ごとに1回だけ作る（uniform_tiles.py で PNG のバイト列から見分ける）
+TILE_SHAPE = (256, 256)         # 全面 nodata の出力は最初から親で作ってワーカーに渡す
+UNIFORM_BLOBS_MAX = 256         # 覚えておく色・モードの組の数
+
+class RoundTripError(RuntimeError):
+    pass
+
+def content_hash(data: bytes) -> str:
+    return hashlib.md5(data).hexdigest()
+
+def decode_png(data: bytes) -> np.ndarray:
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    return np.array(img, dtype=np.uint8)
+
+def encode_png(rgb: np.ndarray, mode: str = None) -> bytes:
+    return encode_image(rgb, mode or ENCODE_MODE)
+
+def height_stats(height_m: np.ndarray, nodata: np.ndarray):
+    """nodata を除いた (min, max, 有効画素数)。全面 nodata なら (None, None, 0)"""
+    valid_px = nodata.size - int(np.count_nonzero(nodata))
+    if valid_px == 0:
+        return None, None, 0
+    v = height_m if valid_px == nodata.size else height_m[~nodata]
+    return float(v.min()), float(v.max()), valid_px
 
-    # nodata を 0m に置換（必要なら -32768 などに変えてもOK）
-    h = np.where(nodata_mask, 0.0, h)
+def roundtrip_error(h_m: np.ndarray, nodata: np.ndarray, ter_rgb: np.ndarray, buf) -> float:
+    """Terrarium RGB を復号して元の標高との差の最大 (m)。h_m は nodata を 0m に書き換える（作業領域として使う）"""
+    np.copyto(h_m, 0.0, where=nodata)
+    dec = terrarium_to_height_m(ter_rgb, out=buf.f32, buf=buf)
+    np.subtract(dec, h_m, out=dec)
+    np.abs(dec, out=dec)
+    return float(dec.max())
 
-    v = h + 32768.0
-    v_floor = np.floor(v)
+def encode_rgb_stats(rgb: np.ndarray, mode: str = None):
+    """GSI RGB -> (Terrarium 画像のバイト列, (min, max, 有効画素数))。標高の集計と往復の確認は変換と同じパスで行う"""
+    buf = buffers_for(rgb.shape[:-1])
+    with perf_metrics.timer("codec"):
+        h_m, nodata = gsi_dem_to_height_m(rgb, out=buf.height, nodata_out=buf.nodata, buf=buf)
+        stats = height_stats(h_m, nodata)
+        ter_rgb = height_m_to_terrarium_rgb(h_m, nodata, out=buf.rgb, buf=buf)
+    with perf_metrics.timer("encode"):
+        data = encode_png(ter_rgb, mode)
+    if VERIFY_ROUNDTRIP:
+        with perf_metrics.timer("verify"):
+            err = roundtrip_error(h_m, nodata, ter_rgb, buf)
+        if err > VERIFY_TOL_M:
+            raise RoundTripError(f"round-trip error {err:.6f} m > {VERIFY_TOL_M:.6f} m")
+        if VERIFY_PNG and not np.array_equal(decode_png(data), ter_rgb):
+            raise RoundTripError("encoded image does not decode to the same RGB")
+    return data, stats
 
-    R = np.floor(v / 256.0).astype(np.int32)
-    G = (v_floor.astype(np.int32) % 256)
-    B = np.floor((v - v_floor) * 256.0).astype(np.int32)
+# (色, 形, モード) -> (Terrarium 画像のバイト列, 集計)。親で作った分はワーカーの初期値として渡す
+UNIFORM_BLOBS = {}
 
-    out = np.stack([R, G, B], axis=-1)
+def encode_uniform(pixel: tuple, shape: tuple, mode: str):
+    # 一様タイル（全面nodataの海など）は値ごと・モードごとに1回だけエンコードして使い回す
+    key = (pixel, tuple(shape), mode)
+    blob = UNIFORM_BLOBS.get(key)
+    if blob is None:
+        blob = encode_rgb_stats(np.full(tuple(shape) + (3,), pixel, dtype=np.uint8), mode)
+        if len(UNIFORM_BLOBS) < UNIFORM_BLOBS_MAX:
+            UNIFORM_BLOBS[key] = blob
+    return blob
 
-    # 範囲クリップ（安全策）
-    out = np.clip(out, 0, 255).astype(np.uint8)
-    return out
+def seed_uniform_blobs(mode: str) -> dict:
+    """親: 全面 nodata と前回までに見つけた一様タイルの出力を先に作る（init_worker に渡す）"""
+    for pixel, shape in {(GSI_NODATA_RGB, TILE_SHAPE), *uniform_tiles.known_tiles()}:
+        encode_uniform(pixel, shape, mode)
+    return {key: blob for key, blob in UNIFORM_BLOBS.items() if key[2] == mode}
 
-def convert_one(in_path: Path, out_path: Path):
-    img = Image.open(in_path).convert("RGB")
-    rgb = np.array(img, dtype=np.uint8)
+def init_worker(blobs: dict):
+    # ワーカープロセスの初期化: Ctrl-C は親だけが受ける。一様タイルの出力は親で作ったものを使う
+    ignore_sigint()
+    UNIFORM_BLOBS.update(blobs)
 
-    h_m, nodata = gsi_dem_to_height_m(rgb)
-    out_rgb = height_m_to_terrarium_rgb(h_m, nodata)
+def encode_tile_stats(raw_png: bytes, mode: str = None):
+    """GSI dem_png のPNGバイト列 -> (Terrarium 画像のバイト列, (min, max, 有効画素数))（mode 省略時は ENCODE_MODE）"""
+    mode = mode or ENCODE_MODE
+    # 一様タイルは小さいPNGなのでバイト列から判定する（既知の MD5 なら復号もしない）。出力は通常経路と同一
+    found = uniform_tiles.detect(raw_png)
+    if found is not None:
+        perf_metrics.count("uniform_tiles")
+        return encode_uniform(*found, mode)
 
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    Image.fromarray(out_rgb, mode="RGB").save(out_path, format="PNG", optimize=True)
+    with perf_metrics.timer("decode"):
+        rgb = decode_png(raw_png)
 
+    # 大きなファイルでも全画素が同じ色なら変換もPNGエンコードも省略
+    first = rgb[0, 0]
+    if (rgb == first).all():
+        perf_metrics.count("uniform_tiles")
+        return encode_uniform(tuple(int(c) for c in first), rgb.shape[:2], mode)
+
+    return encode_rgb_stats(rgb, mode)
+
+def encode_tile(raw_png: bytes, mode: str = None) -> bytes:
+    """GSI dem_png のPNGバイト列 -> Terrarium 画像のバイト列"""
+    return encode_tile_stats(raw_png, mode)[0]
+
+def write_atomic(path: Path, data: bytes):
+    # 書きかけのファイルを残さない（クラッシュ後も *.png は常に完全な状態）
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+def convert_one(in_path: Path, out_path: Path) -> bytes:
+    data = encode_tile(in_path.read_bytes())
+    write_atomic(out_path, data)
+    return data
+
+# ===== マニフェスト =====
+def open_manifest(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(path))
+    conn.executescript("""
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+
+    CREATE TABLE IF NOT EXISTS tiles (
+        rel TEXT PRIMARY KEY,       -- z/x/y.png
+        in_size INTEGER,
+        in_mtime_ns INTEGER,
+        in_hash TEXT,
+        out_hash TEXT,
+        updated_at REAL,
+        elev_min REAL,              -- nodata を除いた標高 (m)
+        elev_max REAL,
+        valid_px INTEGER            -- nodata でない画素数（NULL = 未集計）
+    );
+
+    CREATE TABLE IF NOT EXISTS meta (
+        name TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """)
+    # 標高の列が無い古いマニフェストに列を足す（未集計のタイルは次回変換し直す）
+    cols = {row[1] for row in conn.execute("PRAGMA table_info(tiles)")}
+    for name, typ in (("elev_min", "REAL"), ("elev_max", "REAL"), ("valid_px", "INTEGER")):
+        if name not in cols:
+            conn.execute(f"ALTER TABLE tiles ADD COLUMN {name} {typ}")
+    conn.commit()
+    return conn
+
+def manifest_encode_mode(conn: sqlite3.Connection) -> str:
+    row = conn.execute("SELECT value FROM meta WHERE name = 'encode_mode'").fetchone()
+    # meta が無い古いマニフェストは従来どおり optimize=True（= max）で作られている
+    return row[0] if row else "max"
+
+def prune_removed(conn: sqlite3.Connection) -> int:
+    """入力が消えたタイルの出力とマニフェスト行を削除する"""
+    gone = [rel for (rel,) in conn.execute("SELECT rel FROM tiles") if not (IN_DIR / rel).exists()]
+    for rel in gone:
+        out_path = OUT_DIR / rel
+        if out_path.exists():
+            out_path.unlink()
+        conn.execute("DELETE FROM tiles WHERE rel = ?", (rel,))
+    conn.commit()
+    return len(gone)
+
+def convert_task(task, in_dir: Path = IN_DIR, out_dir: Path = OUT_DIR, mode: str = None):
+    """
+    (rel, 前回の入力ハッシュ) -> (rel, size, mtime_ns, in_hash, out_hash, (min, max, 有効画素数))
+    入力の中身が前回と同じで出力も残っていれば再エンコードしない（out_hash=None, 集計も None）。
+    プロセスプールから呼ぶのでトップレベル関数にしておく（pickle可能）
+    """
+    rel, prev_in_hash = task
+    in_path = in_dir / rel
+    out_path = out_dir / rel
+
+    with perf_metrics.timer("read"):
+        st = in_path.stat()
+        raw = in_path.read_bytes()
+        in_hash = content_hash(raw)
+    perf_metrics.count("bytes_in", len(raw))
+
+    if prev_in_hash == in_hash and out_path.exists():
+        perf_metrics.count("same_input")
+        return rel, st.st_size, st.st_mtime_ns, in_hash, None, None
+
+    try:
+        data, stats = encode_tile_stats(raw, mode)
+    except RoundTripError as e:
+        raise RoundTripError(f"{rel}: {e}") from None
+    with perf_metrics.timer("write"):
+        write_atomic(out_path, data)
+    perf_metrics.count("bytes_out", len(data))
+    return rel, st.st_size, st.st_mtime_ns, in_hash, content_hash(data), stats
+
+def convert_chunk(tasks, in_dir: Path = IN_DIR, out_dir: Path = OUT_DIR, mode: str = None):
+    """
+    ワーカー: [task] -> ([convert_task の結果], 計測値, 見つけた一様タイル)
+    計測値・一様タイルはワーカーのプロセス内に溜まるのでチャンクごとに持ち帰る
+    入出力ディレクトリとモードは親から渡す（spawn のワーカーは親で書き換えたモジュール変数を見ない）
+    """
+    results = [convert_task(t, in_dir, out_dir, mode) for t in tasks]
+    return results, perf_metrics.take(), uniform_tiles.take_learned()
+
+def iter_tasks(conn: sqlite3.Connection, incremental: bool, counts: dict):
+    """
+    入力タイルを辿りながら変換タスク (rel, 前回の入力ハッシュ) を作る（一覧をメモリに作らない）
+    size/mtime が前回と同じなら中身も読まずにスキップ（counts に files / unchanged / skipped を数える）
+    """
+    for in_path in iter_tile_files(IN_DIR):
+        counts["files"] += 1
+        rel = in_path.relative_to(IN_DIR).as_posix()  # z/x/y.png
+        if TILE_FILTER is not None and not TILE_FILTER(*(int(v) for v in rel[:-4].split("/"))):
+            counts["skipped"] += 1
+            continue
+        row = conn.execute(
+            "SELECT in_size, in_mtime_ns, in_hash, valid_px FROM tiles WHERE rel = ?", (rel,)
+        ).fetchone()
+        # 標高が未集計（古いマニフェスト）のタイルも変換し直す
+        if not incremental or row is None or row[3] is None:
+            yield rel, None
+            continue
+        st = in_path.stat()
+        if row[0] == st.st_size and row[1] == st.st_mtime_ns and (OUT_DIR / rel).exists():
+            counts["unchanged"] += 1
+            continue
+        yield rel, row[2]
+
+def merged_results(chunk_results):
+    """convert_chunk の結果 -> convert_task の結果を1つずつ（計測値・一様タイルは親に足す）"""
+    for results, snap, learned in chunk_results:
+        perf_metrics.merge(snap)
+        uniform_tiles.remember(learned)
+        yield from results
+
+@perf_metrics.stage("terrarium")
 def main():
     if not IN_DIR.exists():
         raise SystemExit(f"Input dir not found: {IN_DIR.resolve()}")
-
-    files = list(IN_DIR.rglob("*.png"))
-    if not files:
+    if next(iter_tile_files(IN_DIR), None) is None:
         raise SystemExit("No input PNG tiles found under raw_dem/")
+    if FORMAT_BY_MODE.get(ENCODE_MODE) != "png":
+        raise SystemExit(f"ENCODE_MODE={ENCODE_MODE!r} is not PNG (use raw_to_mbtiles.py for webp)")
 
-    converted = 0
-    for in_path in files:
-        rel = in_path.relative_to(IN_DIR)  # z/x/y.png
-        out_path = OUT_DIR / rel
-        convert_one(in_path, out_path)
-        converted += 1
+    conn = open_manifest(MANIFEST)
+    try:
+        removed = prune_removed(conn)
+        # エンコードモードが前回と違えば、既存の出力は使えないので全タイル作り直す
+        incremental = INCREMENTAL and manifest_encode_mode(conn) == ENCODE_MODE
+
+        workers = max(1, WORKERS)
+        print(f"Converting (workers={workers}, chunksize={CHUNKSIZE}, encode={ENCODE_MODE})")
+        if VERIFY_ROUNDTRIP:
+            print(f"Round-trip check: tol={VERIFY_TOL_M:.6f} m{' + PNG decode' if VERIFY_PNG else ''}")
+
+        counts = {"files": 0, "unchanged": 0, "skipped": 0}
+        done = converted = 0
+        t0 = time.perf_counter()
+
+        # 直列でも並列でも同じ encode_tile を通すので出力はバイト単位で一致する
+        # タスクは入力を辿りながら作り、投入中のチャンクは workers*2 個まで（タイル数によらずメモリは一定）
+        blobs = seed_uniform_blobs(ENCODE_MODE)
+        ex = (ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(blobs,))
+              if workers > 1 else None)
+        with StopRequest() as stop:
+            try:
+                chunks = iter_chunks(iter_tasks(conn, incremental, counts), CHUNKSIZE)
+                convert = functools.partial(convert_chunk, in_dir=IN_DIR, out_dir=OUT_DIR, mode=ENCODE_MODE)
+                results = merged_results(bounded_results(ex, convert, chunks, workers * 2, stop))
+                for rel, size, mtime_ns, in_hash, out_hash, stats in results:
+                    with perf_metrics.timer("manifest"):
+                        if out_hash is None:
+                            # 中身は同じ（touchされただけ）: stat だけ更新
+                            conn.execute(
+                                "UPDATE tiles SET in_size = ?, in_mtime_ns = ?, updated_at = ? WHERE rel = ?",
+                                (size, mtime_ns, time.time(), rel),
+                            )
+                        else:
+                            conn.execute(
+                                "INSERT OR REPLACE INTO tiles(rel, in_size, in_mtime_ns, in_hash, out_hash, updated_at,"
+                                " elev_min, elev_max, valid_px) VALUES(?,?,?,?,?,?,?,?,?)",
+                                (rel, size, mtime_ns, in_hash, out_hash, time.time(), *stats),
+                            )
+                            converted += 1
+                        done += 1
+
+                        # 出力を書いた後で記録するので、途中で落ちても次回は未記録分だけやり直す
+                        if done % COMMIT_EVERY == 0:
+                            conn.commit()
+                    if done % PROGRESS_EVERY == 0:
+                        dt = time.perf_counter() - t0
+                        rate = done / dt if dt > 0 else 0.0
+                        print(f"[{done:,}] {rate:,.1f} tiles/s  ({dt:.1f}s)")
+                # 途中で止めたときはモードを記録しない（次回、モードが変わっていれば全体を作り直す）
+                if not stop.requested:
+                    conn.execute("INSERT OR REPLACE INTO meta(name, value) VALUES('encode_mode', ?)", (ENCODE_MODE,))
+            except RoundTripError as e:
+                # 誤差が許容値を超えたタイルは書かずに止める（記録済みのタイルは次回スキップされる）
+                raise SystemExit(f"Round-trip check failed: {e}")
+            finally:
+                conn.commit()
+                uniform_tiles.save()
+                if ex:
+                    ex.shutdown(cancel_futures=True)
 
-    print(f"Converted: {converted} tiles")
-    print(f"Output dir: {OUT_DIR.resolve()}")
+        dt = time.perf_counter() - t0
+        print(f"Tiles: {counts['files']:,} (unchanged={counts['unchanged']:,}, removed={removed:,})")
+        if counts["skipped"]:
+            print(f"Tiles skipped (TILE_FILTER): {counts['skipped']:,}")
+        print(f"Converted: {converted} tiles")
+        print(f"Throughput: {done / dt if dt > 0 else 0.0:,.1f} tiles/s  ({dt:.1f}s)")
+        print(f"Output dir: {OUT_DIR.resolve()}")
+        print(f"Manifest: {MANIFEST.resolve()}")
+        # 変換済みのタイルはマニフェストに記録済みなので、再実行すれば残りだけ変換する
+        stop.exit_if_requested(f"converted {done:,} tiles before stopping (rerun to resume)")
+    finally:
+        conn.close()
 
 if __name__ == "__main__":
     main()
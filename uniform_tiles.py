@@ -0,0 +1,100 @@
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import perf_metrics
+
+# 一様タイル（全画素が同じ色。海の全面 nodata など）を PNG のバイト列から見分ける
+#   - 一様な 256x256 の PNG は圧縮で数百バイトになるので、MAX_BYTES 以下のファイルだけ復号して調べる
+#     （大きいファイルは調べない。見逃しても通常の経路で処理するだけなので結果は変わらない）
+#   - 見つけた一様タイルはバイト列の MD5 で覚える。GSI の海のタイルは中身が同じファイルなので、2枚目以降は復号もしない
+#   - 覚えた MD5 は KNOWN_PATH に保存し、次の実行・各ワーカープロセス・検証スクリプトが最初に読む
+
+MAX_BYTES = 2048
+KNOWN_PATH = Path("uniform_tiles.json")   # None なら保存も読み込みもしない
+MAX_KNOWN = 4096                           # 覚える MD5 の数の上限
+
+class UniformIndex:
+    """PNG の MD5 -> ((r, g, b), (高さ, 幅))。プロセスごとに1つ"""
+
+    def __init__(self):
+        self.known = None       # 最初に使うときに KNOWN_PATH から読む
+        self.learned = {}       # この実行で見つけた分（ワーカーから親へ返す）
+        self.changed = False
+
+    def load(self):
+        self.known = {}
+        if KNOWN_PATH is not None and KNOWN_PATH.exists():
+            for key, (r, g, b, h, w) in json.loads(KNOWN_PATH.read_text(encoding="utf-8")).items():
+                self.known[key] = ((r, g, b), (h, w))
+
+    def add(self, key: str, found):
+        if self.known is None:
+            self.load()
+        if key not in self.known and len(self.known) < MAX_KNOWN:
+            self.known[key] = found
+            self.learned[key] = found
+            self.changed = True
+
+    def detect(self, data: bytes):
+        """PNG バイト列 -> 一様なら ((r, g, b), (高さ, 幅))、違えば None"""
+        if len(data) > MAX_BYTES:
+            return None
+        if self.known is None:
+            self.load()
+        key = hashlib.md5(data).hexdigest()
+        found = self.known.get(key)
+        if found is not None:
+            perf_metrics.count("uniform_known")
+            return found
+        # 小さいが一様でないタイルは覚えない（上限を一様タイルのために残す）。毎回この復号が1回増えるだけ
+        with perf_metrics.timer("uniform_probe"):
+            rgb = np.array(Image.open(io.BytesIO(data)).convert("RGB"), dtype=np.uint8)
+            first = rgb[0, 0]
+            if not (rgb == first).all():
+                return None
+        found = (tuple(int(c) for c in first), rgb.shape[:2])
+        self.add(key, found)
+        return found
+
+    def take_learned(self) -> dict:
+        learned, self.learned = self.learned, {}
+        return learned
+
+    def save(self):
+        """増えていれば KNOWN_PATH を書き換える（親プロセスから呼ぶ）"""
+        if KNOWN_PATH is None or not self.changed:
+            return
+        data = {key: [*pixel, *shape] for key, (pixel, shape) in self.known.items()}
+        tmp = KNOWN_PATH.with_name(KNOWN_PATH.name + ".tmp")
+        tmp.write_text(json.dumps(data, indent=1), encoding="utf-8")
+        os.replace(tmp, KNOWN_PATH)
+        self.changed = False
+
+INDEX = UniformIndex()
+
+def detect(data: bytes):
+    return INDEX.detect(data)
+
+def take_learned() -> dict:
+    """ワーカー側: この実行で見つけた一様タイルを返して空にする（チャンクの結果と一緒に親へ返す）"""
+    return INDEX.take_learned()
+
+def remember(learned: dict):
+    """親側: ワーカーが見つけた一様タイルを足す（最後に save() で保存する）"""
+    for key, found in learned.items():
+        INDEX.add(key, found)
+
+def known_tiles() -> set:
+    """覚えている一様タイルの (色, 形) の集合"""
+    if INDEX.known is None:
+        INDEX.load()
+    return set(INDEX.known.values())
+
+def save():
+    INDEX.save()